@@ -0,0 +1,82 @@
+"""\
+Micro-benchmark of the JSON codecs of `snuba.api.codecs` encoding query
+results shaped like event results, once as returned by
+`snuba.reader.transform_columns` and once with datetimes and UUIDs left
+for the codec to encode.
+
+python scripts/bench-json-encode.py [rows] [repeat]
+"""
+
+import sys
+import timeit
+import uuid
+from datetime import datetime, timedelta
+
+import simplejson as json
+
+from snuba.api.codecs import CODECS
+from snuba.reader import transform_columns
+from snuba.utils.metrics.timer import Timer
+
+rows = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+meta = [
+    {'name': 'event_id', 'type': 'UUID'},
+    {'name': 'project_id', 'type': 'UInt64'},
+    {'name': 'group_id', 'type': 'UInt64'},
+    {'name': 'timestamp', 'type': 'DateTime'},
+    {'name': 'received', 'type': 'Nullable(DateTime)'},
+    {'name': 'platform', 'type': 'String'},
+    {'name': 'message', 'type': 'String'},
+    {'name': 'tags.key', 'type': 'Array(String)'},
+    {'name': 'tags.value', 'type': 'Array(String)'},
+    {'name': 'duration', 'type': 'Float64'},
+]
+
+base = datetime(2019, 10, 1)
+data = [
+    {
+        'event_id': uuid.UUID(int=i),
+        'project_id': i % 10,
+        'group_id': i % 1000,
+        'timestamp': base + timedelta(seconds=i),
+        'received': base + timedelta(seconds=i + 1),
+        'platform': 'python',
+        'message': f'ValueError: invalid literal for int() with base 10: {i!r}',
+        'tags.key': ['environment', 'level', 'logger', 'release', 'server_name'],
+        'tags.value': ['production', 'error', 'root', f'1.0.{i % 50}', f'web-{i % 8}'],
+        'duration': i / 7,
+    }
+    for i in range(rows)
+]
+
+
+def make_result(transform):
+    timer = Timer('bench')
+    timer.mark('execute')
+    result = {'meta': meta, 'data': [dict(row) for row in data]}
+    if transform:
+        transform_columns(result)
+    result['timing'] = timer
+    return result
+
+
+for transform in [True, False]:
+    result = make_result(transform)
+    expected = json.loads(CODECS['simplejson'].dumps(result))
+    for name, codec in CODECS.items():
+        assert json.loads(codec.dumps(result)) == expected
+        timings = timeit.repeat(
+            'codec.dumps(result)',
+            globals={'codec': codec, 'result': result},
+            number=1,
+            repeat=repeat,
+        )
+        print('%-12s %-12s %10.2fms (best of %d, %d rows)' % (
+            name,
+            'transformed' if transform else 'raw',
+            min(timings) * 1000,
+            repeat,
+            rows,
+        ))
@@ -0,0 +1,75 @@
+"""\
+Micro-benchmark of the conversion of ClickHouse results in
+`snuba.reader.transform_columns`, compared to the previous implementation
+that matched the column types and walked the rows once per converted column.
+
+python scripts/bench-transform-columns.py [rows] [repeat]
+"""
+
+import sys
+import timeit
+import uuid
+from datetime import date, datetime, timedelta
+
+from dateutil.tz import tz
+
+from snuba.reader import DATE_TYPE_RE, DATETIME_TYPE_RE, UUID_TYPE_RE, transform_columns
+
+rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+meta = [
+    {'name': 'event_id', 'type': 'UUID'},
+    {'name': 'project_id', 'type': 'UInt64'},
+    {'name': 'timestamp', 'type': 'DateTime'},
+    {'name': 'received', 'type': 'Nullable(DateTime)'},
+    {'name': 'day', 'type': 'Date'},
+    {'name': 'message', 'type': 'String'},
+]
+
+
+def legacy_transform_columns(result):
+    for col in result['meta']:
+        if DATETIME_TYPE_RE.match(col['type']):
+            for row in result['data']:
+                row[col['name']] = row[col['name']].replace(tzinfo=tz.tzutc()).isoformat()
+        elif DATE_TYPE_RE.match(col['type']):
+            for row in result['data']:
+                row[col['name']] = datetime(
+                    *(row[col['name']].timetuple()[:6])
+                ).replace(tzinfo=tz.tzutc()).isoformat()
+        elif UUID_TYPE_RE.match(col['type']):
+            for row in result['data']:
+                row[col['name']] = str(row[col['name']])
+    return result
+
+
+base = datetime(2019, 10, 1)
+data = [
+    {
+        'event_id': uuid.UUID(int=i),
+        'project_id': i % 10,
+        'timestamp': base + timedelta(seconds=i),
+        'received': base + timedelta(seconds=i + 1),
+        'day': date(2019, 10, 1) + timedelta(days=i % 90),
+        'message': 'a message',
+    }
+    for i in range(rows)
+]
+
+
+def make_result():
+    return {'meta': meta, 'data': [dict(row) for row in data]}
+
+
+assert legacy_transform_columns(make_result()) == transform_columns(make_result())
+
+for name, func in [('legacy', legacy_transform_columns), ('transform_columns', transform_columns)]:
+    timings = timeit.repeat(
+        'func(result)',
+        setup='result = make_result()',
+        globals={'func': func, 'make_result': make_result},
+        number=1,
+        repeat=repeat,
+    )
+    print('%-20s %10.2fms (best of %d, %d rows)' % (name, min(timings) * 1000, repeat, rows))
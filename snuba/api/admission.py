@@ -0,0 +1,126 @@
+from datetime import datetime
+from typing import Any, MutableMapping, Optional
+
+from snuba import settings, state, util
+from snuba.clickhouse.estimator import PartitionStatsCache, QueryCostEstimate, estimate_query_cost
+from snuba.clickhouse.prewhere import ColumnSizeCache
+from snuba.datasets.dataset import Dataset
+from snuba.datasets.schemas.tables import MergeTreeSchema, TableSchema
+from snuba.request import Request
+from snuba.state.rate_limit import RateLimitParameters
+
+LOW_PRIORITY_RATE_LIMIT_NAME = 'low_priority'
+
+
+class QueryTooExpensive(Exception):
+    """
+    Exception thrown when the estimated cost of a query exceeds the limit.
+    """
+
+
+def estimate_request_cost(
+    dataset: Dataset,
+    request: Request,
+    from_date: datetime,
+    to_date: datetime,
+    partition_stats_cache: PartitionStatsCache,
+    column_size_cache: ColumnSizeCache,
+) -> Optional[QueryCostEstimate]:
+    schema = dataset.get_dataset_schemas().get_read_schema()
+    # Only the queries reading the table of the dataset can be estimated.
+    if not isinstance(schema, TableSchema) or request.query.get_data_source() is not schema.get_data_source():
+        return None
+
+    project_selectivity, final_factor = state.get_configs([
+        ('query_cost_project_selectivity', 0.01),
+        ('query_cost_final_factor', 2),
+    ])
+
+    project_ids = util.to_list(request.extensions.get('project', {}).get('project', []))
+    if request.query.get_sample():
+        sample = request.query.get_sample()
+    elif request.settings.get_turbo():
+        sample = settings.TURBO_SAMPLE_RATE
+    else:
+        sample = None
+
+    table = schema.get_local_table_name()
+    return estimate_query_cost(
+        partition_stats_cache.get_partitions(table),
+        column_size_cache.get_column_sizes(table),
+        from_date,
+        to_date,
+        request.query.get_all_referenced_columns(),
+        project_selectivity * len(project_ids) if project_ids else 1.0,
+        sample,
+        final_factor if request.query.get_final() else 1,
+    )
+
+
+def admit_query(
+    dataset: Dataset,
+    request: Request,
+    estimate: QueryCostEstimate,
+    stats: MutableMapping[str, Any],
+) -> None:
+    """
+    Applies the admission policy to a query estimated to read
+    ``estimate.bytes`` bytes. Above the configured thresholds, queries are:
+
+    - rejected with ``QueryTooExpensive``;
+    - sampled down to the sampling threshold, if the table can be sampled
+      and the query is not sampled already;
+    - run with a lower ClickHouse priority and fewer threads, and limited
+      in how many can run at once.
+
+    A threshold of 0 disables the action.
+    """
+    (
+        reject_bytes,
+        sample_bytes,
+        low_priority_bytes,
+        min_sample_rate,
+        low_priority,
+        low_priority_max_threads,
+        low_priority_concurrent_limit,
+    ) = state.get_configs([
+        ('query_cost_reject_bytes', 0),
+        ('query_cost_sample_bytes', 0),
+        ('query_cost_low_priority_bytes', 0),
+        ('query_cost_min_sample_rate', 0.01),
+        ('query_cost_low_priority', 10),
+        ('query_cost_low_priority_max_threads', 1),
+        ('query_cost_low_priority_concurrent_limit', 5),
+    ])
+
+    stats['estimated_rows'] = estimate.rows
+    stats['estimated_bytes'] = estimate.bytes
+    estimated_bytes = estimate.bytes
+
+    if reject_bytes and estimated_bytes > reject_bytes:
+        stats['cost_action'] = 'reject'
+        raise QueryTooExpensive(
+            'estimated bytes read of {:.0f} exceeds limit of {:.0f}'.format(estimated_bytes, reject_bytes)
+        )
+
+    schema = dataset.get_dataset_schemas().get_read_schema()
+    if (
+        sample_bytes and estimated_bytes > sample_bytes
+        and isinstance(schema, MergeTreeSchema) and schema.get_sample_expr()
+        and not request.query.get_sample() and not request.settings.get_turbo()
+    ):
+        sample_rate = round(max(min_sample_rate, sample_bytes / estimated_bytes), 4)
+        request.query.set_sample(sample_rate)
+        estimated_bytes *= sample_rate
+        stats['cost_action'] = 'sample'
+
+    if low_priority_bytes and estimated_bytes > low_priority_bytes:
+        request.settings.set_query_setting('priority', low_priority)
+        request.settings.set_query_setting('max_threads', low_priority_max_threads)
+        request.settings.add_rate_limit(RateLimitParameters(
+            rate_limit_name=LOW_PRIORITY_RATE_LIMIT_NAME,
+            bucket=LOW_PRIORITY_RATE_LIMIT_NAME,
+            per_second_limit=None,
+            concurrent_limit=low_priority_concurrent_limit,
+        ))
+        stats['cost_action'] = 'low_priority'
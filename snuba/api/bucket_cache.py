@@ -0,0 +1,204 @@
+import calendar
+import time
+from datetime import datetime
+from hashlib import md5
+from typing import Any, List, Mapping, MutableMapping, Optional, Tuple
+
+import simplejson as json
+
+from snuba import state, util
+from snuba.api.query import QueryResult
+from snuba.datasets.dataset import Dataset, TimeSeriesDataset
+from snuba.query.timeseries import TimeSeriesExtensionProcessor
+from snuba.replacer import get_replaced_projects
+from snuba.request import Request
+
+
+def _to_timestamp(value: datetime) -> int:
+    return calendar.timegm(value.timetuple())
+
+
+def _from_timestamp(value: int) -> datetime:
+    return datetime.utcfromtimestamp(value)
+
+
+def get_time_group_column(dataset: Dataset, request: Request) -> Optional[str]:
+    """
+    Returns the bucketed time column the query is grouped by, if it buckets
+    the column the time range of the query applies to.
+    """
+    if not isinstance(dataset, TimeSeriesDataset) or 'timeseries' not in request.extensions:
+        return None
+
+    timestamp_column = dataset.get_extensions()['timeseries'].get_processor().get_timestamp_column()
+    groupby = util.to_list(request.query.get_groupby())
+    for column, bucketed_column in dataset.get_time_group_columns().items():
+        if bucketed_column == timestamp_column and column in groupby:
+            return column
+    return None
+
+
+def is_mergeable(request: Request, time_column: str) -> bool:
+    """
+    Results grouped by time bucket can be computed per range of buckets and
+    concatenated, as long as nothing is computed across the whole result.
+    """
+    query = request.query
+    return (
+        request.settings.get_format() == 'json'
+        and not request.settings.get_consistent()
+        and not query.has_totals()
+        and query.get_offset() == 0
+        and query.get_limitby() is None
+        and util.to_list(query.get_orderby()) in ([], [time_column], [f'-{time_column}'])
+    )
+
+
+def get_shape_id(request: Request, replaced_projects: Mapping[int, float]) -> str:
+    """
+    Identifies everything in the request that affects the result of a
+    bucket, which excludes the time range. That includes the time of the
+    last replacement of the projects of the request, so buckets cached
+    before a replacement are not used anymore.
+    """
+    query = request.query
+    shape = [
+        query.get_data_source().format_from(),
+        query.get_selected_columns(),
+        query.get_aggregations(),
+        query.get_groupby(),
+        query.get_conditions(),
+        query.get_having(),
+        query.get_orderby(),
+        query.get_limit(),
+        query.get_sample(),
+        query.get_arrayjoin(),
+        {name: ext for name, ext in request.extensions.items() if name != 'timeseries'},
+        request.extensions['timeseries']['granularity'],
+        request.settings.get_turbo(),
+        sorted(replaced_projects.items()),
+    ]
+    return md5(util.force_bytes(json.dumps(shape, sort_keys=True))).hexdigest()
+
+
+def bucket_cache(query_func):
+    """
+    Caches the results of queries grouped by time bucket, one bucket at a
+    time, so that refreshing a chart only queries the buckets that are not
+    cached yet. Buckets closer than ``bucket_cache_recent_seconds`` to now
+    can still receive events and are never cached.
+    """
+
+    def wrapper(dataset, request: Request, *args, **kwargs):
+        use_bucket_cache, date_align, recent_seconds, timeout, max_buckets = state.get_configs([
+            ('use_bucket_cache', 0),
+            ('date_align_seconds', 1),
+            ('bucket_cache_recent_seconds', 3600),
+            ('bucket_cache_ttl', 3600),
+            ('bucket_cache_max_buckets', 10000),
+        ])
+
+        time_column = get_time_group_column(dataset, request) if use_bucket_cache else None
+        granularity = request.extensions['timeseries']['granularity'] if time_column else 0
+        if (
+            time_column is None
+            or not is_mergeable(request, time_column)
+            or granularity != int(granularity)
+            # Ranges are aligned to date_align_seconds when parsed, bucket
+            # boundaries have to stay where they are.
+            or granularity % date_align != 0
+        ):
+            return query_func(dataset, request, *args, **kwargs)
+
+        granularity = int(granularity)
+        from_date, to_date = TimeSeriesExtensionProcessor.get_time_limit(request.extensions['timeseries'])
+        start, end = _to_timestamp(from_date), _to_timestamp(to_date)
+
+        # Only the buckets entirely within the range can be cached.
+        cache_end = min(end, int(time.time()) - recent_seconds)
+        buckets = list(range(
+            start + (-start % granularity),
+            cache_end - (cache_end % granularity),
+            granularity,
+        ))
+        if not buckets or len(buckets) > max_buckets:
+            return query_func(dataset, request, *args, **kwargs)
+
+        project_ids = util.to_list(request.extensions.get('project', {}).get('project', []))
+        shape_id = get_shape_id(request, get_replaced_projects(project_ids))
+        cached: MutableMapping[int, Any] = {
+            bucket: value
+            for bucket, value in zip(buckets, state.get_buckets(shape_id, [str(b) for b in buckets]))
+            if value is not None
+        }
+        if len(cached) == len(buckets) and start == buckets[0] and end == buckets[-1] + granularity:
+            # Always run a query, even a small one, so the result has the
+            # same metadata, timing and stats as an uncached one.
+            del cached[buckets[-1]]
+
+        # Query every range that is not covered by cached buckets.
+        segments: List[Tuple[int, int]] = []
+        segment_start = start
+        for bucket in buckets:
+            if bucket in cached:
+                if segment_start < bucket:
+                    segments.append((segment_start, bucket))
+                segment_start = bucket + granularity
+        if segment_start < end:
+            segments.append((segment_start, end))
+
+        limit = request.query.get_limit()
+        result = None
+        data = [row for bucket in sorted(cached) for row in cached[bucket]]
+        to_cache: MutableMapping[str, Any] = {}
+        for segment_start, segment_end in segments:
+            # The query function may mutate the request, so every segment
+            # is queried with a copy.
+            segment_request = request.copy()
+            segment_request.extensions['timeseries']['from_date'] = _from_timestamp(segment_start).isoformat()
+            segment_request.extensions['timeseries']['to_date'] = _from_timestamp(segment_end).isoformat()
+
+            query_result = query_func(dataset, segment_request, *args, **kwargs)
+            if query_result.status != 200:
+                return query_result
+
+            if limit is not None and len(query_result.result['data']) >= limit:
+                if (segment_start, segment_end) == (start, end):
+                    return query_result
+                # The segment may have been truncated, so it cannot be
+                # merged with anything else.
+                return query_func(dataset, request, *args, **kwargs)
+
+            if result is None:
+                result = query_result.result
+
+            segment_buckets: MutableMapping[int, Any] = {
+                bucket: []
+                for bucket in buckets
+                if segment_start <= bucket and bucket + granularity <= segment_end
+            }
+            for row in query_result.result['data']:
+                bucket = _to_timestamp(util.parse_datetime(row[time_column]))
+                if bucket in segment_buckets:
+                    segment_buckets[bucket].append(row)
+            to_cache.update((str(bucket), rows) for bucket, rows in segment_buckets.items())
+
+            data.extend(query_result.result['data'])
+
+        state.set_buckets(shape_id, to_cache, timeout)
+
+        orderby = util.to_list(request.query.get_orderby())
+        if orderby:
+            # Time buckets are formatted the same way, so they sort as strings.
+            data.sort(key=lambda row: row[time_column], reverse=orderby[0].startswith('-'))
+
+        result['data'] = data[:limit] if limit is not None else data
+        if 'stats' in result:
+            result['stats'].update({
+                'cached_buckets': len(cached),
+                'queried_segments': len(segments),
+            })
+
+        return QueryResult(result, 200)
+
+    return wrapper
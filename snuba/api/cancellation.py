@@ -0,0 +1,85 @@
+import logging
+import threading
+import time
+from types import TracebackType
+from typing import Callable, Optional, Type
+
+logger = logging.getLogger('snuba.api.cancellation')
+
+DEADLINE_EXCEEDED = 'deadline'
+CLIENT_DISCONNECTED = 'disconnected'
+
+
+class QueryCancelled(Exception):
+    """
+    Exception thrown when a query is cancelled before it completes.
+    """
+
+    def __init__(self, reason: str) -> None:
+        super().__init__('deadline exceeded' if reason == DEADLINE_EXCEEDED else 'client disconnected')
+        self.reason = reason
+
+
+class QueryWatchdog:
+    """
+    Cancels a running query once the deadline of its request passes, or
+    once the client that sent it disconnects, instead of letting it run
+    for nobody until ClickHouse times out.
+
+    The client is checked every `poll_interval` seconds. When the query is
+    cancelled, `reason` says why.
+    """
+
+    def __init__(
+        self,
+        cancel: Callable[[], None],
+        deadline: Optional[float] = None,
+        disconnect_check: Optional[Callable[[], bool]] = None,
+        poll_interval: float = 0.5,
+    ) -> None:
+        self.__cancel = cancel
+        self.__deadline = deadline
+        self.__disconnect_check = disconnect_check
+        self.__poll_interval = poll_interval
+        self.__done = threading.Event()
+        self.__thread: Optional[threading.Thread] = None
+        self.reason: Optional[str] = None
+
+    def __enter__(self) -> 'QueryWatchdog':
+        if self.__deadline is not None or self.__disconnect_check is not None:
+            self.__thread = threading.Thread(target=self.__watch, name='query-watchdog', daemon=True)
+            self.__thread.start()
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc_val: Optional[BaseException],
+        exc_tb: Optional[TracebackType],
+    ) -> None:
+        self.__done.set()
+        if self.__thread is not None:
+            self.__thread.join()
+
+    def __watch(self) -> None:
+        while True:
+            timeout = self.__poll_interval if self.__disconnect_check is not None else None
+            if self.__deadline is not None:
+                remaining = self.__deadline - time.time()
+                timeout = remaining if timeout is None else min(timeout, remaining)
+
+            if self.__done.wait(max(timeout, 0) if timeout is not None else None):
+                return
+
+            if self.__deadline is not None and time.time() >= self.__deadline:
+                self.reason = DEADLINE_EXCEEDED
+            elif self.__disconnect_check is not None and self.__disconnect_check():
+                self.reason = CLIENT_DISCONNECTED
+            else:
+                continue
+
+            try:
+                self.__cancel()
+            except Exception as ex:
+                logger.exception(ex)
+            return
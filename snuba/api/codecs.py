@@ -0,0 +1,103 @@
+import logging
+from abc import ABC, abstractmethod
+from datetime import datetime
+from typing import Any, Mapping, Union
+from uuid import UUID
+
+import rapidjson
+import simplejson as json
+
+logger = logging.getLogger('snuba.api.codecs')
+
+
+def json_default(obj):
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    elif isinstance(obj, UUID):
+        return str(obj)
+    return obj
+
+
+class JSONCodec(ABC):
+    """
+    Parses the bodies of API requests and encodes the JSON responses.
+    """
+
+    name: str
+
+    @abstractmethod
+    def loads(self, value: Union[str, bytes]) -> Any:
+        raise NotImplementedError
+
+    @abstractmethod
+    def dumps(self, value: Any) -> str:
+        raise NotImplementedError
+
+
+class SimpleJSONCodec(JSONCodec):
+    """
+    Encodes objects with a ``for_json`` method, datetimes and UUIDs through
+    Python callbacks.
+    """
+
+    name = 'simplejson'
+
+    def loads(self, value: Union[str, bytes]) -> Any:
+        return json.loads(value)
+
+    def dumps(self, value: Any) -> str:
+        return json.dumps(value, for_json=True, default=json_default)
+
+
+def _rapidjson_default(obj):
+    if hasattr(obj, 'for_json'):
+        return obj.for_json()
+    raise TypeError(f'{obj!r} is not JSON serializable')
+
+
+class RapidJSONCodec(JSONCodec):
+    """
+    Parses and encodes with rapidjson, which encodes datetimes and UUIDs
+    natively, in the same format as ``json_default``.
+
+    Documents rapidjson does not handle like simplejson, such as mappings
+    with keys that are not strings or invalid request bodies, are handled
+    by simplejson, so the output and the errors are the same as with
+    ``SimpleJSONCodec``.
+    """
+
+    name = 'rapidjson'
+
+    def __init__(self) -> None:
+        self.__fallback = SimpleJSONCodec()
+
+    def loads(self, value: Union[str, bytes]) -> Any:
+        try:
+            return rapidjson.loads(value.decode('utf-8') if isinstance(value, bytes) else value)
+        except ValueError:
+            return self.__fallback.loads(value)
+
+    def dumps(self, value: Any) -> str:
+        try:
+            return rapidjson.dumps(
+                value,
+                default=_rapidjson_default,
+                datetime_mode=rapidjson.DM_ISO8601,
+                uuid_mode=rapidjson.UM_CANONICAL,
+            )
+        except (TypeError, ValueError, OverflowError):
+            return self.__fallback.dumps(value)
+
+
+CODECS: Mapping[str, JSONCodec] = {
+    codec.name: codec for codec in [SimpleJSONCodec(), RapidJSONCodec()]
+}
+
+
+def get_codec(name: str) -> JSONCodec:
+    try:
+        return CODECS[name]
+    except KeyError:
+        # A bad runtime config must not fail every request.
+        logger.warning('Unknown JSON codec %r, using %r', name, SimpleJSONCodec.name)
+        return CODECS[SimpleJSONCodec.name]
@@ -0,0 +1,119 @@
+import base64
+import binascii
+from datetime import datetime, timedelta
+from typing import Any, Mapping, Optional, Sequence, Tuple
+
+import simplejson as json
+
+from snuba import state, util
+from snuba.datasets.dataset import ColumnSplitSpec, Dataset, TimeSeriesDataset
+from snuba.request import Request
+
+
+class InvalidCursor(Exception):
+    """
+    Exception thrown when the cursor of a request cannot be used.
+    """
+
+
+def encode_cursor(timestamp: datetime, row_id: str) -> str:
+    return base64.urlsafe_b64encode(
+        util.force_bytes(json.dumps([timestamp.isoformat(), row_id]))
+    ).decode('ascii')
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, str]:
+    try:
+        timestamp, row_id = json.loads(base64.urlsafe_b64decode(util.force_bytes(cursor)))
+        return util.parse_datetime(timestamp), str(row_id)
+    except (binascii.Error, TypeError, ValueError) as error:
+        raise InvalidCursor('invalid cursor') from error
+
+
+def get_cursor_orderby(spec: ColumnSplitSpec) -> Sequence[str]:
+    """
+    Results are paged with a cursor when they are sorted by time and then by
+    id, both descending, so every row has a unique position in the sort
+    order.
+    """
+    return [f'-{spec.timestamp_column}', f'-{spec.id_column}']
+
+
+def is_paginated(dataset: Dataset, request: Request) -> bool:
+    spec = dataset.get_split_query_spec()
+    return (
+        spec is not None
+        and not request.query.get_groupby()
+        and not request.query.get_aggregations()
+        and util.to_list(request.query.get_orderby()) == list(get_cursor_orderby(spec))
+    )
+
+
+def apply_cursor(dataset: Dataset, request: Request) -> None:
+    """
+    Restricts the query to the rows after the last row of the previous page,
+    identified by its cursor. Instead of skipping the rows of the previous
+    pages with an offset, the rows are filtered on the sort key, so every
+    page is as expensive as the first one.
+    """
+    cursor = request.query.get_cursor()
+    if cursor is None:
+        return
+
+    spec = dataset.get_split_query_spec()
+    if spec is None or not is_paginated(dataset, request):
+        raise InvalidCursor('cursors are only supported by queries without aggregations ordered by {}'.format(
+            ', '.join(get_cursor_orderby(spec)) if spec is not None else 'time and id'
+        ))
+
+    timestamp, row_id = decode_cursor(cursor)
+    # (timestamp, id) < (cursor timestamp, cursor id)
+    request.query.add_conditions([
+        (spec.timestamp_column, '<=', timestamp.isoformat()),
+        [
+            (spec.timestamp_column, '<', timestamp.isoformat()),
+            (spec.id_column, '<', row_id),
+        ],
+    ])
+
+    # Also move the end of the time range, so the ranges time_split queries
+    # start from the cursor.
+    if isinstance(dataset, TimeSeriesDataset) and 'timeseries' in request.extensions:
+        timestamp_column = dataset.get_extensions()['timeseries'].get_processor().get_timestamp_column()
+        if timestamp_column == spec.timestamp_column:
+            date_align = state.get_config('date_align_seconds', 1)
+            # Timestamps are stored with a granularity of 1 second, and the
+            # end of the range is aligned down when parsed.
+            to_date = util.parse_datetime((timestamp + timedelta(seconds=1)).isoformat(), date_align)
+            if to_date <= timestamp:
+                to_date += timedelta(seconds=date_align)
+            timeseries = request.extensions['timeseries']
+            if to_date < util.parse_datetime(timeseries['to_date']):
+                timeseries['to_date'] = to_date.isoformat()
+            if util.parse_datetime(timeseries['from_date']) > to_date:
+                timeseries['from_date'] = timeseries['to_date']
+
+
+def get_next_cursor(dataset: Dataset, request: Request, result: Mapping[str, Any]) -> Optional[str]:
+    """
+    Returns the cursor of the page following a page of results, if there
+    can be one.
+    """
+    spec = dataset.get_split_query_spec()
+    if spec is None or not is_paginated(dataset, request):
+        return None
+
+    data = result.get('data')
+    limit = request.query.get_limit()
+    if not isinstance(data, list) or not data or limit is None or len(data) < limit:
+        return None
+
+    last_row = data[-1]
+    timestamp = last_row.get(spec.timestamp_column)
+    row_id = last_row.get(spec.id_column)
+    if timestamp is None or row_id is None:
+        return None
+
+    if not isinstance(timestamp, datetime):
+        timestamp = util.parse_datetime(str(timestamp))
+    return encode_cursor(timestamp, str(row_id))
@@ -1,15 +1,30 @@
+import itertools
 import logging
+import math
+import time
+import uuid
 
 from clickhouse_driver.errors import Error as ClickHouseError
 from collections import namedtuple
+from contextlib import ExitStack, contextmanager
 from hashlib import md5
-from typing import Any, MutableMapping, NamedTuple
+from typing import Any, Iterator, Mapping, MutableMapping, NamedTuple, Optional, Sequence
 
 from snuba import settings, state
-from snuba.clickhouse.native import ClickhousePool
+from snuba.api.cancellation import DEADLINE_EXCEEDED, QueryCancelled, QueryWatchdog
+from snuba.clickhouse.native import ClickhousePool, HedgingPolicy
 from snuba.clickhouse.query import ClickhouseQuery
+from snuba.query.schema import COLUMNAR_FORMATS
+from snuba.reader import get_row_count
 from snuba.request import Request
-from snuba.state.rate_limit import RateLimitAggregator, RateLimitExceeded, PROJECT_RATE_LIMIT_NAME
+from snuba.state.rate_limit import (
+    PROJECT_RATE_LIMIT_NAME,
+    RateLimitAggregator,
+    RateLimitExceeded,
+    RateLimitStatsContainer,
+)
+from snuba.state.recorder import record_query
+from snuba.state.scheduler import get_query_weight, get_scheduler
 from snuba.util import (
     create_metrics,
     force_bytes,
@@ -26,6 +41,232 @@ class QueryResult(NamedTuple):
     status: int
 
 
+def _get_query_settings(request: Request) -> MutableMapping[str, Any]:
+    query_settings = state.get_query_settings()
+    query_settings.update(request.settings.get_query_settings())
+    return query_settings
+
+
+def _apply_rate_limit_settings(
+    request: Request,
+    query_settings: MutableMapping[str, Any],
+    rate_limit_stats_container: RateLimitStatsContainer,
+    stats: MutableMapping[str, Any],
+    scheduled: bool = False,
+) -> None:
+    project_rate_limit_stats = rate_limit_stats_container.get_stats(PROJECT_RATE_LIMIT_NAME)
+
+    # Scheduled queries already share the threads with the other queries.
+    if not scheduled and 'max_threads' in query_settings and \
+            project_rate_limit_stats is not None and \
+            project_rate_limit_stats.concurrent > 1:
+        maxt = query_settings['max_threads']
+        query_settings['max_threads'] = max(1, maxt - project_rate_limit_stats.concurrent + 1)
+
+    # Force query to use the first shard replica, which
+    # should have synchronously received any cluster writes
+    # before this query is run.
+    consistent = request.settings.get_consistent()
+    stats['consistent'] = consistent
+    if consistent:
+        query_settings['load_balancing'] = 'in_order'
+        query_settings['max_threads'] = 1
+
+
+@contextmanager
+def _schedule_query(
+    request: Request,
+    query_settings: MutableMapping[str, Any],
+    stats: MutableMapping[str, Any],
+) -> Iterator[bool]:
+    """
+    Limits the threads and memory of the query to its fair share while it
+    runs, if the fair share scheduler is enabled. Yields whether the query
+    was scheduled.
+    """
+    if not state.get_config('use_fair_scheduler', 0):
+        yield False
+        return
+
+    project_ids = request.extensions.get('project', {}).get('project', [])
+    weight = get_query_weight(
+        project_ids if isinstance(project_ids, list) else [project_ids],
+        stats.get('referrer'),
+    )
+    with get_scheduler().allocate(weight) as allocation:
+        if allocation is None:
+            yield False
+            return
+
+        query_settings['max_threads'] = min(
+            query_settings.get('max_threads', allocation.max_threads),
+            allocation.max_threads,
+        )
+        if allocation.max_memory_usage is not None:
+            query_settings['max_memory_usage'] = min(
+                query_settings.get('max_memory_usage', allocation.max_memory_usage),
+                allocation.max_memory_usage,
+            )
+        stats.update({
+            'scheduler_weight': weight,
+            'scheduler_share': round(allocation.share, 4),
+            'scheduler_running': allocation.running,
+        })
+        yield True
+
+
+def _apply_deadline_settings(request: Request, query_settings: MutableMapping[str, Any]) -> None:
+    """
+    Limits the execution time of the query to the time left before the
+    deadline of the request, if it has one.
+    """
+    deadline = request.settings.get_deadline()
+    if deadline is None:
+        return
+
+    remaining = deadline - time.time()
+    if remaining <= 0:
+        raise QueryCancelled(DEADLINE_EXCEEDED)
+
+    max_execution_time = math.ceil(remaining)
+    query_settings['max_execution_time'] = min(
+        query_settings.get('max_execution_time', max_execution_time),
+        max_execution_time,
+    )
+
+
+def _watch_query(
+    request: Request,
+    client: ClickhousePool,
+    query_id: str,
+    rate_limiter: RateLimitAggregator,
+) -> QueryWatchdog:
+    def cancel() -> None:
+        client.kill_query(query_id)
+        # ClickHouse may take a while to stop the query, which should not
+        # count towards the limits anymore.
+        rate_limiter.release()
+
+    return QueryWatchdog(
+        cancel,
+        deadline=request.settings.get_deadline(),
+        disconnect_check=request.settings.get_disconnect_check(),
+    )
+
+
+def _get_hedging_policy(client: ClickhousePool) -> Optional[HedgingPolicy]:
+    """
+    Queries still running after the latency of most queries are sent to a
+    second replica when hedged reads are enabled, as long as the latency
+    of the recent queries is known.
+    """
+    use_hedged_reads, percentile, min_delay_ms, max_rate = state.get_configs([
+        ('use_hedged_reads', 0),
+        ('hedged_reads_percentile', 95),
+        ('hedged_reads_min_delay_ms', 50),
+        ('hedged_reads_max_rate', 0.05),
+    ])
+    if not use_hedged_reads:
+        return None
+
+    latency = client.get_latency_percentile(percentile)
+    if latency is None:
+        return None
+    return HedgingPolicy(delay=max(latency, min_delay_ms / 1000), max_rate=max_rate)
+
+
+def _get_error_result(sql: str, ex: BaseException) -> MutableMapping[str, Any]:
+    error = str(ex)
+    logger.exception("Error running query: %s\n%s", sql, error)
+    if isinstance(ex, ClickHouseError):
+        return {'error': {
+            'type': 'clickhouse',
+            'code': ex.code,
+            'message': error,
+        }}
+    else:
+        return {'error': {
+            'type': 'unknown',
+            'message': error,
+        }}
+
+
+def _get_rate_limit_error_result(ex: RateLimitExceeded) -> MutableMapping[str, Any]:
+    return {'error': {
+        'type': 'ratelimit',
+        'message': 'rate limit exceeded',
+        'detail': str(ex),
+    }}
+
+
+def _get_cancelled_error_result(ex: QueryCancelled) -> MutableMapping[str, Any]:
+    return {'error': {
+        'type': 'timeout' if ex.reason == DEADLINE_EXCEEDED else 'cancelled',
+        'message': str(ex),
+    }}
+
+
+def _get_cancelled_status(ex: QueryCancelled) -> int:
+    # 499 is the status nginx records for the requests the client closed.
+    return 504 if ex.reason == DEADLINE_EXCEEDED else 499
+
+
+def _finish_query(
+    request: Request,
+    sql: str,
+    timer: Timer,
+    stats: MutableMapping[str, Any],
+    query_settings: Mapping[str, Any],
+    result: MutableMapping[str, Any],
+    status: int,
+) -> QueryResult:
+    stats.update(query_settings)
+
+    if settings.RECORD_QUERIES:
+        # The query is serialized and sent to redis later, off the request
+        # thread, so it gets a copy of anything that may still change.
+        record_query({
+            'request': request.body,
+            'sql': sql,
+            'timing': timer.for_json(),
+            'stats': dict(stats),
+            'status': status,
+        })
+
+        timer.send_metrics_to(
+            metrics,
+            tags={
+                'status': str(status),
+                'referrer': stats.get('referrer', 'none'),
+                'final': str(stats.get('final', False)),
+            },
+            mark_tags={
+                'final': str(stats.get('final', False)),
+            }
+        )
+
+    result['timing'] = timer
+
+    if settings.STATS_IN_RESPONSE or request.settings.get_debug():
+        result['stats'] = stats
+        result['sql'] = sql
+
+    return QueryResult(result, status)
+
+
+def reject_query(
+    request: Request,
+    timer: Timer,
+    stats: MutableMapping[str, Any],
+    error: MutableMapping[str, Any],
+    status: int,
+) -> QueryResult:
+    """
+    Finishes a query that is rejected before being sent to ClickHouse.
+    """
+    return _finish_query(request, '', timer, stats, {}, {'error': error}, status)
+
+
 def raw_query(
     request: Request,
     query: ClickhouseQuery,
@@ -46,12 +287,7 @@ def raw_query(
         ('uncompressed_cache_max_cols', 5),
     ])
 
-    all_confs = state.get_all_configs()
-    query_settings = {
-        k.split('/', 1)[1]: v
-        for k, v in all_confs.items()
-        if k.startswith('query_settings/')
-    }
+    query_settings = _get_query_settings(request)
 
     # Experiment, if we are going to grab more than X columns worth of data,
     # don't use uncompressed_cache in clickhouse, or result cache in snuba.
@@ -61,16 +297,23 @@ def raw_query(
 
     timer.mark('get_configs')
 
+    columnar = request.settings.get_format() in COLUMNAR_FORMATS
+
     sql = query.format_sql()
     query_id = md5(force_bytes(sql)).hexdigest()
-    with state.deduper(query_id if use_deduper else None) as is_dupe:
+    # Row and columnar results of the same query are cached separately.
+    cache_key = f'{query_id}:columnar' if columnar else query_id
+    with state.deduper(query_id if use_deduper else None) as dedupe:
         timer.mark('dedupe_wait')
 
-        result = state.get_result(query_id) if use_cache else None
+        # An identical query we waited for may have cached its result.
+        result = dedupe.get_result(cache_key)
+        if result is None and use_cache:
+            result = state.get_result(cache_key)
         timer.mark('cache_get')
 
         stats.update({
-            'is_duplicate': is_dupe,
+            'is_duplicate': dedupe.is_duplicate,
             'query_id': query_id,
             'use_cache': bool(use_cache),
             'cache_hit': bool(result)}
@@ -80,102 +323,164 @@ def raw_query(
             status = 200
         else:
             try:
-                with RateLimitAggregator(request.settings.get_rate_limit_params()) as rate_limit_stats_container:
+                rate_limiter = RateLimitAggregator(request.settings.get_rate_limit_params())
+                with rate_limiter as rate_limit_stats_container, \
+                        _schedule_query(request, query_settings, stats) as scheduled:
                     stats.update(rate_limit_stats_container.to_dict())
                     timer.mark('rate_limit')
 
-                    project_rate_limit_stats = rate_limit_stats_container.get_stats(PROJECT_RATE_LIMIT_NAME)
-
-                    if 'max_threads' in query_settings and \
-                            project_rate_limit_stats is not None and \
-                            project_rate_limit_stats.concurrent > 1:
-                        maxt = query_settings['max_threads']
-                        query_settings['max_threads'] = max(1, maxt - project_rate_limit_stats.concurrent + 1)
-
-                    # Force query to use the first shard replica, which
-                    # should have synchronously received any cluster writes
-                    # before this query is run.
-                    consistent = request.settings.get_consistent()
-                    stats['consistent'] = consistent
-                    if consistent:
-                        query_settings['load_balancing'] = 'in_order'
-                        query_settings['max_threads'] = 1
+                    _apply_rate_limit_settings(request, query_settings, rate_limit_stats_container, stats, scheduled)
 
+                    # All queries should already be deduplicated at this point
+                    # But the query_id will let us know if they aren't.
+                    # Otherwise the query still needs an id to be cancelled.
+                    clickhouse_query_id = query_id if use_deduper else uuid.uuid4().hex
                     try:
-                        result = NativeDriverReader(client).execute(
-                            query,
-                            query_settings,
-                            # All queries should already be deduplicated at this point
-                            # But the query_id will let us know if they aren't
-                            query_id=query_id if use_deduper else None,
-                            with_totals=request.query.has_totals(),
-                        )
+                        _apply_deadline_settings(request, query_settings)
+                        watchdog = _watch_query(request, client, clickhouse_query_id, rate_limiter)
+                        hedging = _get_hedging_policy(client)
+                        if hedging is not None:
+                            stats['hedge_delay_ms'] = int(hedging.delay * 1000)
+                        with watchdog:
+                            try:
+                                result = NativeDriverReader(client, hedging).execute(
+                                    query,
+                                    query_settings,
+                                    query_id=clickhouse_query_id,
+                                    with_totals=request.query.has_totals(),
+                                    columnar=columnar,
+                                )
+                            except ClickHouseError as ex:
+                                if watchdog.reason is not None:
+                                    raise QueryCancelled(watchdog.reason) from ex
+                                raise
                         status = 200
 
                         logger.debug(sql)
                         timer.mark('execute')
                         stats.update({
-                            'result_rows': len(result['data']),
+                            'result_rows': get_row_count(result),
                             'result_cols': len(result['meta']),
                         })
 
                         if use_cache:
-                            state.set_result(query_id, result)
+                            state.set_result(cache_key, result)
+                            dedupe.publish(cache_key)
                             timer.mark('cache_set')
 
+                    except QueryCancelled as ex:
+                        status = _get_cancelled_status(ex)
+                        result = _get_cancelled_error_result(ex)
                     except BaseException as ex:
-                        error = str(ex)
                         status = 500
-                        logger.exception("Error running query: %s\n%s", sql, error)
-                        if isinstance(ex, ClickHouseError):
-                            result = {'error': {
-                                'type': 'clickhouse',
-                                'code': ex.code,
-                                'message': error,
-                            }}
-                        else:
-                            result = {'error': {
-                                'type': 'unknown',
-                                'message': error,
-                            }}
+                        result = _get_error_result(sql, ex)
 
             except RateLimitExceeded as ex:
-                error = str(ex)
                 status = 429
-                result = {'error': {
-                    'type': 'ratelimit',
-                    'message': 'rate limit exceeded',
-                    'detail': error
-                }}
+                result = _get_rate_limit_error_result(ex)
 
-    stats.update(query_settings)
+    return _finish_query(request, sql, timer, stats, query_settings, result, status)
 
-    if settings.RECORD_QUERIES:
-        # send to redis
-        state.record_query({
-            'request': request.body,
-            'sql': sql,
-            'timing': timer,
-            'stats': stats,
-            'status': status,
-        })
 
-        timer.send_metrics_to(
-            metrics,
-            tags={
-                'status': str(status),
-                'referrer': stats.get('referrer', 'none'),
-                'final': str(stats.get('final', False)),
-            },
-            mark_tags={
-                'final': str(stats.get('final', False)),
-            }
+def stream_query(
+    request: Request,
+    query: ClickhouseQuery,
+    client: ClickhousePool,
+    timer: Timer,
+    stats=None,
+) -> QueryResult:
+    """
+    Submit a raw SQL query to clickhouse without materializing its result.
+    The ``data`` of a successful result is an iterator over blocks of rows,
+    converted as they are received from clickhouse. The rate limit is held
+    until that iterator is exhausted or closed, which is also when the
+    totals, timing and stats are added to the result.
+
+    Streamed results are neither deduplicated nor cached.
+    """
+    from snuba.clickhouse.native import NativeDriverReader
+
+    stats = stats or {}
+    block_size, = state.get_configs([
+        ('stream_block_size', 10000),
+    ])
+    query_settings = _get_query_settings(request)
+    timer.mark('get_configs')
+
+    sql = query.format_sql()
+    query_id = md5(force_bytes(sql)).hexdigest()
+    stats['query_id'] = query_id
+
+    stack = ExitStack()
+    try:
+        rate_limit_stats_container = stack.enter_context(
+            RateLimitAggregator(request.settings.get_rate_limit_params())
+        )
+    except RateLimitExceeded as ex:
+        return _finish_query(
+            request, sql, timer, stats, query_settings, _get_rate_limit_error_result(ex), 429
         )
 
-    result['timing'] = timer
+    scheduled = stack.enter_context(_schedule_query(request, query_settings, stats))
+    stats.update(rate_limit_stats_container.to_dict())
+    timer.mark('rate_limit')
 
-    if settings.STATS_IN_RESPONSE or request.settings.get_debug():
-        result['stats'] = stats
-        result['sql'] = sql
+    _apply_rate_limit_settings(request, query_settings, rate_limit_stats_container, stats, scheduled)
 
-    return QueryResult(result, status)
+    # Streamed queries are not watched, closing the response closes the
+    # connection, which cancels the query.
+    try:
+        _apply_deadline_settings(request, query_settings)
+    except QueryCancelled as ex:
+        stack.close()
+        return _finish_query(
+            request, sql, timer, stats, query_settings, _get_cancelled_error_result(ex), _get_cancelled_status(ex)
+        )
+
+    blocks = NativeDriverReader(client).execute_iter(
+        query,
+        query_settings,
+        query_id=query_id,
+        with_totals=request.query.has_totals(),
+        block_size=block_size,
+    )
+    try:
+        # The query is only sent when the first block is requested, errors
+        # in the query itself can still be reported with an error status.
+        first_block = next(blocks)
+    except BaseException as ex:
+        stack.close()
+        return _finish_query(
+            request, sql, timer, stats, query_settings, _get_error_result(sql, ex), 500
+        )
+
+    result: MutableMapping[str, Any] = {'meta': first_block['meta']}
+
+    def iterate_data() -> Iterator[Sequence[Any]]:
+        status = 200
+        rows = 0
+        try:
+            for block in itertools.chain([first_block], blocks):
+                rows += len(block['data'])
+                if 'totals' in block:
+                    result['totals'] = block['totals']
+                yield block['data']
+
+            logger.debug(sql)
+            timer.mark('execute')
+        except Exception as ex:
+            # The response is already being sent, the error can only be
+            # reported after the rows received so far.
+            status = 500
+            result.update(_get_error_result(sql, ex))
+        finally:
+            blocks.close()
+            stack.close()
+            stats.update({
+                'result_rows': rows,
+                'result_cols': len(result['meta']),
+            })
+            _finish_query(request, sql, timer, stats, query_settings, result, status)
+
+    result['data'] = iterate_data()
+    return QueryResult(result, 200)
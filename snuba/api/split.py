@@ -1,8 +1,14 @@
-import copy
-from datetime import timedelta
+import contextvars
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta
 import math
+import threading
+from typing import Deque, NamedTuple, Optional, Tuple
 
-from snuba import state, util
+from flask import copy_current_request_context, has_request_context
+
+from snuba import settings, state, util
 from snuba.datasets.dataset import ColumnSplitSpec
 from snuba.api.query import QueryResult
 from snuba.request import Request
@@ -14,6 +20,24 @@ from snuba.request import Request
 STEP_GROWTH = 10
 
 
+# Shared by every request, so speculative windows can't use more than this
+# many threads (and ClickHouse connections) per process.
+speculative_executor = ThreadPoolExecutor(max_workers=settings.SPLIT_SPECULATIVE_THREADS)
+
+
+class Window(NamedTuple):
+    split_start: datetime
+    split_end: datetime
+    limit: int
+    speculative: bool
+    request: Request
+    # Only set for speculative windows, which are queried in the background.
+    future: Optional[Future]
+    # Set when the result of the window is not needed anymore, so the query
+    # watchdog kills the query of the window on ClickHouse.
+    discarded: threading.Event
+
+
 def split_query(query_func):
 
     def wrapper(dataset, request: Request, *args, **kwargs):
@@ -25,13 +49,16 @@ def split_query(query_func):
         remaining_offset = request.query.get_offset()
         orderby = util.to_list(request.query.get_orderby())
 
-        common_conditions = use_split and limit and not request.query.get_groupby()
+        # Splitting merges and trims materialized results row by row.
+        row_format = request.settings.get_format() == 'json'
+
+        common_conditions = use_split and limit and not request.query.get_groupby() and row_format
 
         if common_conditions:
             total_col_count = len(request.query.get_all_referenced_columns())
             column_split_spec = dataset.get_split_query_spec()
             if column_split_spec:
-                copied_query = copy.deepcopy(request.query)
+                copied_query = request.query.copy()
                 copied_query.set_selected_columns(column_split_spec.get_min_columns())
                 min_col_count = len(copied_query.get_all_referenced_columns())
             else:
@@ -60,10 +87,16 @@ def split_query(query_func):
         chunk at the end of the time range, so optimistically split the time range
         into smaller increments, and start with the last one, so that we can potentially
         avoid querying the entire range.
+
+        With ``split_speculative_windows`` set, that many of the following
+        windows are queried concurrently, assuming the windows before them
+        return no rows. Their results are only used when that assumption
+        holds, so the result is the same as when querying sequentially.
         """
-        date_align, split_step = state.get_configs([
+        date_align, split_step, speculative_windows = state.get_configs([
             ('date_align_seconds', 1),
             ('split_step', 3600),  # default 1 hour
+            ('split_speculative_windows', 0),
         ])
 
         query_limit = request.query.get_limit()
@@ -73,60 +106,130 @@ def split_query(query_func):
         to_date = util.parse_datetime(request.extensions['timeseries']['to_date'], date_align)
         from_date = util.parse_datetime(request.extensions['timeseries']['from_date'], date_align)
 
+        def get_previous_window(split_start: datetime, split_step: int) -> Tuple[datetime, datetime]:
+            try:
+                return max(split_start - timedelta(seconds=split_step), from_date), split_start
+            except OverflowError:
+                return from_date, split_start
+
+        def get_window_request(split_start: datetime, split_end: datetime, window_limit: int) -> Request:
+            # The query function may mutate the request during query
+            # evaluation, so every window is queried with a copy to ensure
+            # that the request is not modified by the time the next window
+            # is queried.
+            window_request = request.copy()
+            window_request.extensions['timeseries']['from_date'] = split_start.isoformat()
+            window_request.extensions['timeseries']['to_date'] = split_end.isoformat()
+            # Because its paged, we have to ask for (limit+offset) results
+            # and set offset=0 so we can then trim them ourselves.
+            window_request.query.set_offset(0)
+            window_request.query.set_limit(window_limit)
+            return window_request
+
+        def create_window(split_start: datetime, split_end: datetime, window_limit: int, speculative: bool) -> Window:
+            window_request = get_window_request(split_start, split_end, window_limit)
+            discarded = threading.Event()
+            future = None
+            if speculative:
+                disconnect_check = window_request.settings.get_disconnect_check()
+                window_request.settings.set_disconnect_check(
+                    lambda: discarded.is_set() or (disconnect_check is not None and disconnect_check())
+                )
+                func = query_func
+                if has_request_context():
+                    func = copy_current_request_context(query_func)
+                # Run every window in a copy of the current context, so they
+                # all share the runtime config resolved for the request.
+                context = contextvars.copy_context()
+                future = speculative_executor.submit(context.run, func, dataset, window_request, *args, **kwargs)
+
+            return Window(split_start, split_end, window_limit, speculative, window_request, future, discarded)
+
+        def get_result(window: Window) -> QueryResult:
+            if window.future is None or window.future.cancel():
+                # Not started yet, e.g. because every thread is busy with
+                # other requests: run it here rather than wait for a thread.
+                return query_func(dataset, window.request, *args, **kwargs)
+            return window.future.result()
+
+        def discard(window: Window) -> None:
+            window.discarded.set()
+            if window.future is not None:
+                window.future.cancel()
+
         overall_result = None
         split_end = to_date
         split_start = max(split_end - timedelta(seconds=split_step), from_date)
         total_results = 0
         status = 0
-        while split_start < split_end and total_results < limit:
-            request.extensions['timeseries']['from_date'] = split_start.isoformat()
-            request.extensions['timeseries']['to_date'] = split_end.isoformat()
-            # Because its paged, we have to ask for (limit+offset) results
-            # and set offset=0 so we can then trim them ourselves.
-            request.query.set_offset(0)
-            request.query.set_limit(limit - total_results + remaining_offset)
-
-            # The query function may mutate the request body during query
-            # evaluation, so we need to copy the body to ensure that the query
-            # has not been modified in between this call and the next loop
-            # iteration, if needed.
-            query_result = query_func(dataset, copy.deepcopy(request), *args, **kwargs)
-            status = query_result.status
-
-            # If something failed, discard all progress and just return that
-            if status != 200:
-                overall_result = query_result.result
-                break
-
-            if overall_result is None:
-                overall_result = query_result.result
-            else:
-                overall_result['data'].extend(query_result.result['data'])
+        # Windows that have been submitted, from the latest to the earliest.
+        windows: Deque[Window] = deque()
+        try:
+            while split_start < split_end and total_results < limit:
+                window_limit = limit - total_results + remaining_offset
+                if windows and windows[0][:3] != (split_start, split_end, window_limit):
+                    # The previous window returned rows, so the speculative
+                    # windows don't match the range and limit to query.
+                    for window in windows:
+                        discard(window)
+                    windows.clear()
 
-            if remaining_offset > 0 and len(overall_result['data']) > 0:
-                to_trim = min(remaining_offset, len(overall_result['data']))
-                overall_result['data'] = overall_result['data'][to_trim:]
-                remaining_offset -= to_trim
+                if not windows:
+                    windows.append(create_window(split_start, split_end, window_limit, False))
 
-            total_results = len(overall_result['data'])
+                while len(windows) <= speculative_windows and windows[-1].split_start > from_date:
+                    # The step grows the same way as when every window
+                    # before it returns no rows.
+                    windows.append(create_window(
+                        *get_previous_window(windows[-1].split_start, split_step * STEP_GROWTH ** len(windows)),
+                        window_limit,
+                        True,
+                    ))
 
-            if total_results < limit:
-                if len(query_result.result['data']) == 0:
-                    # If we got nothing from the last query, expand the range by a static factor
-                    split_step = split_step * STEP_GROWTH
+                window = windows.popleft()
+                query_result = get_result(window)
+                if query_result.status == 429 and window.speculative:
+                    # A speculative window may have been rejected because of
+                    # the windows running concurrently, try again on its own.
+                    query_result = query_func(
+                        dataset, get_window_request(split_start, split_end, window_limit), *args, **kwargs
+                    )
+                status = query_result.status
+
+                # If something failed, discard all progress and just return that
+                if status != 200:
+                    overall_result = query_result.result
+                    break
+
+                if overall_result is None:
+                    overall_result = query_result.result
                 else:
-                    # If we got some results but not all of them, estimate how big the time
-                    # range should be for the next query based on how many results we got for
-                    # our last query and its time range, and how many we have left to fetch.
-                    remaining = limit - total_results
-                    split_step = split_step * math.ceil(remaining / float(len(query_result.result['data'])))
-
-                # Set the start and end of the next query based on the new range.
-                split_end = split_start
-                try:
-                    split_start = max(split_end - timedelta(seconds=split_step), from_date)
-                except OverflowError:
-                    split_start = from_date
+                    overall_result['data'].extend(query_result.result['data'])
+
+                if remaining_offset > 0 and len(overall_result['data']) > 0:
+                    to_trim = min(remaining_offset, len(overall_result['data']))
+                    overall_result['data'] = overall_result['data'][to_trim:]
+                    remaining_offset -= to_trim
+
+                total_results = len(overall_result['data'])
+
+                if total_results < limit:
+                    if len(query_result.result['data']) == 0:
+                        # If we got nothing from the last query, expand the range by a static factor
+                        split_step = split_step * STEP_GROWTH
+                    else:
+                        # If we got some results but not all of them, estimate how big the time
+                        # range should be for the next query based on how many results we got for
+                        # our last query and its time range, and how many we have left to fetch.
+                        remaining = limit - total_results
+                        split_step = split_step * math.ceil(remaining / float(len(query_result.result['data'])))
+
+                    # Set the start and end of the next query based on the new range.
+                    split_start, split_end = get_previous_window(split_start, split_step)
+        finally:
+            # Discard the speculative windows that are not needed anymore.
+            for window in windows:
+                discard(window)
 
         return QueryResult(overall_result, status)
 
@@ -140,7 +243,7 @@ def split_query(query_func):
         # The query function may mutate the request body during query
         # evaluation, so we need to copy the body to ensure that the query has
         # not been modified by the time we're ready to run the full query.
-        minimal_request = copy.deepcopy(request)
+        minimal_request = request.copy()
         minimal_request.query.set_selected_columns(column_split_spec.get_min_columns())
         query_result = query_func(dataset, minimal_request, *args, **kwargs)
         del minimal_request
@@ -150,7 +253,7 @@ def split_query(query_func):
             return QueryResult(query_result.result, query_result.status)
 
         if query_result.result['data']:
-            request = copy.deepcopy(request)
+            request = request.copy()
 
             event_ids = list(set([event[column_split_spec.id_column] for event in query_result.result['data']]))
             request.query.add_conditions([(column_split_spec.id_column, 'IN', event_ids)])
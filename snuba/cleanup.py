@@ -1,12 +1,35 @@
 from datetime import datetime, timedelta
 import logging
+from typing import Sequence
 
 from snuba import util
+from snuba.datasets.dataset import Dataset
+from snuba.datasets.factory import enforce_table_writer
+from snuba.datasets.schemas.tables import MergeTreeSchema
 
 
 logger = logging.getLogger('snuba.cleanup')
 
 
+def get_cleanup_tables(dataset: Dataset) -> Sequence[str]:
+    """Returns the local tables of a dataset partitioned by (date, retention_days):
+    the table the dataset writes to, and the tables populated from it that use
+    the same partitioning, like the events rollup."""
+
+    write_schema = enforce_table_writer(dataset).get_schema()
+    tables = [write_schema.get_local_table_name()]
+    if not isinstance(write_schema, MergeTreeSchema):
+        return tables
+
+    for schema in dataset.get_dataset_schemas().get_intermediary_schemas():
+        if (
+            isinstance(schema, MergeTreeSchema)
+            and schema.get_partition_by() == write_schema.get_partition_by()
+        ):
+            tables.append(schema.get_local_table_name())
+    return tables
+
+
 def run_cleanup(clickhouse, database, table, dry_run=True):
     active_parts = get_active_partitions(clickhouse, database, table)
     stale_parts = filter_stale_partitions(active_parts)
@@ -3,7 +3,7 @@ import logging
 import click
 
 from snuba import settings
-from snuba.datasets.factory import enforce_table_writer, get_dataset, DATASET_NAMES
+from snuba.datasets.factory import get_dataset, DATASET_NAMES
 
 
 @click.command()
@@ -23,14 +23,14 @@ def cleanup(clickhouse_host, clickhouse_port, dry_run, database, dataset, log_le
     Deletes stale partitions for ClickHouse tables
     """
 
-    from snuba.cleanup import run_cleanup, logger
+    from snuba.cleanup import get_cleanup_tables, run_cleanup, logger
     from snuba.clickhouse.native import ClickhousePool
 
     dataset = get_dataset(dataset)
-    table = enforce_table_writer(dataset).get_schema().get_local_table_name()
 
     logging.basicConfig(level=getattr(logging, log_level.upper()), format='%(asctime)s %(message)s')
 
     clickhouse = ClickhousePool(clickhouse_host, clickhouse_port)
-    num_dropped = run_cleanup(clickhouse, database, table, dry_run=dry_run)
-    logger.info("Dropped %s partitions on %s" % (num_dropped, clickhouse_host))
+    for table in get_cleanup_tables(dataset):
+        num_dropped = run_cleanup(clickhouse, database, table, dry_run=dry_run)
+        logger.info("Dropped %s partitions of %s on %s" % (num_dropped, table, clickhouse_host))
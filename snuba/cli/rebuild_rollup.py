@@ -0,0 +1,56 @@
+import logging
+
+import click
+
+from snuba import settings
+from snuba.datasets.factory import get_dataset, DATASET_NAMES
+
+
+@click.command()
+@click.option('--clickhouse-host', 'clickhouse_hosts', multiple=True, default=[settings.CLICKHOUSE_HOST],
+              help='Clickhouse server to write to, repeated for every server holding the rollup.')
+@click.option('--clickhouse-port', default=settings.CLICKHOUSE_PORT, type=int,
+              help='Clickhouse native port to write to.')
+@click.option('--dry-run', type=bool, default=True,
+              help="If true, only print which partitions would be rebuilt.")
+@click.option('--database', default='default',
+              help='Name of the database to target.')
+@click.option('--dataset', default='events', type=click.Choice(DATASET_NAMES),
+              help='The dataset to target')
+@click.option('--margin-days', default=1, type=int,
+              help='Days after the end of a partition before it is rebuilt, while it can still receive events.')
+@click.option('--timeout', default=10000, type=int,
+              help='Clickhouse connection send/receive timeout, must be long enough to recompute a partition.')
+@click.option('--log-level', default=settings.LOG_LEVEL, help='Logging level to use.')
+def rebuild_rollup(clickhouse_hosts, clickhouse_port, dry_run, database, dataset, margin_days, timeout, log_level):
+    """
+    Rebuilds the closed partitions of rollup tables from the deduplicated
+    rows of the tables they are populated from, so they reflect the
+    replacements run since they were written. Meant to run daily, so the
+    rebuild catches up before `REPLACER_REPLACED_KEY_TTL`.
+    """
+
+    import time
+    from datetime import timedelta
+    from snuba.clickhouse.native import ClickhousePool
+    from snuba.rollup import get_rollups, run_rebuild, set_rollup_rebuilt, logger
+
+    dataset = get_dataset(dataset)
+
+    logging.basicConfig(level=getattr(logging, log_level.upper()), format='%(asctime)s %(message)s')
+
+    for view, table in get_rollups(dataset):
+        started = time.time()
+        rebuilt_until = []
+        for clickhouse_host in clickhouse_hosts:
+            clickhouse = ClickhousePool(clickhouse_host, clickhouse_port, send_receive_timeout=timeout)
+            until = run_rebuild(
+                clickhouse, database, view, table, dry_run=dry_run, margin=timedelta(days=margin_days),
+            )
+            logger.info("Rebuilt %s until %s on %s" % (table.get_local_table_name(), until, clickhouse_host))
+            rebuilt_until.append(until)
+
+        # Queries read every server, so the rollup is only as recent as the
+        # least recent rebuild.
+        if not dry_run and None not in rebuilt_until:
+            set_rollup_rebuilt(table.get_table_name(), started, min(rebuilt_until))
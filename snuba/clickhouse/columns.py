@@ -242,6 +242,27 @@ class DateTime(ColumnType):
     pass
 
 
+class AggregateFunction(ColumnType):
+    def __init__(self, func, *arg_types):
+        self.func = func
+        self.arg_types = arg_types
+
+    def __repr__(self):
+        return u'AggregateFunction({})'.format(
+            ', '.join([repr(self.func)] + [repr(t) for t in self.arg_types])
+        )
+
+    def __eq__(self, other):
+        return self.__class__ == other.__class__ \
+            and self.func == other.func \
+            and self.arg_types == other.arg_types
+
+    def for_schema(self):
+        return u'AggregateFunction({})'.format(
+            ', '.join([self.func] + [t.for_schema() for t in self.arg_types])
+        )
+
+
 class ColumnSet(object):
     """\
     A set of columns, unique by column name.
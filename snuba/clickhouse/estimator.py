@@ -0,0 +1,132 @@
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Mapping, MutableMapping, Optional, Sequence
+
+from snuba.clickhouse.native import ClickhousePool
+from snuba.clickhouse.prewhere import get_column_size
+
+
+logger = logging.getLogger('snuba.clickhouse.estimator')
+
+
+@dataclass(frozen=True)
+class PartitionStats:
+    """
+    The number of rows of a partition and the time range they cover.
+    """
+    min_time: datetime
+    max_time: datetime
+    rows: int
+
+
+@dataclass(frozen=True)
+class QueryCostEstimate:
+    rows: int
+    bytes: int
+
+
+class PartitionStatsCache:
+    """
+    Caches the partitions of the tables read by queries. A table is loaded
+    the first time it is requested, and then refreshed every
+    ``refresh_interval`` seconds by a background thread.
+    """
+
+    def __init__(self, clickhouse: ClickhousePool, refresh_interval: int = 300) -> None:
+        self.__clickhouse = clickhouse
+        self.__refresh_interval = refresh_interval
+        self.__partitions: MutableMapping[str, Sequence[PartitionStats]] = {}
+        self.__lock = threading.Lock()
+        self.__pid: Optional[int] = None
+
+    def get_partitions(self, table: str) -> Sequence[PartitionStats]:
+        self.__start()
+        partitions = self.__partitions.get(table)
+        if partitions is None:
+            partitions = self.__partitions[table] = self.__load(table)
+        return partitions
+
+    def __start(self) -> None:
+        # Threads do not survive a fork, so every process needs its own.
+        pid = os.getpid()
+        if self.__pid == pid:
+            return
+
+        with self.__lock:
+            if self.__pid != pid:
+                threading.Thread(target=self.__run, name='partition-stats', daemon=True).start()
+                self.__pid = pid
+
+    def __run(self) -> None:
+        while True:
+            time.sleep(self.__refresh_interval)
+            for table in list(self.__partitions):
+                self.__partitions[table] = self.__load(table)
+
+    def __load(self, table: str) -> Sequence[PartitionStats]:
+        try:
+            # Tables partitioned by a Date column do not track times.
+            return [
+                PartitionStats(min_time, max_time, rows)
+                for min_time, max_time, rows in self.__clickhouse.execute(
+                    'SELECT '
+                    'min(if(toUInt32(min_time) = 0, toDateTime(min_date), min_time)), '
+                    'max(if(toUInt32(max_time) = 0, toDateTime(max_date) + 86399, max_time)), '
+                    'sum(rows) '
+                    'FROM system.parts '
+                    'WHERE database = currentDatabase() AND table = %(table)s AND active '
+                    'GROUP BY partition',
+                    {'table': table},
+                )
+            ]
+        except Exception as ex:
+            logger.exception(ex)
+            return []
+
+
+def estimate_query_cost(
+    partitions: Sequence[PartitionStats],
+    column_sizes: Mapping[str, int],
+    from_date: datetime,
+    to_date: datetime,
+    columns: Sequence[str],
+    project_selectivity: float,
+    sample: Optional[float],
+    final_factor: float,
+) -> QueryCostEstimate:
+    """
+    Estimates the rows and bytes read by a query from the rows of the
+    partitions overlapping its time range, assuming rows are evenly spread
+    over the time range of their partition.
+
+    Queries read the fraction ``project_selectivity`` of those rows, and
+    ``final_factor`` times more data with FINAL, since the parts have to
+    be merged while they are read.
+    """
+    table_rows = 0
+    rows = 0.0
+    for partition in partitions:
+        table_rows += partition.rows
+        if partition.max_time <= partition.min_time:
+            overlap = 1.0 if from_date <= partition.min_time <= to_date else 0.0
+        else:
+            overlap = max(0.0, (
+                min(to_date, partition.max_time) - max(from_date, partition.min_time)
+            ) / (partition.max_time - partition.min_time))
+        rows += partition.rows * overlap
+
+    rows *= min(1.0, project_selectivity)
+    if sample:
+        rows = rows * sample if sample <= 1 else min(rows, sample)
+    rows *= final_factor
+
+    if not table_rows:
+        return QueryCostEstimate(0, 0)
+
+    default_size = sum(column_sizes.values()) / len(column_sizes) if column_sizes else 0
+    row_size = sum(get_column_size(col, column_sizes, default_size) for col in set(columns)) / table_rows
+    return QueryCostEstimate(int(rows), int(rows * row_size))
@@ -1,21 +1,91 @@
 import logging
+import os
 import queue
+import random
+import threading
 import time
-from typing import Iterable, Mapping, Optional
+import uuid
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from typing import Any, Iterable, Iterator, List, Mapping, MutableMapping, Optional, Sequence, Tuple
 
 from clickhouse_driver import Client, errors
 
 from snuba import settings
 from snuba.clickhouse.columns import Array
 from snuba.clickhouse.query import ClickhouseQuery
-from snuba.reader import Reader, Result, transform_columns
+from snuba.reader import Reader, Result, transform_columnar_columns, transform_columns
+from snuba.utils.metrics.backends.abstract import MetricsBackend
 from snuba.writer import BatchWriter, WriterTableRow
 
 
 logger = logging.getLogger('snuba.clickhouse')
 
 
+class HostHealth(object):
+    """
+    Tracks the health of a ClickHouse host from the queries sent to it:
+    moving averages of their error rate and latency, used to rank hosts,
+    and a circuit breaker ejecting the host after consecutive connection
+    failures.
+    """
+
+    def __init__(self, host: str, port: int, alpha: float = 0.1) -> None:
+        self.host = host
+        self.port = port
+        self.__alpha = alpha
+        self.error_rate = 0.0
+        self.latency = 0.0
+        self.consecutive_failures = 0
+        self.ejected_until: Optional[float] = None
+
+    def record_success(self, latency: float) -> None:
+        self.error_rate *= 1 - self.__alpha
+        self.latency += self.__alpha * (latency - self.latency)
+        self.consecutive_failures = 0
+        self.ejected_until = None
+
+    def record_failure(self) -> None:
+        self.error_rate += self.__alpha * (1 - self.error_rate)
+        self.consecutive_failures += 1
+
+    def eject(self, until: float) -> None:
+        self.ejected_until = until
+
+    def is_ejected(self) -> bool:
+        return self.ejected_until is not None
+
+    def get_score(self) -> float:
+        """
+        The lower the better. Errors weigh much more than latency.
+        """
+        return (self.latency + 0.001) * (1 + 10 * self.error_rate)
+
+
+@dataclass(frozen=True)
+class HedgingPolicy:
+    """
+    When to send a second copy of a read query to another replica: after
+    `delay` seconds without a result, unless more than `max_rate` of the
+    recent queries were already hedged.
+    """
+    delay: float
+    max_rate: float
+
+
 class ClickhousePool(object):
+    """
+    A pool of connections to one or more replicas of the same ClickHouse
+    data. Every query goes to the healthiest replica, picked as the best
+    of two random replicas based on their error rate and latency.
+
+    Replicas failing `failure_threshold` times in a row are ejected for
+    `eject_seconds`, after which they are re-probed in the background and
+    put back once they accept connections again. When every replica is
+    ejected, queries still go to the one closest to being re-probed.
+    """
+
     def __init__(self,
                  host=settings.CLICKHOUSE_HOST,
                  port=settings.CLICKHOUSE_PORT,
@@ -23,12 +93,37 @@ class ClickhousePool(object):
                  send_receive_timeout=300,
                  max_pool_size=settings.CLICKHOUSE_MAX_POOL_SIZE,
                  client_settings={},
+                 replicas: Sequence[Tuple[str, int]] = (),
+                 failure_threshold=3,
+                 eject_seconds=10,
+                 warm_up_connections=0,
+                 metrics: Optional[MetricsBackend] = None,
                  ):
         self.host = host
         self.port = port
         self.connect_timeout = connect_timeout
         self.send_receive_timeout = send_receive_timeout
         self.client_settings = client_settings
+        self.max_pool_size = max_pool_size
+        self.failure_threshold = failure_threshold
+        self.eject_seconds = eject_seconds
+        self.warm_up_connections = warm_up_connections
+        self.metrics = metrics
+
+        self.hosts = [HostHealth(host, port)] + [
+            HostHealth(replica_host, replica_port)
+            for replica_host, replica_port in replicas
+            if (replica_host, replica_port) != (host, port)
+        ]
+        self.__lock = threading.Lock()
+        self.__idle: MutableMapping[Tuple[str, int], List[Client]] = {}
+        self.__in_use = 0
+        self.__pid: Optional[int] = None
+        self.__executor: Optional[ThreadPoolExecutor] = None
+        # Latencies of the last queries, and moving average of the
+        # fraction of queries hedged.
+        self.__latencies: deque = deque(maxlen=1000)
+        self.__hedge_rate = 0.0
 
         self.pool = queue.LifoQueue(max_pool_size)
 
@@ -36,6 +131,128 @@ class ClickhousePool(object):
         for _ in range(max_pool_size):
             self.pool.put(None)
 
+    def start(self) -> None:
+        """
+        Starts the background threads of the pool in the current process:
+        the one warming up connections, if any, and the one re-probing
+        ejected replicas, if there are several. Threads do not survive a
+        fork, and neither should connections, so this happens again in
+        every process the pool is used in.
+        """
+        pid = os.getpid()
+        if self.__pid == pid:
+            return
+
+        with self.__lock:
+            if self.__pid == pid:
+                return
+            self.__idle = {}
+            self.__in_use = 0
+            # Runs the attempts of hedged queries.
+            self.__executor = ThreadPoolExecutor(max_workers=self.max_pool_size * 2)
+            if self.warm_up_connections > 0:
+                threading.Thread(target=self.warm_up, name='clickhouse-warm-up', daemon=True).start()
+            if len(self.hosts) > 1:
+                threading.Thread(target=self.__probe_ejected_hosts, name='clickhouse-probe', daemon=True).start()
+            self.__pid = pid
+
+    def warm_up(self) -> None:
+        """
+        Opens connections to every replica ahead of the first queries.
+        """
+        per_host = min(self.warm_up_connections, self.max_pool_size // len(self.hosts))
+        for health in self.hosts:
+            for _ in range(per_host):
+                conn = self._create_conn(health.host, health.port)
+                try:
+                    conn.connection.force_connect()
+                except Exception as e:
+                    logger.warning("Could not connect to ClickHouse host %s:%d: %s", health.host, health.port, str(e))
+                    break
+                with self.__lock:
+                    self.__idle.setdefault((health.host, health.port), []).append(conn)
+
+    def __probe_ejected_hosts(self) -> None:
+        while True:
+            time.sleep(1)
+            now = time.time()
+            for health in self.hosts:
+                if not health.is_ejected() or health.ejected_until > now:
+                    continue
+
+                conn = self._create_conn(health.host, health.port)
+                try:
+                    conn.execute('SELECT 1')
+                except Exception:
+                    with self.__lock:
+                        health.eject(time.time() + self.eject_seconds)
+                else:
+                    logger.info("ClickHouse host %s:%d is back", health.host, health.port)
+                    with self.__lock:
+                        health.record_success(health.latency)
+                finally:
+                    conn.disconnect()
+
+    def __choose_host(self) -> HostHealth:
+        available = [health for health in self.hosts if not health.is_ejected()]
+        if not available:
+            return min(self.hosts, key=lambda health: health.ejected_until)
+        if len(available) == 1:
+            return available[0]
+        return min(random.sample(available, 2), key=lambda health: health.get_score())
+
+    def __checkout(
+        self,
+        exclude: Optional[HostHealth] = None,
+        block: bool = True,
+    ) -> Tuple[HostHealth, Optional[Client]]:
+        self.start()
+
+        start = time.time()
+        # Raises queue.Empty if no connection is available without blocking.
+        self.pool.get(block=block)
+        wait = time.time() - start
+
+        with self.__lock:
+            health = self.__choose_host()
+            if health is exclude:
+                # Retry somewhere else if possible.
+                others = [other for other in self.hosts if other is not exclude and not other.is_ejected()]
+                if others:
+                    health = min(others, key=lambda other: other.get_score())
+            idle = self.__idle.get((health.host, health.port))
+            conn = idle.pop() if idle else None
+            self.__in_use += 1
+            utilization = self.__in_use / self.max_pool_size
+
+        if self.metrics is not None:
+            self.metrics.timing('clickhouse_pool.checkout_wait', wait * 1000)
+            self.metrics.gauge('clickhouse_pool.utilization', utilization)
+        return health, conn
+
+    def __checkin(self, health: HostHealth, conn: Optional[Client]) -> None:
+        with self.__lock:
+            if conn is not None:
+                self.__idle.setdefault((health.host, health.port), []).append(conn)
+            self.__in_use -= 1
+        self.pool.put(None, block=False)
+
+    def __record_success(self, health: HostHealth, latency: float) -> None:
+        with self.__lock:
+            health.record_success(latency)
+            self.__latencies.append(latency)
+
+    def __record_failure(self, health: HostHealth) -> None:
+        with self.__lock:
+            health.record_failure()
+            if health.is_ejected() or health.consecutive_failures < self.failure_threshold:
+                return
+            health.eject(time.time() + self.eject_seconds)
+
+        logger.warning("Ejecting ClickHouse host %s:%d", health.host, health.port)
+        if self.metrics is not None:
+            self.metrics.increment('clickhouse_pool.host_ejected', tags={'host': f'{health.host}:{health.port}'})
+
     def execute(self, *args, **kwargs):
         """
         Execute a clickhouse query with a single quick retry in case of
@@ -43,32 +260,206 @@ class ClickhousePool(object):
 
         This should smooth over any Clickhouse instance restarts, but will also
         return relatively quickly with an error in case of more persistent
-        failures.
+        failures. With several replicas, the retry goes to another replica
+        right away.
         """
+        health, conn = self.__checkout()
         try:
-            conn = self.pool.get(block=True)
-
             attempts_remaining = 2
             while attempts_remaining > 0:
                 attempts_remaining -= 1
                 # Lazily create connection instances
                 if conn is None:
-                    conn = self._create_conn()
+                    conn = self._create_conn(health.host, health.port)
 
                 try:
+                    start = time.time()
                     result = conn.execute(*args, **kwargs)
+                    self.__record_success(health, time.time() - start)
                     return result
                 except (errors.NetworkError, errors.SocketTimeoutError, EOFError) as e:
                     # Force a reconnection next time
                     conn = None
+                    self.__record_failure(health)
                     if attempts_remaining == 0:
                         raise e
-                    else:
+
+                    self.__checkin(health, None)
+                    previous = health
+                    health, conn = self.__checkout(exclude=previous)
+                    if health is previous:
                         # Short sleep to make sure we give the load
                         # balancer a chance to mark a bad host as down.
                         time.sleep(0.1)
         finally:
-            self.pool.put(conn, block=False)
+            self.__checkin(health, conn)
+
+    def get_latency_percentile(self, percentile: float, min_samples: int = 100) -> Optional[float]:
+        """
+        The latency of the given percentile of the last successful queries,
+        in seconds, if there were enough of them.
+        """
+        with self.__lock:
+            latencies = sorted(self.__latencies)
+        if len(latencies) < min_samples:
+            return None
+        index = min(len(latencies) - 1, int(len(latencies) * percentile / 100))
+        return latencies[index]
+
+    def execute_hedged(self, query: str, policy: HedgingPolicy, query_id: Optional[str] = None, **kwargs):
+        """
+        Execute a read query on one replica, and if it did not complete
+        after the delay of the hedging policy, on a second replica as well.
+        The first result received is returned, and the query still running
+        is killed. A query failing to connect is sent to the second replica
+        right away.
+
+        Hedging needs a spare connection and another healthy replica,
+        otherwise this is the same as `execute` without the retry.
+        """
+        if len(self.hosts) < 2:
+            return self.execute(query, query_id=query_id, **kwargs)
+
+        primary_id = query_id or uuid.uuid4().hex
+        health, conn = self.__checkout()
+        primary = self.__executor.submit(self.__execute_attempt, health, conn, query, primary_id, kwargs)
+        attempts = {primary: (health, primary_id)}
+
+        done, _ = wait([primary], timeout=policy.delay)
+        hedge: Optional[Future] = None
+        if not done or self.__is_network_error(primary.exception()):
+            hedge_id = self.__get_hedge_query_id(primary_id)
+            hedge_attempt = self.__start_hedge(health, query, hedge_id, kwargs, policy.max_rate)
+            if hedge_attempt is not None:
+                hedge_health, hedge = hedge_attempt
+                attempts[hedge] = (hedge_health, hedge_id)
+        self.__update_hedge_rate(hedge is not None)
+
+        winner: Optional[Future] = None
+        pending = set(attempts)
+        while pending and winner is None:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            winner = next((future for future in done if future.exception() is None), None)
+
+        for loser in pending:
+            loser_health, loser_id = attempts[loser]
+            self.__executor.submit(self.__kill_query, loser_health, loser_id)
+
+        if hedge is not None and winner is hedge and self.metrics is not None:
+            self.metrics.increment('clickhouse_pool.hedge_won')
+
+        if winner is None:
+            raise primary.exception()
+        return winner.result()
+
+    def __execute_attempt(
+        self,
+        health: HostHealth,
+        conn: Optional[Client],
+        query: str,
+        query_id: str,
+        kwargs: Mapping[str, Any],
+    ):
+        try:
+            if conn is None:
+                conn = self._create_conn(health.host, health.port)
+
+            start = time.time()
+            result = conn.execute(query, query_id=query_id, **kwargs)
+            self.__record_success(health, time.time() - start)
+            return result
+        except (errors.NetworkError, errors.SocketTimeoutError, EOFError):
+            conn = None
+            self.__record_failure(health)
+            raise
+        finally:
+            self.__checkin(health, conn)
+
+    def __start_hedge(
+        self,
+        exclude: HostHealth,
+        query: str,
+        query_id: str,
+        kwargs: Mapping[str, Any],
+        max_rate: float,
+    ) -> Optional[Tuple[HostHealth, Future]]:
+        with self.__lock:
+            if self.__hedge_rate >= max_rate:
+                return None
+
+        try:
+            health, conn = self.__checkout(exclude=exclude, block=False)
+        except queue.Empty:
+            return None
+        if health is exclude:
+            self.__checkin(health, conn)
+            return None
+
+        if self.metrics is not None:
+            self.metrics.increment('clickhouse_pool.hedge')
+        return health, self.__executor.submit(self.__execute_attempt, health, conn, query, query_id, kwargs)
+
+    def __update_hedge_rate(self, hedged: bool, alpha: float = 0.01) -> None:
+        with self.__lock:
+            self.__hedge_rate += alpha * (hedged - self.__hedge_rate)
+            hedge_rate = self.__hedge_rate
+        if self.metrics is not None:
+            self.metrics.gauge('clickhouse_pool.hedge_rate', hedge_rate)
+
+    def kill_query(self, query_id: str) -> None:
+        """
+        Kills a running query, and its hedged copy, on every replica it may
+        be running on.
+        """
+        for health in self.hosts:
+            if not health.is_ejected():
+                self.__kill_query(health, query_id, self.__get_hedge_query_id(query_id))
+
+    def __kill_query(self, health: HostHealth, *query_ids: str) -> None:
+        conn = self._create_conn(health.host, health.port)
+        try:
+            conn.execute('KILL QUERY WHERE has(%(query_ids)s, query_id) ASYNC', {'query_ids': list(query_ids)})
+        except Exception as e:
+            logger.warning("Could not kill query %s on ClickHouse host %s:%d: %s", query_ids[0], health.host, health.port, str(e))
+        finally:
+            conn.disconnect()
+
+    def __get_hedge_query_id(self, query_id: str) -> str:
+        return f'{query_id}-hedge'
+
+    def __is_network_error(self, error: Optional[BaseException]) -> bool:
+        return isinstance(error, (errors.NetworkError, errors.SocketTimeoutError, EOFError))
+
+    def execute_iter(self, *args, **kwargs):
+        """
+        Execute a clickhouse query and iterate over the rows of its result
+        as they are received. The connection is held until the iterator is
+        exhausted or closed. There is no retry since rows may already have
+        been consumed when the connection fails.
+        """
+        health, conn = self.__checkout()
+        completed = False
+        try:
+            if conn is None:
+                conn = self._create_conn(health.host, health.port)
+
+            start = time.time()
+            yield from conn.execute_iter(*args, **kwargs)
+            completed = True
+            with self.__lock:
+                # Not sampled for hedging, as the time includes the time
+                # spent consuming the rows.
+                health.record_success(time.time() - start)
+        except (errors.NetworkError, errors.SocketTimeoutError, EOFError):
+            self.__record_failure(health)
+            raise
+        finally:
+            if not completed and conn is not None:
+                # The rest of the result may still be in flight, so the
+                # connection cannot be reused.
+                conn.disconnect()
+                conn = None
+            self.__checkin(health, conn)
 
     def execute_robust(self, *args, **kwargs):
         """
@@ -103,28 +494,48 @@ class ClickhousePool(object):
                     # Quit immediately for other types of server errors.
                     raise
 
-    def _create_conn(self):
+    def _create_conn(self, host: str, port: int) -> Client:
         return Client(
-            host=self.host,
-            port=self.port,
+            host=host,
+            port=port,
             connect_timeout=self.connect_timeout,
             send_receive_timeout=self.send_receive_timeout,
             settings=self.client_settings
         )
 
     def close(self) -> None:
-        try:
-            while True:
-                conn = self.pool.get(block=False)
-                if conn:
-                    conn.disconnect()
-        except queue.Empty:
-            pass
+        with self.__lock:
+            idle, self.__idle = self.__idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.disconnect()
 
 
 class NativeDriverReader(Reader[ClickhouseQuery]):
-    def __init__(self, client):
+    def __init__(self, client, hedging: Optional[HedgingPolicy] = None):
         self.__client = client
+        # Only used by execute, streamed rows cannot be hedged.
+        self.__hedging = hedging
+
+    def __transform_columnar_result(self, result, with_totals: bool) -> Result:
+        """
+        Transform a columnar native driver response into a mapping of
+        column names to lists of values.
+        """
+        data, meta = result
+
+        meta = [{"name": m[0], "type": m[1]} for m in meta]
+        # The driver returns no columns at all for empty results.
+        data = {c["name"]: list(data[i]) if data else [] for i, c in enumerate(meta)}
+
+        if with_totals:
+            assert all(len(values) > 0 for values in data.values())
+            totals = {name: values.pop(-1) for name, values in data.items()}
+            result = {"data": data, "meta": meta, "totals": totals}
+        else:
+            result = {"data": data, "meta": meta}
+
+        return transform_columnar_columns(result)
 
     def __transform_result(self, result, with_totals: bool) -> Result:
         """
@@ -152,6 +563,7 @@ class NativeDriverReader(Reader[ClickhouseQuery]):
         settings: Optional[Mapping[str, str]] = None,
         query_id: Optional[str] = None,
         with_totals: bool = False,
+        columnar: bool = False,
     ) -> Result:
         if settings is None:
             settings = {}
@@ -161,13 +573,67 @@ class NativeDriverReader(Reader[ClickhouseQuery]):
             kwargs["query_id"] = query_id
 
         sql = query.format_sql()
-        return self.__transform_result(
-            self.__client.execute(
-                sql, with_column_types=True, settings=settings, **kwargs
-            ),
-            with_totals=with_totals,
+        if self.__hedging is not None:
+            result = self.__client.execute_hedged(
+                sql, self.__hedging, with_column_types=True, settings=settings, columnar=columnar, **kwargs
+            )
+        else:
+            result = self.__client.execute(
+                sql, with_column_types=True, settings=settings, columnar=columnar, **kwargs
+            )
+        if columnar:
+            return self.__transform_columnar_result(result, with_totals=with_totals)
+        else:
+            return self.__transform_result(result, with_totals=with_totals)
+
+    def execute_iter(
+        self,
+        query: ClickhouseQuery,
+        settings: Optional[Mapping[str, str]] = None,
+        query_id: Optional[str] = None,
+        with_totals: bool = False,
+        block_size: int = 10000,
+    ) -> Iterator[Result]:
+        if settings is None:
+            settings = {}
+
+        kwargs = {}
+        if query_id is not None:
+            kwargs["query_id"] = query_id
+
+        sql = query.format_sql()
+        rows = self.__client.execute_iter(
+            sql, with_column_types=True, settings=settings, **kwargs
         )
 
+        # The column types are received before any row.
+        columns = next(rows, [])
+        names = [c[0] for c in columns]
+        meta = [{"name": c[0], "type": c[1]} for c in columns]
+
+        data = []
+        pending = None
+        for row in rows:
+            if with_totals:
+                # The totals are received as the last row, so a row is only
+                # known to be data once the next one has been received.
+                row, pending = pending, row
+                if row is None:
+                    continue
+
+            data.append(dict(zip(names, row)))
+            if len(data) >= block_size:
+                yield transform_columns({"data": data, "meta": meta})
+                data = []
+
+        if with_totals:
+            assert pending is not None
+            result = {"data": data, "meta": meta, "totals": dict(zip(names, pending))}
+        else:
+            result = {"data": data, "meta": meta}
+
+        yield transform_columns(result)
+
 
 class NativeDriverBatchWriter(BatchWriter):
     def __init__(self, schema, connection):
@@ -0,0 +1,212 @@
+import logging
+import os
+import re
+import threading
+import time
+from typing import List, Mapping, MutableMapping, Optional, Sequence, Tuple
+
+from snuba import util
+from snuba.clickhouse.native import ClickhousePool
+from snuba.datasets.dataset import Dataset
+from snuba.datasets.schemas.tables import TableSchema
+from snuba.query.query import Query
+from snuba.query.types import Condition
+
+
+logger = logging.getLogger('snuba.clickhouse.prewhere')
+
+# Rough fraction of the rows matched by a condition using each operator.
+# IN matches as many rows as an equality per value.
+OPERATOR_SELECTIVITY: Mapping[str, float] = {
+    '=': 0.01,
+    'IN': 0.01,
+    'IS NULL': 0.1,
+    'LIKE': 0.1,
+    '>': 0.5,
+    '<': 0.5,
+    '>=': 0.5,
+    '<=': 0.5,
+    'NOT LIKE': 0.9,
+    'IS NOT NULL': 0.9,
+    '!=': 0.99,
+    'NOT IN': 0.99,
+}
+
+NESTED_COL_EXPR_RE = re.compile(r'^([a-zA-Z0-9_\.]+)\[[a-zA-Z0-9_\.:-]+\]$')
+
+
+class ColumnSizeCache:
+    """
+    Caches the compressed size on disk of the columns of the tables read by
+    queries. A table is loaded the first time it is requested, and then
+    refreshed every ``refresh_interval`` seconds by a background thread, so
+    requests keep using the previous sizes while they are refreshed.
+    """
+
+    def __init__(self, clickhouse: ClickhousePool, refresh_interval: int = 600) -> None:
+        self.__clickhouse = clickhouse
+        self.__refresh_interval = refresh_interval
+        self.__sizes: MutableMapping[str, Mapping[str, int]] = {}
+        self.__lock = threading.Lock()
+        self.__pid: Optional[int] = None
+
+    def get_column_sizes(self, table: str) -> Mapping[str, int]:
+        self.__start()
+        sizes = self.__sizes.get(table)
+        if sizes is None:
+            # Failures are cached as well until the next refresh, so an
+            # unavailable table is not queried by every request.
+            sizes = self.__sizes[table] = self.__load(table)
+        return sizes
+
+    def refresh(self) -> None:
+        for table in list(self.__sizes):
+            self.__sizes[table] = self.__load(table)
+
+    def __start(self) -> None:
+        # Threads do not survive a fork, so every process needs its own.
+        pid = os.getpid()
+        if self.__pid == pid:
+            return
+
+        with self.__lock:
+            if self.__pid != pid:
+                threading.Thread(target=self.__run, name='column-sizes', daemon=True).start()
+                self.__pid = pid
+
+    def __run(self) -> None:
+        while True:
+            time.sleep(self.__refresh_interval)
+            self.refresh()
+
+    def __load(self, table: str) -> Mapping[str, int]:
+        try:
+            sizes = {
+                name: size
+                for name, size in self.__clickhouse.execute(
+                    'SELECT name, data_compressed_bytes FROM system.columns '
+                    'WHERE database = currentDatabase() AND table = %(table)s',
+                    {'table': table},
+                )
+            }
+            if not any(sizes.values()):
+                # Older servers do not report sizes in system.columns.
+                sizes = {
+                    name: size
+                    for name, size in self.__clickhouse.execute(
+                        'SELECT name, sum(column_data_compressed_bytes) FROM system.parts_columns '
+                        'WHERE database = currentDatabase() AND table = %(table)s AND active '
+                        'GROUP BY name',
+                        {'table': table},
+                    )
+                }
+            return sizes
+        except Exception as ex:
+            logger.exception(ex)
+            return {}
+
+
+def get_column_size(column: str, column_sizes: Mapping[str, int], default: float) -> float:
+    """
+    Returns the size of a column referenced by a query, including the
+    key and value columns read by a nested column expression.
+    """
+    if column in column_sizes:
+        return column_sizes[column]
+
+    match = NESTED_COL_EXPR_RE.match(column)
+    if match:
+        nested = match.group(1)
+        sizes = [column_sizes[c] for c in (f'{nested}.key', f'{nested}.value') if c in column_sizes]
+        if sizes:
+            return sum(sizes)
+
+    return default
+
+
+def get_selectivity(condition: Condition) -> float:
+    _, operator, literal = condition
+    selectivity = OPERATOR_SELECTIVITY.get(operator, 1.0)
+    if operator == 'IN' and isinstance(literal, (list, tuple)):
+        selectivity = min(1.0, selectivity * len(literal))
+    return selectivity
+
+
+def get_prewhere_candidates(dataset: Dataset, query: Query) -> Sequence[Tuple[Sequence[str], Condition]]:
+    """
+    Returns the conditions that can be moved to PREWHERE: single top-level
+    conditions (not OR-nested) referencing any of the prewhere keys of the
+    dataset, sorted by the position of their columns in the prewhere keys.
+    """
+    prewhere_keys = dataset.get_prewhere_keys()
+    candidates = [
+        (util.columns_in_expr(cond[0]), cond)
+        for cond in query.get_conditions() if util.is_condition(cond) and
+        any(col in prewhere_keys for col in util.columns_in_expr(cond[0]))
+    ]
+    return [
+        (cols, cond) for _, cols, cond in sorted(
+            [
+                (min(prewhere_keys.index(col) for col in cols if col in prewhere_keys), cols, cond)
+                for cols, cond in candidates
+            ],
+            key=lambda candidate: candidate[0],
+        )
+    ]
+
+
+def get_table_column_sizes(dataset: Dataset, column_size_cache: ColumnSizeCache) -> Mapping[str, int]:
+    schema = dataset.get_dataset_schemas().get_read_schema()
+    if not isinstance(schema, TableSchema):
+        return {}
+    return column_size_cache.get_column_sizes(schema.get_local_table_name())
+
+
+def plan_prewhere(
+    dataset: Dataset,
+    query: Query,
+    column_sizes: Mapping[str, int],
+    max_conditions: int,
+) -> Sequence[Condition]:
+    """
+    Picks the PREWHERE conditions that minimize the estimated amount of
+    data read by the query.
+
+    ClickHouse reads the PREWHERE columns first and then the other columns
+    only for the granules matching the PREWHERE conditions, so the cost of
+    a set of conditions is estimated as the size of their columns plus the
+    size of the remaining columns scaled by the combined selectivity of the
+    conditions. Conditions are added greedily, cheapest first, for as long
+    as they lower the cost.
+    """
+    candidates = get_prewhere_candidates(dataset, query)
+    if not candidates or max_conditions <= 0:
+        return []
+
+    default_size = sum(column_sizes.values()) / len(column_sizes) if column_sizes else 1.0
+    referenced = set(query.get_all_referenced_columns())
+    for cols, _ in candidates:
+        referenced.update(cols)
+    sizes = {col: get_column_size(col, column_sizes, default_size) for col in referenced}
+    total_size = sum(sizes.values())
+
+    def get_cost(conditions: Sequence[Tuple[Sequence[str], Condition]]) -> float:
+        columns = {col for cols, _ in conditions for col in cols}
+        prewhere_size = sum(sizes[col] for col in columns)
+        selectivity = 1.0
+        for _, cond in conditions:
+            selectivity *= get_selectivity(cond)
+        return prewhere_size + selectivity * (total_size - prewhere_size)
+
+    chosen: List[Tuple[Sequence[str], Condition]] = []
+    remaining = list(candidates)
+    cost: Optional[float] = None
+    while remaining and len(chosen) < max_conditions:
+        # Ties keep the order of the prewhere keys.
+        best_cost, best = min((get_cost(chosen + [candidate]), i) for i, candidate in enumerate(remaining))
+        if cost is not None and best_cost >= cost:
+            break
+        cost = best_cost
+        chosen.append(remaining.pop(best))
+
+    return [cond for _, cond in chosen]
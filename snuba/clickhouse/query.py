@@ -1,7 +1,8 @@
-from typing import Sequence
+from typing import Optional, Sequence
 
 from snuba import settings as snuba_settings
 from snuba import util
+from snuba.clickhouse.query_templates import QueryTemplateCache
 from snuba.query.columns import (
     column_expr,
     conditions_expr,
@@ -9,9 +10,95 @@ from snuba.query.columns import (
 from snuba.datasets.dataset import Dataset
 from snuba.query.parsing import ParsingContext
 from snuba.query.query import Query
+from snuba.query.types import Condition
 from snuba.request.request_settings import RequestSettings
 
 
+def format_query(
+    dataset: Dataset,
+    query: Query,
+    settings: RequestSettings,
+    prewhere_conditions: Sequence[Condition],
+) -> str:
+    """
+    Formats the SQL statement for a snuba Query.
+    """
+    parsing_context = ParsingContext()
+
+    aggregate_exprs = [column_expr(dataset, col, query, parsing_context, alias, agg) for (agg, col, alias) in query.get_aggregations()]
+    groupby = util.to_list(query.get_groupby())
+    group_exprs = [column_expr(dataset, gb, query, parsing_context) for gb in groupby]
+    column_names = query.get_selected_columns() or []
+    selected_cols = [column_expr(dataset, util.tuplify(colname), query, parsing_context) for colname in column_names]
+    select_clause = u'SELECT {}'.format(', '.join(group_exprs + aggregate_exprs + selected_cols))
+
+    from_clause = u'FROM {}'.format(query.get_data_source().format_from())
+
+    if query.get_final():
+        from_clause = u'{} FINAL'.format(from_clause)
+
+    if query.get_sample():
+        sample_rate = query.get_sample()
+    elif settings.get_turbo():
+        sample_rate = snuba_settings.TURBO_SAMPLE_RATE
+    else:
+        sample_rate = None
+
+    if sample_rate:
+        from_clause = u'{} SAMPLE {}'.format(from_clause, sample_rate)
+
+    join_clause = ''
+    if query.get_arrayjoin():
+        join_clause = u'ARRAY JOIN {}'.format(query.get_arrayjoin())
+
+    where_clause = ''
+    if query.get_conditions():
+        where_clause = u'WHERE {}'.format(conditions_expr(dataset, query.get_conditions(), query, parsing_context))
+
+    prewhere_clause = ''
+    if prewhere_conditions:
+        prewhere_clause = u'PREWHERE {}'.format(conditions_expr(dataset, prewhere_conditions, query, parsing_context))
+
+    group_clause = ''
+    if groupby:
+        group_clause = 'GROUP BY ({})'.format(', '.join(column_expr(dataset, gb, query, parsing_context) for gb in groupby))
+        if query.has_totals():
+            group_clause = '{} WITH TOTALS'.format(group_clause)
+
+    having_clause = ''
+    having_conditions = query.get_having()
+    if having_conditions:
+        assert groupby, 'found HAVING clause with no GROUP BY'
+        having_clause = u'HAVING {}'.format(conditions_expr(dataset, having_conditions, query, parsing_context))
+
+    order_clause = ''
+    if query.get_orderby():
+        orderby = [column_expr(dataset, util.tuplify(ob), query, parsing_context) for ob in util.to_list(query.get_orderby())]
+        orderby = [u'{} {}'.format(ob.lstrip('-'), 'DESC' if ob.startswith('-') else 'ASC') for ob in orderby]
+        order_clause = u'ORDER BY {}'.format(', '.join(orderby))
+
+    limitby_clause = ''
+    if query.get_limitby() is not None:
+        limitby_clause = 'LIMIT {} BY {}'.format(*query.get_limitby())
+
+    limit_clause = ''
+    if query.get_limit() is not None:
+        limit_clause = 'LIMIT {}, {}'.format(query.get_offset(), query.get_limit())
+
+    return ' '.join([c for c in [
+        select_clause,
+        from_clause,
+        join_clause,
+        prewhere_clause,
+        where_clause,
+        group_clause,
+        having_clause,
+        order_clause,
+        limitby_clause,
+        limit_clause
+    ] if c])
+
+
 class ClickhouseQuery:
     """
     Generates and represents a Clickhouse query from a Request
@@ -22,82 +109,13 @@ class ClickhouseQuery:
         dataset: Dataset,
         query: Query,
         settings: RequestSettings,
-        prewhere_conditions: Sequence[str],
+        prewhere_conditions: Sequence[Condition],
+        template_cache: Optional[QueryTemplateCache] = None,
     ) -> None:
-        parsing_context = ParsingContext()
-
-        aggregate_exprs = [column_expr(dataset, col, query, parsing_context, alias, agg) for (agg, col, alias) in query.get_aggregations()]
-        groupby = util.to_list(query.get_groupby())
-        group_exprs = [column_expr(dataset, gb, query, parsing_context) for gb in groupby]
-        column_names = query.get_selected_columns() or []
-        selected_cols = [column_expr(dataset, util.tuplify(colname), query, parsing_context) for colname in column_names]
-        select_clause = u'SELECT {}'.format(', '.join(group_exprs + aggregate_exprs + selected_cols))
-
-        from_clause = u'FROM {}'.format(query.get_data_source().format_from())
-
-        if query.get_final():
-            from_clause = u'{} FINAL'.format(from_clause)
-
-        if query.get_sample():
-            sample_rate = query.get_sample()
-        elif settings.get_turbo():
-            sample_rate = snuba_settings.TURBO_SAMPLE_RATE
+        if template_cache is not None:
+            self.__formatted_query = template_cache.format_sql(dataset, query, settings, prewhere_conditions)
         else:
-            sample_rate = None
-
-        if sample_rate:
-            from_clause = u'{} SAMPLE {}'.format(from_clause, sample_rate)
-
-        join_clause = ''
-        if query.get_arrayjoin():
-            join_clause = u'ARRAY JOIN {}'.format(query.get_arrayjoin())
-
-        where_clause = ''
-        if query.get_conditions():
-            where_clause = u'WHERE {}'.format(conditions_expr(dataset, query.get_conditions(), query, parsing_context))
-
-        prewhere_clause = ''
-        if prewhere_conditions:
-            prewhere_clause = u'PREWHERE {}'.format(conditions_expr(dataset, prewhere_conditions, query, parsing_context))
-
-        group_clause = ''
-        if groupby:
-            group_clause = 'GROUP BY ({})'.format(', '.join(column_expr(dataset, gb, query, parsing_context) for gb in groupby))
-            if query.has_totals():
-                group_clause = '{} WITH TOTALS'.format(group_clause)
-
-        having_clause = ''
-        having_conditions = query.get_having()
-        if having_conditions:
-            assert groupby, 'found HAVING clause with no GROUP BY'
-            having_clause = u'HAVING {}'.format(conditions_expr(dataset, having_conditions, query, parsing_context))
-
-        order_clause = ''
-        if query.get_orderby():
-            orderby = [column_expr(dataset, util.tuplify(ob), query, parsing_context) for ob in util.to_list(query.get_orderby())]
-            orderby = [u'{} {}'.format(ob.lstrip('-'), 'DESC' if ob.startswith('-') else 'ASC') for ob in orderby]
-            order_clause = u'ORDER BY {}'.format(', '.join(orderby))
-
-        limitby_clause = ''
-        if query.get_limitby() is not None:
-            limitby_clause = 'LIMIT {} BY {}'.format(*query.get_limitby())
-
-        limit_clause = ''
-        if query.get_limit() is not None:
-            limit_clause = 'LIMIT {}, {}'.format(query.get_offset(), query.get_limit())
-
-        self.__formatted_query = ' '.join([c for c in [
-            select_clause,
-            from_clause,
-            join_clause,
-            prewhere_clause,
-            where_clause,
-            group_clause,
-            having_clause,
-            order_clause,
-            limitby_clause,
-            limit_clause
-        ] if c])
+            self.__formatted_query = format_query(dataset, query, settings, prewhere_conditions)
 
     def format_sql(self) -> str:
         """Produces a SQL string from the parameters."""
@@ -0,0 +1,237 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import (
+    Any,
+    Callable,
+    Hashable,
+    List,
+    MutableMapping,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+from snuba.datasets.dataset import Dataset
+from snuba.query.columns import LiteralPlaceholder, escape_condition_literal
+from snuba.query.query import Query
+from snuba.query.types import Condition
+from snuba.request.request_settings import RequestSettings
+from snuba.util import is_condition, tuplify
+from snuba.utils.metrics.backends.abstract import MetricsBackend
+
+
+QueryFormatter = Callable[[Dataset, Query, RequestSettings, Sequence[Condition]], str]
+
+# Literal slots are marked in the compiled SQL with NUL delimited indexes,
+# which cannot appear in a properly escaped statement.
+SLOT_RE = re.compile('\x00(\\d+)\x00')
+
+
+class UncacheableQuery(Exception):
+    """
+    Raised when the shape of a query cannot be expressed as a template.
+    """
+
+
+class QueryTemplate:
+    """
+    A compiled SQL statement split around its literal slots.
+    """
+
+    def __init__(self, sql: str) -> None:
+        parts = SLOT_RE.split(sql)
+        self.__fragments = parts[0::2]
+        self.__slots = [int(slot) for slot in parts[1::2]]
+
+    def fill(self, literals: Sequence[str]) -> str:
+        out = [self.__fragments[0]]
+        for slot, fragment in zip(self.__slots, self.__fragments[1:]):
+            out.append(literals[slot])
+            out.append(fragment)
+        return ''.join(out)
+
+
+class QueryShape(NamedTuple):
+    """
+    A query stripped of the literals of its WHERE and PREWHERE conditions.
+
+    Conditions comparing against the same escaped literal share a slot, so
+    the template deduplicates conditions exactly like the regular formatter.
+    """
+    fingerprint: Hashable
+    # The escaped literal for each slot of the template.
+    literals: Sequence[str]
+    conditions: Sequence[Condition]
+    prewhere_conditions: Sequence[Condition]
+
+
+def _extract_slots(
+    dataset: Dataset,
+    conditions: Sequence[Condition],
+    slots: MutableMapping[str, int],
+) -> Tuple[Sequence[Any], Sequence[Condition]]:
+    def slot_condition(condition: Condition) -> Tuple[Any, Condition]:
+        lhs, op, lit = condition
+        _, _, processed_lit = dataset.process_condition(condition)
+        literal = escape_condition_literal(op, processed_lit)
+        slot = slots.setdefault(literal, len(slots))
+        is_sequence = isinstance(processed_lit, (list, tuple))
+        return (
+            (tuplify(lhs), op, slot, is_sequence),
+            [lhs, op, LiteralPlaceholder(f'\x00{slot}\x00', is_sequence)],
+        )
+
+    shape = []
+    slotted = []
+    for condition in conditions or []:
+        if is_condition(condition):
+            condition_shape, slotted_condition = slot_condition(condition)
+            shape.append(condition_shape)
+            slotted.append(slotted_condition)
+        elif isinstance(condition, (list, tuple)) and all(is_condition(c) for c in condition):
+            nested = [slot_condition(c) for c in condition]
+            shape.append(tuple(s for s, _ in nested))
+            slotted.append([c for _, c in nested])
+        else:
+            raise UncacheableQuery(f'Unsupported condition {condition!r}')
+
+    return tuple(shape), slotted
+
+
+def get_query_shape(
+    dataset: Dataset,
+    query: Query,
+    settings: RequestSettings,
+    prewhere_conditions: Sequence[Condition],
+) -> QueryShape:
+    """
+    Builds the fingerprint of everything in the query that affects the
+    generated SQL, except for the condition literals which become slots.
+    """
+    slots: MutableMapping[str, int] = {}
+    conditions_shape, conditions = _extract_slots(dataset, query.get_conditions(), slots)
+    prewhere_shape, prewhere = _extract_slots(dataset, prewhere_conditions, slots)
+
+    fingerprint = (
+        dataset,
+        query.get_data_source().format_from(),
+        query.get_final(),
+        query.get_sample(),
+        settings.get_turbo(),
+        tuplify(query.get_selected_columns()),
+        tuplify(query.get_aggregations()),
+        tuplify(query.get_groupby()),
+        query.get_arrayjoin(),
+        tuplify(query.get_having()),
+        tuplify(query.get_orderby()),
+        tuplify(query.get_limitby()),
+        query.has_totals(),
+        query.get_granularity(),
+        query.get_limit(),
+        query.get_offset(),
+        conditions_shape,
+        prewhere_shape,
+    )
+
+    try:
+        hash(fingerprint)
+    except TypeError as error:
+        raise UncacheableQuery(str(error)) from error
+
+    literals: List[str] = [''] * len(slots)
+    for literal, slot in slots.items():
+        literals[slot] = literal
+
+    return QueryShape(fingerprint, literals, conditions, prewhere)
+
+
+class QueryTemplateCache:
+    """
+    LRU cache of compiled SQL templates keyed by query shape.
+
+    Most queries repeat the same few shapes and only differ in the values of
+    their conditions (project ids, time bounds), so column expansion and
+    condition formatting only need to run once per shape. Entries expire
+    after ``ttl`` seconds, since some of the SQL generation depends on
+    runtime configuration.
+
+    Every template is checked against the regular formatter when it is
+    compiled, shapes that don't round trip are remembered and always
+    formatted from scratch.
+    """
+
+    def __init__(
+        self,
+        formatter: QueryFormatter,
+        metrics: MetricsBackend,
+        max_size: int = 500,
+        ttl: int = 60,
+    ) -> None:
+        self.__formatter = formatter
+        self.__metrics = metrics
+        self.__max_size = max_size
+        self.__ttl = ttl
+        self.__lock = threading.Lock()
+        self.__templates: MutableMapping[Hashable, Tuple[float, Optional[QueryTemplate]]] = OrderedDict()
+
+    def __get(self, fingerprint: Hashable) -> Tuple[bool, Optional[QueryTemplate]]:
+        with self.__lock:
+            entry = self.__templates.get(fingerprint)
+            if entry is None:
+                return False, None
+
+            compiled_at, template = entry
+            if time.time() > compiled_at + self.__ttl:
+                del self.__templates[fingerprint]
+                return False, None
+
+            self.__templates.move_to_end(fingerprint)
+            return True, template
+
+    def __set(self, fingerprint: Hashable, template: Optional[QueryTemplate]) -> None:
+        with self.__lock:
+            self.__templates[fingerprint] = (time.time(), template)
+            self.__templates.move_to_end(fingerprint)
+            while len(self.__templates) > self.__max_size:
+                self.__templates.popitem(last=False)
+
+    def format_sql(
+        self,
+        dataset: Dataset,
+        query: Query,
+        settings: RequestSettings,
+        prewhere_conditions: Sequence[Condition],
+    ) -> str:
+        try:
+            shape = get_query_shape(dataset, query, settings, prewhere_conditions)
+        except UncacheableQuery:
+            self.__metrics.increment('query_template_cache.skip')
+            return self.__formatter(dataset, query, settings, prewhere_conditions)
+
+        found, template = self.__get(shape.fingerprint)
+        if found:
+            if template is None:
+                self.__metrics.increment('query_template_cache.skip')
+                return self.__formatter(dataset, query, settings, prewhere_conditions)
+
+            self.__metrics.increment('query_template_cache.hit')
+            return template.fill(shape.literals)
+
+        self.__metrics.increment('query_template_cache.miss')
+        sql = self.__formatter(dataset, query, settings, prewhere_conditions)
+
+        # Compile the template from a copy so the conditions of the query
+        # being run are left untouched.
+        template_query = query.copy()
+        template_query.set_conditions(shape.conditions)
+        template = QueryTemplate(
+            self.__formatter(dataset, template_query, settings, shape.prewhere_conditions)
+        )
+        if template.fill(shape.literals) != sql:
+            template = None
+
+        self.__set(shape.fingerprint, template)
+        return sql
@@ -146,6 +146,12 @@ class TimeSeriesDataset(Dataset):
         self.__time_group_columns = time_group_columns
         self.__time_parse_columns = time_parse_columns
 
+    def get_time_group_columns(self) -> Mapping[str, str]:
+        """
+        Returns the bucketed time columns mapped to the column they bucket.
+        """
+        return self.__time_group_columns
+
     def __time_expr(self, column_name: str, granularity: int, table_alias: str="") -> str:
         real_column = self.__time_group_columns[column_name]
         real_column = qualified_column(real_column, table_alias)
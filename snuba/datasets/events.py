@@ -2,6 +2,7 @@ from datetime import timedelta
 from typing import Mapping, Sequence, Tuple, Union
 
 from snuba.clickhouse.columns import (
+    AggregateFunction,
     Array,
     ColumnSet,
     DateTime,
@@ -16,12 +17,19 @@ from snuba.datasets.dataset import ColumnSplitSpec, TimeSeriesDataset
 from snuba.datasets.dataset_schemas import DatasetSchemas
 from snuba.datasets.table_storage import TableWriter, KafkaStreamLoader
 from snuba.datasets.events_processor import EventsProcessor
-from snuba.datasets.schemas.tables import MigrationSchemaColumn, ReplacingMergeTreeSchema
+from snuba.datasets.schemas.tables import (
+    AggregatingMergeTreeSchema,
+    MaterializedViewSchema,
+    MigrationSchemaColumn,
+    ReplacingMergeTreeSchema,
+)
 from snuba.datasets.tags_column_processor import TagColumnProcessor
 from snuba.query.query import Query
 from snuba.query.types import Condition
 from snuba.query.extensions import QueryExtension
 from snuba.query.parsing import ParsingContext
+from snuba.query.processors.rollup import RollupProcessor
+from snuba.query.query_processor import QueryProcessor
 from snuba.query.timeseries import TimeSeriesExtension
 from snuba.query.project_extension import ProjectExtension, ProjectWithGroupsProcessor
 from snuba.util import qualified_column
@@ -217,9 +225,57 @@ class EventsDataset(TimeSeriesDataset):
             sample_expr=sample_expr,
             migration_function=events_migrations)
 
+        rollup_columns = ColumnSet([
+            ('project_id', UInt(64)),
+            ('group_id', UInt(64)),
+            ('timestamp', DateTime()),
+            ('retention_days', UInt(16)),
+            ('times_seen', AggregateFunction('count')),
+            ('users', AggregateFunction('uniq', Nullable(String()))),
+        ])
+
+        # Hourly counts of events and users per group, used in place of
+        # the events table by the queries RollupProcessor can route to it.
+        # The view counts every row inserted, including events inserted
+        # more than once and the rows written by replacements, until the
+        # partition is rebuilt from the deduplicated events (see
+        # snuba.rollup).
+        rollup_schema = AggregatingMergeTreeSchema(
+            columns=rollup_columns,
+            local_table_name='sentry_rollup_hourly_local',
+            dist_table_name='sentry_rollup_hourly_dist',
+            order_by='(project_id, toStartOfDay(timestamp), group_id, timestamp)',
+            partition_by='(toMonday(timestamp), if(equals(retention_days, 30), 30, 90))',
+        )
+
+        rollup_query = """
+               SELECT
+                   project_id,
+                   group_id,
+                   toStartOfHour(timestamp) AS timestamp,
+                   retention_days,
+                   countState() AS times_seen,
+                   uniqState(`sentry:user`) AS users
+               FROM %(source_table_name)s
+               WHERE deleted = 0
+               GROUP BY project_id, group_id, timestamp, retention_days
+               """
+
+        rollup_materialized_view = MaterializedViewSchema(
+            local_materialized_view_name='sentry_mv_rollup_hourly_local',
+            dist_materialized_view_name='sentry_mv_rollup_hourly_dist',
+            columns=rollup_columns,
+            query=rollup_query,
+            local_source_table_name='sentry_local',
+            local_destination_table_name='sentry_rollup_hourly_local',
+            dist_source_table_name='sentry_dist',
+            dist_destination_table_name='sentry_rollup_hourly_dist',
+        )
+
         dataset_schemas = DatasetSchemas(
             read_schema=schema,
             write_schema=schema,
+            intermediary_schemas=[rollup_schema, rollup_materialized_view],
         )
 
         table_writer = TableWriter(
@@ -247,6 +303,7 @@ class EventsDataset(TimeSeriesDataset):
         self.__promoted_context_tag_columns = promoted_context_tag_columns
         self.__promoted_context_columns = promoted_context_columns
         self.__required_columns = required_columns
+        self.__rollup_schema = rollup_schema
 
         self.__tags_processor = TagColumnProcessor(
             columns=all_columns,
@@ -336,3 +393,21 @@ class EventsDataset(TimeSeriesDataset):
 
     def get_prewhere_keys(self) -> Sequence[str]:
         return ['event_id', 'issue', 'tags[sentry:release]', 'message', 'environment', 'project_id']
+
+    def get_query_processors(self) -> Sequence[QueryProcessor]:
+        return [
+            RollupProcessor(
+                rollup_source=self.__rollup_schema.get_data_source(),
+                timestamp_column='timestamp',
+                time_group_columns=['time'],
+                granularity=3600,
+                dimensions=['project_id', 'group_id', 'issue'],
+                aggregations={
+                    ('count()', ''): ('countMerge', 'times_seen'),
+                    ('count', ''): ('countMerge', 'times_seen'),
+                    ('uniq', 'tags[sentry:user]'): ('uniqMerge', 'users'),
+                },
+                start_config='events_rollup_start',
+                project_column='project_id',
+            ),
+        ]
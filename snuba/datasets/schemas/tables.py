@@ -148,6 +148,12 @@ class MergeTreeSchema(WritableTableSchema):
     def _get_engine_type(self) -> str:
         return "MergeTree()"
 
+    def get_sample_expr(self) -> Optional[str]:
+        return self.__sample_expr
+
+    def get_partition_by(self) -> Optional[str]:
+        return self.__partition_by
+
     def __get_local_engine(self) -> str:
         partition_by_clause = ("PARTITION BY %s" %
             self.__partition_by) if self.__partition_by else ''
@@ -226,6 +232,12 @@ class SummingMergeTreeSchema(MergeTreeSchema):
         return "SummingMergeTree()"
 
 
+class AggregatingMergeTreeSchema(MergeTreeSchema):
+
+    def _get_engine_type(self) -> str:
+        return "AggregatingMergeTree()"
+
+
 class MaterializedViewSchema(TableSchema):
 
     def __init__(
@@ -258,12 +270,19 @@ class MaterializedViewSchema(TableSchema):
         self.__dist_source_table_name = dist_source_table_name
         self.__dist_destination_table_name = dist_destination_table_name
 
-    def __get_local_source_table_name(self) -> str:
+    def get_local_source_table_name(self) -> str:
         return self._make_test_table(self.__local_source_table_name)
 
-    def __get_local_destination_table_name(self) -> str:
+    def get_local_destination_table_name(self) -> str:
         return self._make_test_table(self.__local_destination_table_name)
 
+    def get_query(self, source_table_name: str) -> str:
+        """
+        Returns the query of the view, reading from the given table or
+        subquery instead of the source table.
+        """
+        return self.__query % {'source_table_name': source_table_name}
+
     def __get_table_definition(self, name: str, source_table_name: str, destination_table_name: str) -> str:
         return """
         CREATE MATERIALIZED VIEW IF NOT EXISTS %(name)s TO %(destination_table_name)s (%(columns)s) AS %(query)s""" % {
@@ -278,6 +297,6 @@ class MaterializedViewSchema(TableSchema):
     def get_local_table_definition(self) -> str:
         return self.__get_table_definition(
             self.get_local_table_name(),
-            self.__get_local_source_table_name(),
-            self.__get_local_destination_table_name(),
+            self.get_local_source_table_name(),
+            self.get_local_destination_table_name(),
         )
@@ -1,6 +1,6 @@
 import re
 
-from typing import OrderedDict
+from typing import Any, OrderedDict
 import _strptime  # NOQA fixes _strptime deferred import issue
 
 from snuba.query.parsing import ParsingContext
@@ -23,6 +23,21 @@ class InvalidConditionException(Exception):
     pass
 
 
+class LiteralPlaceholder:
+    """
+    Stands in for the literal of a condition while compiling a query
+    template. The placeholder is written verbatim into the expression
+    instead of being escaped, so the real (already escaped) literal can be
+    filled in later.
+    """
+
+    def __init__(self, placeholder: str, is_sequence: bool) -> None:
+        self.placeholder = placeholder
+        # Whether the literal this stands for is a list/tuple. This changes
+        # the expression generated for conditions on array columns.
+        self.is_sequence = is_sequence
+
+
 def column_expr(dataset, column_name, query: Query, parsing_context: ParsingContext, alias=None, aggregate=None):
     """
     Certain special column names expand into more complex expressions. Return
@@ -80,6 +95,17 @@ def complex_column_expr(dataset, expr, query: Query, parsing_context: ParsingCon
     return ret
 
 
+def escape_condition_literal(op: str, lit: Any) -> str:
+    """
+    Escapes the (already processed) literal of a condition for use in the
+    WHERE/PREWHERE clause.
+    """
+    # facilitate deduping IN conditions by sorting them.
+    if op in ('IN', 'NOT IN') and isinstance(lit, tuple):
+        lit = tuple(sorted(lit))
+    return escape_literal(lit)
+
+
 def conditions_expr(dataset, conditions, query: Query, parsing_context: ParsingContext, depth=0):
     """
     Return a boolean expression suitable for putting in the WHERE clause of the
@@ -99,9 +125,12 @@ def conditions_expr(dataset, conditions, query: Query, parsing_context: ParsingC
     elif is_condition(conditions):
         lhs, op, lit = dataset.process_condition(conditions)
 
-        # facilitate deduping IN conditions by sorting them.
-        if op in ('IN', 'NOT IN') and isinstance(lit, tuple):
-            lit = tuple(sorted(lit))
+        if isinstance(lit, LiteralPlaceholder):
+            literal = lit.placeholder
+            is_sequence = lit.is_sequence
+        else:
+            literal = escape_condition_literal(op, lit)
+            is_sequence = isinstance(lit, (list, tuple))
 
         # If the LHS is a simple column name that refers to an array column
         # (and we are not arrayJoining on that column, which would make it
@@ -118,20 +147,20 @@ def conditions_expr(dataset, conditions, query: Query, parsing_context: ParsingC
             lhs in columns and
             isinstance(columns[lhs].type, Array) and
             columns[lhs].base_name != query.get_arrayjoin() and
-            not isinstance(lit, (list, tuple))
+            not is_sequence
         ):
             any_or_all = 'arrayExists' if op in POSITIVE_OPERATORS else 'arrayAll'
             return u'{}(x -> assumeNotNull(x {} {}), {})'.format(
                 any_or_all,
                 op,
-                escape_literal(lit),
+                literal,
                 column_expr(dataset, lhs, query, parsing_context)
             )
         else:
             return u'{} {} {}'.format(
                 column_expr(dataset, lhs, query, parsing_context),
                 op,
-                escape_literal(lit)
+                literal
             )
 
     elif depth == 1:
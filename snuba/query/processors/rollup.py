@@ -0,0 +1,198 @@
+import calendar
+from typing import Any, Mapping, Optional, Sequence, Set, Tuple
+
+from snuba import state, util
+from snuba.datasets.schemas.tables import TableSource
+from snuba.query.query import Aggregation, Query
+from snuba.query.query_processor import QueryProcessor
+from snuba.replacer import get_replaced_projects
+from snuba.rollup import get_rollup_rebuilt
+from snuba.request.request_settings import RequestSettings
+
+
+class RollupProcessor(QueryProcessor):
+    """
+    Routes aggregation queries to a rollup table, where rows are already
+    aggregated by time bucket, when the rollup holds everything the query
+    needs:
+
+    - the query only groups by, selects and filters on the dimensions of
+      the rollup;
+    - every aggregation can be computed by merging one of the aggregate
+      states stored in the rollup;
+    - the time range and the time buckets are aligned to the granularity
+      of the rollup, and the range starts after the rollup was populated
+      (the ``start_config`` runtime config, a unix timestamp, the rollup
+      is not used while it is unset);
+    - the query does not need FINAL or sampling, which the rollup does not
+      support;
+    - none of the projects of the query had replacements recently, or the
+      rollup was rebuilt since for the whole time range of the query. The
+      rollup is filled by a materialized view, which only sees inserts,
+      so merges, unmerges and deletions are only reflected in it once its
+      partitions are rebuilt (see ``snuba.rollup``).
+
+    Aggregations are rewritten to merge the aggregate states. The outcome
+    is reported in the ``rollup`` request stat: either ``routed`` or the
+    reason the query could not use the rollup.
+    """
+
+    def __init__(
+        self,
+        rollup_source: TableSource,
+        timestamp_column: str,
+        time_group_columns: Sequence[str],
+        granularity: int,
+        dimensions: Sequence[str],
+        aggregations: Mapping[Tuple[str, str], Tuple[str, str]],
+        start_config: str,
+        project_column: str,
+    ) -> None:
+        self.__rollup_source = rollup_source
+        self.__timestamp_column = timestamp_column
+        self.__time_group_columns = time_group_columns
+        self.__granularity = granularity
+        self.__dimensions = set(dimensions) | set(time_group_columns)
+        # Maps (function, column) of an aggregation to the (merge function,
+        # state column) computing it from the rollup.
+        self.__aggregations = aggregations
+        self.__start_config = start_config
+        self.__project_column = project_column
+
+    def process_query(self,
+        query: Query,
+        request_settings: RequestSettings,
+    ) -> None:
+        reason = self.get_skip_reason(query, request_settings)
+        request_settings.add_stat('rollup', reason or 'routed')
+        if reason is not None:
+            return
+
+        query.set_aggregations([
+            self.__rewrite_aggregation(aggregation)
+            for aggregation in query.get_aggregations()
+        ])
+        query.set_data_source(self.__rollup_source)
+
+    def get_skip_reason(self, query: Query, request_settings: RequestSettings) -> Optional[str]:
+        start = state.get_config(self.__start_config, None)
+        if not start:
+            return 'disabled'
+        if query.get_final():
+            return 'final'
+        if query.get_sample() or request_settings.get_turbo():
+            return 'sample'
+        if query.get_arrayjoin():
+            return 'arrayjoin'
+
+        aggregations = query.get_aggregations() or []
+        if not aggregations:
+            return 'no_aggregation'
+        if any(self.__get_aggregation_key(aggregation) not in self.__aggregations for aggregation in aggregations):
+            return 'aggregation'
+        aliases = {alias for _, _, alias in aggregations if alias}
+
+        columns: Set[str] = set()
+        for expr in util.to_list(query.get_selected_columns()) + util.to_list(query.get_groupby()):
+            columns.update(util.columns_in_expr(expr))
+        if not columns <= self.__dimensions:
+            return 'column'
+
+        if (
+            columns & set(self.__time_group_columns)
+            and (query.get_granularity() or 0) % self.__granularity != 0
+        ):
+            return 'granularity'
+
+        for expr in util.to_list(query.get_orderby()):
+            if not set(util.columns_in_expr(expr)) <= self.__dimensions | aliases:
+                return 'orderby'
+
+        limitby = query.get_limitby()
+        if limitby and limitby[1] not in self.__dimensions:
+            return 'limitby'
+
+        for cond in self.__flatten_conditions(query.get_having() or []):
+            if not set(util.columns_in_expr(cond[0])) <= self.__dimensions | aliases:
+                return 'having'
+
+        from_date = None
+        to_date = None
+        for cond in self.__flatten_conditions(query.get_conditions() or []):
+            column, operator, literal = cond
+            if column != self.__timestamp_column:
+                if not set(util.columns_in_expr(column)) <= self.__dimensions:
+                    return 'condition'
+                continue
+
+            timestamp = self.__parse_timestamp(literal)
+            if (
+                operator not in ('>=', '<')
+                or timestamp is None
+                or util.parse_datetime(timestamp.isoformat(), self.__granularity) != timestamp
+            ):
+                return 'time_range'
+            if operator == '>=':
+                from_date = max(from_date, timestamp) if from_date else timestamp
+            else:
+                to_date = min(to_date, timestamp) if to_date else timestamp
+
+        if from_date is None or calendar.timegm(from_date.timetuple()) < start:
+            return 'time_range'
+
+        project_ids = self.__get_project_ids(query.get_conditions() or [])
+        if not project_ids:
+            return 'project'
+        replaced = get_replaced_projects(project_ids)
+        if replaced:
+            rebuilt = get_rollup_rebuilt(self.__rollup_source.format_from())
+            if (
+                rebuilt is None
+                or max(replaced.values()) >= rebuilt[0]
+                or to_date is None
+                or calendar.timegm(to_date.timetuple()) > calendar.timegm(rebuilt[1].timetuple())
+            ):
+                return 'replaced'
+
+        return None
+
+    def __get_project_ids(self, conditions: Sequence[Any]) -> Set[int]:
+        # Only top level conditions restrict the projects of the query,
+        # every project they mention is checked.
+        project_ids: Set[int] = set()
+        for cond in conditions:
+            if util.is_condition(cond) and cond[0] == self.__project_column and cond[1] in ('=', 'IN'):
+                project_ids.update(util.to_list(cond[2]))
+        return project_ids
+
+    def __rewrite_aggregation(self, aggregation: Aggregation) -> Aggregation:
+        function, column, alias = aggregation
+        merge_function, state_column = self.__aggregations[self.__get_aggregation_key(aggregation)]
+        # Keep the name the column would have had without the rollup.
+        return [merge_function, state_column, alias or column]
+
+    def __get_aggregation_key(self, aggregation: Aggregation) -> Tuple[str, Any]:
+        function, column, _ = aggregation
+        if not column:
+            column = ''
+        elif not isinstance(column, str):
+            column = util.tuplify(column)
+        return (function, column)
+
+    def __flatten_conditions(self, conditions: Sequence[Any]) -> Sequence[Any]:
+        # Conditions are ANDed lists of conditions or ORed groups of them.
+        return [
+            cond
+            for group in conditions
+            for cond in ([group] if util.is_condition(group) else group)
+        ]
+
+    def __parse_timestamp(self, literal: Any) -> Optional[Any]:
+        if hasattr(literal, 'isoformat'):
+            return literal
+        if isinstance(literal, str):
+            try:
+                return util.parse_datetime(literal)
+            except ValueError:
+                return None
+        return None
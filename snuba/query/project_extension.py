@@ -6,7 +6,7 @@ from snuba.query.query import Query
 from snuba.query.query_processor import ExtensionData
 from snuba.replacer import get_projects_query_flags
 from snuba.request.request_settings import RequestSettings
-from snuba.state import get_config, get_configs
+from snuba.state import get_all_configs, get_config
 from snuba.state.rate_limit import RateLimitParameters, PROJECT_RATE_LIMIT_NAME
 
 
@@ -40,26 +40,28 @@ class ProjectExtensionProcessor(ExtensionQueryProcessor):
     def __init__(self, project_column: str) -> None:
         self.__project_column = project_column
 
-    def _get_rate_limit_params(self, project_ids: Sequence[int]) -> RateLimitParameters:
-        project_id = project_ids[0] if project_ids else 0  # TODO rate limit on every project in the list?
+    def _get_rate_limit_params(self, project_ids: Sequence[int]) -> Sequence[RateLimitParameters]:
+        all_confs = get_all_configs()
+        prl = all_confs.get('project_per_second_limit', 1000)
+        pcl = all_confs.get('project_concurrent_limit', 1000)
 
-        prl, pcl = get_configs([
-            ('project_per_second_limit', 1000),
-            ('project_concurrent_limit', 1000),
-        ])
+        # Every project of the query is limited in the same call to redis,
+        # the first one is rate limited unless enabled for all of them.
+        if not project_ids:
+            project_ids = [0]
+        elif not all_confs.get('rate_limit_all_projects', 0):
+            project_ids = project_ids[:1]
 
         # Specific projects can have their rate limits overridden
-        (per_second, concurr) = get_configs([
-            ('project_per_second_limit_{}'.format(project_id), prl),
-            ('project_concurrent_limit_{}'.format(project_id), pcl),
-        ])
-
-        return RateLimitParameters(
-            rate_limit_name=PROJECT_RATE_LIMIT_NAME,
-            bucket=str(project_id),
-            per_second_limit=per_second,
-            concurrent_limit=concurr,
-        )
+        return [
+            RateLimitParameters(
+                rate_limit_name=PROJECT_RATE_LIMIT_NAME,
+                bucket=str(project_id),
+                per_second_limit=all_confs.get('project_per_second_limit_{}'.format(project_id), prl),
+                concurrent_limit=all_confs.get('project_concurrent_limit_{}'.format(project_id), pcl),
+            )
+            for project_id in project_ids
+        ]
 
     def do_post_processing(
             self,
@@ -80,7 +82,8 @@ class ProjectExtensionProcessor(ExtensionQueryProcessor):
         if project_ids:
             query.add_conditions([(self.__project_column, 'IN', project_ids)])
 
-        request_settings.add_rate_limit(self._get_rate_limit_params(project_ids))
+        for rate_limit_params in self._get_rate_limit_params(project_ids):
+            request_settings.add_rate_limit(rate_limit_params)
 
         self.do_post_processing(project_ids, query, request_settings)
 
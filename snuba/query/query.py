@@ -47,6 +47,12 @@ class Query:
     an abstract Snuba query and a concrete Clickhouse query, but
     that cannot come in this PR since it also requires a proper
     schema split in the dataset to happen.
+
+    The values of the body are never modified in place: every change
+    replaces the value of a field. This lets copies share the values
+    they do not change, so copying a query does not depend on the size
+    of its conditions. The values returned by the getters must not be
+    modified either.
     """
     # TODO: Make getters non nullable when possible. This is a risky
     # change so we should take one field at a time.
@@ -61,6 +67,15 @@ class Query:
         self.__final = False
         self.__data_source = data_source
 
+    def copy(self) -> Query:
+        """
+        Returns a copy of the query, sharing the values of the body with
+        this query until either of them replaces them.
+        """
+        query = Query(dict(self.__body), self.__data_source)
+        query.set_final(self.__final)
+        return query
+
     def get_data_source(self) -> RelationalSource:
         return self.__data_source
 
@@ -71,9 +86,9 @@ class Query:
         field: str,
         content: Sequence[TElement],
     ) -> None:
-        if field not in self.__body:
-            self.__body[field] = []
-        self.__body[field].extend(content)
+        # Copies can share the sequence, so it is replaced rather than
+        # extended in place.
+        self.__body[field] = [*self.__body.get(field, []), *content]
 
     def get_selected_columns(self) -> Optional[Sequence[Any]]:
         return self.__body.get("selected_columns")
@@ -150,6 +165,9 @@ class Query:
     def get_sample(self) -> Optional[float]:
         return self.__body.get("sample")
 
+    def set_sample(self, sample: float) -> None:
+        self.__body["sample"] = sample
+
     def get_limit(self) -> Optional[int]:
         return self.__body.get('limit', None)
 
@@ -162,6 +180,9 @@ class Query:
     def set_offset(self, offset: int) -> None:
         self.__body["offset"] = offset
 
+    def get_cursor(self) -> Optional[str]:
+        return self.__body.get("cursor")
+
     def has_totals(self) -> bool:
         return self.__body.get("totals", False)
 
@@ -1,6 +1,10 @@
 CONDITION_OPERATORS = ['>', '<', '>=', '<=', '=', '!=', 'IN', 'NOT IN', 'IS NULL', 'IS NOT NULL', 'LIKE', 'NOT LIKE']
 POSITIVE_OPERATORS = ['>', '<', '>=', '<=', '=', 'IN', 'IS NULL', 'LIKE']
 
+RESULT_FORMATS = ['json', 'json_stream', 'columnar', 'msgpack']
+# Formats returning one array per column instead of one object per row.
+COLUMNAR_FORMATS = ['columnar', 'msgpack']
+
 GENERIC_QUERY_SCHEMA = {
     'type': 'object',
     'properties': {
@@ -104,6 +108,11 @@ GENERIC_QUERY_SCHEMA = {
             'type': 'integer',
             'minimum': 0,
         },
+        # Opaque position returned with the previous page of results, only
+        # valid for queries ordered by time and id.
+        'cursor': {
+            'type': 'string',
+        },
         'limitby': {
             'type': 'array',
             'items': [
@@ -197,6 +206,18 @@ SETTINGS_SCHEMA = {
             'type': 'boolean',
             'default': False,
         },
+        # Layout and encoding of the response body.
+        'format': {
+            'type': 'string',
+            'enum': RESULT_FORMATS,
+            'default': 'json',
+        },
+        # Seconds the client waits for the result. Queries are cancelled
+        # once that deadline passes.
+        'timeout': {
+            'type': 'number',
+            'minimum': 0,
+        },
     },
     'additionalProperties': False,
 }
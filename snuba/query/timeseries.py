@@ -15,6 +15,9 @@ class TimeSeriesExtensionProcessor(ExtensionQueryProcessor):
     def __init__(self, timstamp_column: str):
         self.__timestamp_column = timstamp_column
 
+    def get_timestamp_column(self) -> str:
+        return self.__timestamp_column
+
     @classmethod
     def get_time_limit(cls, timeseries_extension: Mapping[str, Any]) -> Tuple[datetime, datetime]:
         max_days, date_align = state.get_configs([
@@ -3,16 +3,22 @@ from __future__ import annotations
 import itertools
 import re
 from abc import ABC, abstractmethod
-from datetime import datetime
+from datetime import date, datetime
+from functools import lru_cache
 from typing import (
     TYPE_CHECKING,
     Any,
+    Callable,
     Generic,
+    Iterator,
     Mapping,
     MutableMapping,
+    MutableSequence,
     Optional,
     Sequence,
+    Tuple,
     TypeVar,
+    Union,
 )
 
 from dateutil.tz import tz
@@ -23,9 +29,11 @@ if TYPE_CHECKING:
 
     Column = TypedDict("Column", {"name": str, "type": str})
     Row = MutableMapping[str, Any]
+    # Columnar results map every column name to the list of its values.
+    Columns = MutableMapping[str, MutableSequence[Any]]
     Result = TypedDict(
         "Result",
-        {"meta": Sequence[Column], "data": Sequence[Row], "totals": Row},
+        {"meta": Sequence[Column], "data": Union[Sequence[Row], Columns], "totals": Row},
         total=False,
     )
 else:
@@ -42,8 +50,29 @@ class Reader(ABC, Generic[TQuery]):
         settings: Optional[Mapping[str, str]] = None,
         query_id: Optional[str] = None,
         with_totals: bool = False,
+        columnar: bool = False,
     ) -> Result:
-        """Execute a query."""
+        """
+        Execute a query. Columnar results hold one list of values per
+        column in ``data`` instead of one mapping per row.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def execute_iter(
+        self,
+        query: TQuery,
+        settings: Optional[Mapping[str, str]] = None,
+        query_id: Optional[str] = None,
+        with_totals: bool = False,
+        block_size: int = 10000,
+    ) -> Iterator[Result]:
+        """
+        Execute a query and yield its result in blocks of at most
+        ``block_size`` rows as they are received. At least one block is
+        yielded, every block holds the ``meta`` of the result and the last
+        one holds the ``totals`` if they were requested.
+        """
         raise NotImplementedError
 
 
@@ -53,6 +82,59 @@ DATETIME_TYPE_RE = re.compile(r"(Nullable\()?DateTime\b")
 UUID_TYPE_RE = re.compile(r"(Nullable\()?UUID\b")
 
 
+def _convert_datetime(value: datetime) -> str:
+    # ClickHouse returns timezone-naive values in UTC, appending the offset
+    # is much cheaper than attaching a tzinfo before formatting.
+    if value.tzinfo is None:
+        return value.isoformat() + "+00:00"
+    return value.replace(tzinfo=tz.tzutc()).isoformat()
+
+
+def _convert_date(value: date) -> str:
+    return value.isoformat() + "T00:00:00+00:00"
+
+
+def _convert_uuid(value: Any) -> str:
+    return str(value)
+
+
+def get_converter(column_type: str) -> Optional[Callable[[Any], Any]]:
+    """
+    Returns the function formatting the values of a column of the given
+    ClickHouse type, or None if they are returned unchanged.
+    """
+    if DATETIME_TYPE_RE.match(column_type):
+        return _convert_datetime
+    elif DATE_TYPE_RE.match(column_type):
+        return _convert_date
+    elif UUID_TYPE_RE.match(column_type):
+        return _convert_uuid
+    else:
+        return None
+
+
+ConversionPlan = Sequence[Tuple[str, Callable[[Any], Any]]]
+
+
+@lru_cache(maxsize=1000)
+def _compile_conversion_plan(signature: Tuple[Tuple[str, str], ...]) -> ConversionPlan:
+    plan = []
+    for name, column_type in signature:
+        converter = get_converter(column_type)
+        if converter is not None:
+            plan.append((name, converter))
+    return tuple(plan)
+
+
+def get_conversion_plan(meta: Sequence[Column]) -> ConversionPlan:
+    """
+    Returns the converter of every column of a result that needs one. Plans
+    are cached by the names and types of the columns, since the same few
+    shapes of results are returned over and over.
+    """
+    return _compile_conversion_plan(tuple((col["name"], col["type"]) for col in meta))
+
+
 def transform_columns(result: Result) -> Result:
     """
     Converts Clickhouse results into formatted strings. Specifically:
@@ -60,28 +142,37 @@ def transform_columns(result: Result) -> Result:
        into ISO 8601 formatted strings (including the UTC offset.)
     - UUID objects into strings
     """
+    plan = get_conversion_plan(result["meta"])
+    if not plan:
+        return result
+
+    if "totals" in result:
+        rows = itertools.chain(result["data"], [result["totals"]])
+    else:
+        rows = iter(result["data"])
 
-    def iterate_rows():
+    for row in rows:
+        for name, converter in plan:
+            row[name] = converter(row[name])
+
+    return result
+
+
+def transform_columnar_columns(result: Result) -> Result:
+    """
+    Same as ``transform_columns`` for columnar results.
+    """
+    for name, converter in get_conversion_plan(result["meta"]):
+        result["data"][name] = [converter(value) for value in result["data"][name]]
         if "totals" in result:
-            return itertools.chain(result["data"], [result["totals"]])
-        else:
-            return iter(result["data"])
-
-    for col in result["meta"]:
-        if DATETIME_TYPE_RE.match(col["type"]):
-            for row in iterate_rows():
-                row[col["name"]] = (
-                    row[col["name"]].replace(tzinfo=tz.tzutc()).isoformat()
-                )
-        elif DATE_TYPE_RE.match(col["type"]):
-            for row in iterate_rows():
-                row[col["name"]] = (
-                    datetime(*(row[col["name"]].timetuple()[:6]))
-                    .replace(tzinfo=tz.tzutc())
-                    .isoformat()
-                )
-        elif UUID_TYPE_RE.match(col["type"]):
-            for row in iterate_rows():
-                row[col["name"]] = str(row[col["name"]])
+            result["totals"][name] = converter(result["totals"][name])
 
     return result
+
+
+def get_row_count(result: Result) -> int:
+    data = result["data"]
+    if isinstance(data, Mapping):
+        return len(next(iter(data.values()), []))
+    else:
+        return len(data)
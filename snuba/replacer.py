@@ -3,7 +3,7 @@ import time
 from collections import deque
 from dataclasses import dataclass
 from datetime import datetime
-from typing import Any, Mapping, Optional, Sequence
+from typing import Any, Iterable, Mapping, Optional, Sequence
 
 import simplejson as json
 
@@ -58,6 +58,37 @@ def set_project_needs_final(project_id):
     )
 
 
+def get_project_replaced_key(project_id):
+    return "project_replaced:%s" % project_id
+
+
+def set_project_replaced(project_id):
+    """Record the time of the last replacement of a project. Tables populated
+    by materialized views, like the events rollup, keep the rows replacements
+    change until they are rebuilt, and results cached per time bucket were
+    computed from the rows before the replacement. The key expires after
+    `settings.REPLACER_REPLACED_KEY_TTL`, by when the rebuilds are expected
+    to have caught up."""
+    return redis_client.set(
+        get_project_replaced_key(project_id), repr(time.time()), ex=settings.REPLACER_REPLACED_KEY_TTL
+    )
+
+
+def get_replaced_projects(project_ids: Iterable[int]) -> Mapping[int, float]:
+    """Returns the time of the last replacement of the projects that had one
+    recently."""
+    project_ids = sorted(set(project_ids))
+    if not project_ids:
+        return {}
+
+    values = redis_client.mget([get_project_replaced_key(project_id) for project_id in project_ids])
+    return {
+        project_id: float(value)
+        for project_id, value in zip(project_ids, values)
+        if value is not None
+    }
+
+
 def get_projects_query_flags(project_ids):
     """\
     1. Fetch `needs_final` for each Project
@@ -144,6 +175,7 @@ class ReplacerWorker(AbstractBatchWorker[KafkaMessage, Replacement]):
 
             # query_time_flags == (type, project_id, [...data...])
             flag_type, project_id = replacement.query_time_flags[:2]
+            set_project_replaced(project_id)
             if flag_type == NEEDS_FINAL:
                 set_project_needs_final(project_id)
             elif flag_type == EXCLUDE_GROUPS:
@@ -154,6 +186,9 @@ class ReplacerWorker(AbstractBatchWorker[KafkaMessage, Replacement]):
             query = replacement.insert_query_template % query_args
             logger.debug("Executing replace query: %s" % query)
             self.clickhouse.execute_robust(query)
+            # Once more after the replacement is applied, so results computed
+            # from the rows it replaced are not reused.
+            set_project_replaced(project_id)
             duration = int((time.time() - t) * 1000)
             logger.info("Replacing %s rows took %sms" % (count, duration))
             self.metrics.timing('replacements.count', count)
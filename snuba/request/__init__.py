@@ -15,6 +15,18 @@ class Request:
     settings: RequestSettings  # settings provided by the request
     extensions: Mapping[str, Mapping[str, Any]]
 
+    def copy(self) -> Request:
+        """
+        Returns a copy of the request that can be changed and processed
+        without affecting this request. The values of the query body and
+        of the extensions are shared, see `Query.copy`.
+        """
+        return Request(
+            self.query.copy(),
+            self.settings.copy(),
+            {name: dict(extension) for name, extension in self.extensions.items()},
+        )
+
     @property
     @deprecated(
         details="Do not access the internal query representation "
@@ -1,4 +1,6 @@
-from typing import Sequence
+import copy
+import time
+from typing import Any, Callable, Mapping, MutableMapping, Optional, Sequence
 
 from snuba.state.rate_limit import get_global_rate_limit_params, RateLimitParameters
 
@@ -14,11 +16,34 @@ class RequestSettings:
     the formation of the query for projects, but it doesn't appear in the SQL statement.
     """
 
-    def __init__(self, turbo: bool, consistent: bool, debug: bool) -> None:
+    def __init__(
+        self,
+        turbo: bool,
+        consistent: bool,
+        debug: bool,
+        format: str = 'json',
+        timeout: Optional[float] = None,
+    ) -> None:
         self.__turbo = turbo
         self.__consistent = consistent
         self.__debug = debug
+        self.__format = format
+        self.__deadline = time.time() + timeout if timeout is not None else None
+        self.__disconnect_check: Optional[Callable[[], bool]] = None
         self.__rate_limit_params = [get_global_rate_limit_params()]
+        self.__query_settings: MutableMapping[str, Any] = {}
+        self.__stats: MutableMapping[str, Any] = {}
+
+    def copy(self) -> 'RequestSettings':
+        """
+        Returns a copy of the settings, with their own rate limits, query
+        settings and stats.
+        """
+        settings = copy.copy(self)
+        settings.__rate_limit_params = list(self.__rate_limit_params)
+        settings.__query_settings = dict(self.__query_settings)
+        settings.__stats = dict(self.__stats)
+        return settings
 
     def get_turbo(self) -> bool:
         return self.__turbo
@@ -29,8 +54,48 @@ class RequestSettings:
     def get_debug(self) -> bool:
         return self.__debug
 
+    def get_format(self) -> str:
+        return self.__format
+
+    def get_deadline(self) -> Optional[float]:
+        """
+        The time after which the client does not wait for the result
+        anymore, if it set a timeout.
+        """
+        return self.__deadline
+
+    def get_disconnect_check(self) -> Optional[Callable[[], bool]]:
+        """
+        Returns whether the client that sent the request disconnected, when
+        the server can tell.
+        """
+        return self.__disconnect_check
+
+    def set_disconnect_check(self, disconnect_check: Callable[[], bool]) -> None:
+        self.__disconnect_check = disconnect_check
+
     def get_rate_limit_params(self) -> Sequence[RateLimitParameters]:
         return self.__rate_limit_params
 
     def add_rate_limit(self, rate_limit_param: RateLimitParameters) -> None:
         self.__rate_limit_params.append(rate_limit_param)
+
+    def get_query_settings(self) -> Mapping[str, Any]:
+        """
+        ClickHouse settings to run the query with, on top of the ones from
+        the runtime config.
+        """
+        return self.__query_settings
+
+    def set_query_setting(self, name: str, value: Any) -> None:
+        self.__query_settings[name] = value
+
+    def get_stats(self) -> Mapping[str, Any]:
+        """
+        Stats recorded while the query was processed, reported with the
+        stats of the query.
+        """
+        return self.__stats
+
+    def add_stat(self, name: str, value: Any) -> None:
+        self.__stats[name] = value
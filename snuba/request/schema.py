@@ -10,7 +10,7 @@ from snuba.query.query import Query
 from snuba.query.schema import GENERIC_QUERY_SCHEMA, SETTINGS_SCHEMA
 from snuba.request import Request
 from snuba.request.request_settings import RequestSettings
-from snuba.schemas import Schema, validate_jsonschema
+from snuba.schemas import CompiledSchema, Schema
 
 
 class RequestSchema:
@@ -41,6 +41,7 @@ class RequestSchema:
                 self.__composite_schema['definitions'][definition_name] = definition_schema
 
         self.__composite_schema['required'] = set(self.__composite_schema['required'])
+        self.__compiled_schema = CompiledSchema(self.__composite_schema)
 
     @classmethod
     def build_with_extensions(cls, extensions: Mapping[str, QueryExtension]) -> RequestSchema:
@@ -54,7 +55,7 @@ class RequestSchema:
         return cls(generic_schema, settings_schema, extensions_schemas)
 
     def validate(self, value, data_source: RelationalSource) -> Request:
-        value = validate_jsonschema(value, self.__composite_schema)
+        value = self.__compiled_schema.validate(value)
 
         query_body = {key: value.pop(key) for key in self.__query_schema['properties'].keys() if key in value}
         settings = {key: value.pop(key) for key in self.__settings_schema['properties'].keys() if key in value}
@@ -65,7 +66,13 @@ class RequestSchema:
 
         return Request(
             Query(query_body, data_source),
-            RequestSettings(settings['turbo'], settings['consistent'], settings['debug']),
+            RequestSettings(
+                settings['turbo'],
+                settings['consistent'],
+                settings['debug'],
+                settings['format'],
+                settings.get('timeout'),
+            ),
             extensions
         )
 
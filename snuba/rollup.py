@@ -0,0 +1,137 @@
+from datetime import datetime, timedelta
+import logging
+from typing import Optional, Sequence, Tuple
+
+import simplejson as json
+
+from snuba import util
+from snuba.cleanup import get_active_partitions
+from snuba.datasets.dataset import Dataset
+from snuba.datasets.factory import enforce_table_writer
+from snuba.datasets.schemas.tables import MaterializedViewSchema, MergeTreeSchema
+from snuba.redis import redis_client
+
+
+logger = logging.getLogger('snuba.rollup')
+
+
+def get_rollup_rebuilt_key(table: str) -> str:
+    return "rollup_rebuilt:%s" % table
+
+
+def set_rollup_rebuilt(table: str, started: float, until: datetime) -> None:
+    redis_client.set(
+        get_rollup_rebuilt_key(table),
+        json.dumps([started, until.isoformat()]),
+    )
+
+
+def get_rollup_rebuilt(table: str) -> Optional[Tuple[float, datetime]]:
+    """Returns when the last rebuild of a rollup started, and the end of the
+    time range it rebuilt: rows of the rollup before that end reflect every
+    replacement that happened before the rebuild started."""
+    value = redis_client.get(get_rollup_rebuilt_key(table))
+    if value is None:
+        return None
+
+    started, until = json.loads(value)
+    return started, util.parse_datetime(until)
+
+
+def get_rollups(dataset: Dataset) -> Sequence[Tuple[MaterializedViewSchema, MergeTreeSchema]]:
+    """Returns the materialized views populating tables from the table the
+    dataset writes to, with the same partitioning, and the tables they
+    populate."""
+    write_schema = enforce_table_writer(dataset).get_schema()
+    if not isinstance(write_schema, MergeTreeSchema):
+        return []
+
+    schemas = dataset.get_dataset_schemas().get_intermediary_schemas()
+    tables = {
+        schema.get_local_table_name(): schema
+        for schema in schemas
+        if isinstance(schema, MergeTreeSchema) and schema.get_partition_by() == write_schema.get_partition_by()
+    }
+    return [
+        (schema, tables[schema.get_local_destination_table_name()])
+        for schema in schemas
+        if isinstance(schema, MaterializedViewSchema)
+        and schema.get_local_source_table_name() == write_schema.get_local_table_name()
+        and schema.get_local_destination_table_name() in tables
+    ]
+
+
+def get_partition_end(part_date: datetime) -> datetime:
+    # Partitions start on Mondays.
+    return part_date + timedelta(days=7)
+
+
+def filter_closed_partitions(parts, as_of=None, margin=timedelta(days=1)):
+    """Filter partitions of (datetime, retention_days) down to the ones that
+    ended more than `margin` before `as_of` (default: now), which are not
+    expected to receive events anymore."""
+
+    if as_of is None:
+        as_of = datetime.utcnow()
+
+    return [
+        (part_date, retention_days)
+        for part_date, retention_days in parts
+        if get_partition_end(part_date) + margin <= as_of
+    ]
+
+
+def rebuild_partitions(clickhouse, database, view: MaterializedViewSchema, table: MergeTreeSchema,
+                       parts, dry_run=True):
+    """Recomputes partitions of the table populated by the view from the
+    deduplicated rows of its source table, and swaps them in one at a time.
+    Rows the view inserts in a partition while it is being recomputed are
+    lost, hence only partitions that are closed are rebuilt."""
+
+    args = {
+        'database': database,
+        'source': view.get_local_source_table_name(),
+        'table': table.get_local_table_name(),
+        'rebuild': table.get_local_table_name() + '_rebuild',
+        'partition_by': table.get_partition_by(),
+    }
+
+    for part_date, retention_days in parts:
+        partition = "('%s', %s)" % (part_date.strftime("%Y-%m-%d"), retention_days)
+        source = """(
+            SELECT *
+            FROM %(database)s.%(source)s FINAL
+            WHERE %(partition_by)s = (toDate('%(date_str)s'), %(retention_days)s)
+        )""" % {
+            **args,
+            'date_str': part_date.strftime("%Y-%m-%d"),
+            'retention_days': retention_days,
+        }
+        queries = [
+            "DROP TABLE IF EXISTS %(database)s.%(rebuild)s" % args,
+            "CREATE TABLE %(database)s.%(rebuild)s AS %(database)s.%(table)s" % args,
+            "INSERT INTO %(database)s.%(rebuild)s %(query)s" % {**args, 'query': view.get_query(source)},
+            "ALTER TABLE %(database)s.%(table)s REPLACE PARTITION %(partition)s FROM %(database)s.%(rebuild)s" % {
+                **args,
+                'partition': partition,
+            },
+            "DROP TABLE %(database)s.%(rebuild)s" % args,
+        ]
+        for query in queries:
+            if dry_run:
+                logger.info("Dry run: " + query)
+            else:
+                logger.info("Rebuilding partition: " + query)
+                clickhouse.execute(query)
+
+
+def run_rebuild(clickhouse, database, view: MaterializedViewSchema, table: MergeTreeSchema,
+                dry_run=True, as_of=None, margin=timedelta(days=1)) -> Optional[datetime]:
+    """Rebuilds every closed partition of a rollup. Returns the end of the
+    last partition rebuilt, if any was."""
+    active_parts = get_active_partitions(clickhouse, database, view.get_local_source_table_name())
+    closed_parts = filter_closed_partitions(active_parts, as_of=as_of, margin=margin)
+    rebuild_partitions(clickhouse, database, view, table, closed_parts, dry_run=dry_run)
+    if not closed_parts:
+        return None
+    return get_partition_end(max(part_date for part_date, _ in closed_parts))
@@ -4,6 +4,8 @@ from typing import Any, Mapping
 
 import jsonschema
 
+from snuba.utils.schema_compiler import UnsupportedSchema, compile_schema
+
 
 def get_time_series_extension_properties(default_granularity: int, default_window: timedelta):
     return {
@@ -55,40 +57,89 @@ SDK_STATS_EXTENSIONS_SCHEMA = {
 }
 
 
+def _validate_and_default(validator, properties, instance, schema):
+    for property, subschema in properties.items():
+        if 'default' in subschema:
+            if callable(subschema['default']):
+                instance.setdefault(property, subschema['default']())
+            else:
+                instance.setdefault(property, copy.deepcopy(subschema['default']))
+
+    for error in jsonschema.Draft6Validator.VALIDATORS['properties'](validator, properties, instance, schema):
+        yield error
+
+
+DefaultingValidator = jsonschema.validators.extend(
+    jsonschema.Draft4Validator,
+    {'properties': _validate_and_default}
+)
+
+
+def _get_validator(schema, set_defaults):
+    validator_cls = DefaultingValidator if set_defaults else jsonschema.Draft6Validator
+    return validator_cls(
+        schema,
+        types={'array': (list, tuple)},
+        format_checker=jsonschema.FormatChecker()
+    )
+
+
+def _copy_value(value):
+    """
+    A faster deepcopy for the values decoded from JSON.
+    """
+    if type(value) is dict:
+        return {key: _copy_value(item) for key, item in value.items()}
+    elif type(value) is list:
+        return [_copy_value(item) for item in value]
+    elif type(value) in (str, int, float, bool, type(None)):
+        return value
+    return copy.deepcopy(value)
+
+
 def validate_jsonschema(value, schema, set_defaults=True):
     """
     Validates a value against the provided schema, returning the validated
     value if the value conforms to the schema, otherwise raising a
     ``jsonschema.ValidationError``.
     """
-    orig = jsonschema.Draft6Validator.VALIDATORS['properties']
-
-    def validate_and_default(validator, properties, instance, schema):
-        for property, subschema in properties.items():
-            if 'default' in subschema:
-                if callable(subschema['default']):
-                    instance.setdefault(property, subschema['default']())
-                else:
-                    instance.setdefault(property, copy.deepcopy(subschema['default']))
-
-        for error in orig(validator, properties, instance, schema):
-            yield error
-
     # Using schema defaults during validation will cause the input value to be
     # mutated, so to be on the safe side we create a deep copy of that value to
     # avoid unwanted side effects for the calling function.
     if set_defaults:
-        value = copy.deepcopy(value)
+        value = _copy_value(value)
 
-    validator_cls = jsonschema.validators.extend(
-        jsonschema.Draft4Validator,
-        {'properties': validate_and_default}
-    ) if set_defaults else jsonschema.Draft6Validator
-
-    validator_cls(
-        schema,
-        types={'array': (list, tuple)},
-        format_checker=jsonschema.FormatChecker()
-    ).validate(value, schema)
+    _get_validator(schema, set_defaults).validate(value, schema)
 
     return value
+
+
+class CompiledSchema:
+    """
+    Validates values like ``validate_jsonschema``, with the checks of the
+    schema compiled once into Python functions instead of being
+    interpreted by jsonschema for every value.
+
+    Values the compiled checks do not accept are validated again by
+    jsonschema, so invalid values raise exactly the same errors. Schemas
+    that cannot be compiled are always validated by jsonschema.
+    """
+
+    def __init__(self, schema, set_defaults=True):
+        self.__schema = schema
+        self.__set_defaults = set_defaults
+        try:
+            self.__is_valid = compile_schema(schema, set_defaults)
+        except UnsupportedSchema:
+            self.__is_valid = None
+
+    def is_compiled(self) -> bool:
+        return self.__is_valid is not None
+
+    def validate(self, value):
+        if self.__is_valid is not None:
+            copied = _copy_value(value) if self.__set_defaults else value
+            if self.__is_valid(copied):
+                return copied
+
+        return validate_jsonschema(value, self.__schema, self.__set_defaults)
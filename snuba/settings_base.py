@@ -17,7 +17,17 @@ DATASET_MODE = 'local'
 CLICKHOUSE_HOST = os.environ.get('CLICKHOUSE_HOST', default_clickhouse_host)
 CLICKHOUSE_PORT = int(os.environ.get('CLICKHOUSE_PORT', default_clickhouse_port))
 CLICKHOUSE_HTTP_PORT = int(os.environ.get('CLICKHOUSE_HTTP_PORT', 8123))
+# Connections to ClickHouse per API process. Queries wait for a connection
+# past that many, so it should be at least the number of threads of the
+# process (uWSGI --threads).
 CLICKHOUSE_MAX_POOL_SIZE = 25
+# Other replicas of the same data queries can be sent to, as host:port.
+CLICKHOUSE_REPLICAS = [
+    (replica.split(':', 1)[0], int(replica.split(':', 1)[1]))
+    for replica in os.environ.get('CLICKHOUSE_REPLICAS', '').split(',') if replica
+]
+# Connections opened to every replica when an API process starts.
+CLICKHOUSE_WARM_UP_CONNECTIONS = 0
 
 # Dogstatsd Options
 DOGSTATSD_HOST = 'localhost'
@@ -33,6 +43,11 @@ REDIS_DB = 1
 # Query Recording Options
 RECORD_QUERIES = False
 QUERIES_TOPIC = 'snuba-queries'
+# Queries are recorded in batches from a background thread, and dropped if
+# more than QUERY_RECORDER_QUEUE_SIZE are waiting.
+QUERY_RECORDER_QUEUE_SIZE = 1000
+QUERY_RECORDER_BATCH_SIZE = 100
+QUERY_RECORDER_FLUSH_INTERVAL = 1.0
 
 # Runtime Config Options
 CONFIG_MEMOIZE_TIMEOUT = 10
@@ -61,6 +76,22 @@ DEFAULT_RETENTION_DAYS = 90
 RETENTION_OVERRIDES = {}
 
 MAX_PREWHERE_CONDITIONS = 1
+# How often the column sizes used to plan PREWHERE conditions are refreshed.
+PREWHERE_COLUMN_SIZES_REFRESH_INTERVAL = 600
+# How often the partition row counts used to estimate query costs are refreshed.
+PARTITION_STATS_REFRESH_INTERVAL = 300
+
+# Number of compiled SQL templates (one per query shape) kept by the API and
+# how long they are reused before being compiled again.
+QUERY_TEMPLATE_CACHE_SIZE = 500
+QUERY_TEMPLATE_CACHE_TTL = 60
+
+# Maximum number of queries of a /batch request, and number of threads
+# running them in every API process.
+BATCH_MAX_QUERIES = 50
+BATCH_QUERY_THREADS = 8
+# Threads shared by all requests to query speculative time split windows.
+SPLIT_SPECULATIVE_THREADS = 8
 
 STATS_IN_RESPONSE = False
 
@@ -73,5 +104,10 @@ REPLACER_MAX_MEMORY_USAGE = 10 * (1024**3)  # 10GB
 # to queries.
 REPLACER_KEY_TTL = 12 * 60 * 60
 REPLACER_MAX_GROUP_IDS_TO_EXCLUDE = 256
+# TTL of the Redis key holding the time of the last replacement of a
+# project. Rollups are not used for the project until it expires or the
+# rollup was rebuilt since, so it has to cover the time until the
+# partitions open at the time of the replacement are rebuilt.
+REPLACER_REPLACED_KEY_TTL = 14 * 24 * 60 * 60
 
 TURBO_SAMPLE_RATE = 0.1
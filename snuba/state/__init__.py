@@ -1,28 +1,45 @@
 from __future__ import absolute_import
 
+from bisect import bisect_left
 from confluent_kafka import Producer
 from contextlib import contextmanager
+from contextvars import ContextVar, Token
 import logging
+import os
 import random
 import re
 import simplejson as json
+import threading
 import time
 import uuid
 from functools import partial
-from typing import Any, Iterator, Mapping, Optional, Sequence
+from types import MappingProxyType
+from typing import Any, Iterator, List, Mapping, MutableMapping, Optional, Sequence, Tuple
 
 from snuba import settings
 from snuba.redis import redis_client as rds
+from snuba.state import cache
+from snuba.util import create_metrics
 
 
 logger = logging.getLogger('snuba.state')
+metrics = create_metrics(settings.DOGSTATSD_HOST, settings.DOGSTATSD_PORT, 'snuba.state')
 
 kfk = None
 
-ratelimit_prefix = 'snuba-ratelimit:'
+# All the rate limiting buckets share a hash tag, so a query can check all
+# of them atomically in a redis cluster. This puts every bucket in the same
+# cluster slot, hence on a single node.
+ratelimit_prefix = 'snuba-ratelimit:{ratelimit}:'
+# The queries running under the fair share scheduler, updated atomically.
+scheduler_prefix = 'snuba-scheduler:{scheduler}:'
 query_lock_prefix = 'snuba-query-lock:'
+query_done_prefix = 'snuba-query-done:'
 query_cache_prefix = 'snuba-query-cache:'
+bucket_cache_prefix = 'snuba-bucket-cache:'
 config_hash = 'snuba-config'
+config_version_key = 'snuba-config-version'
+config_version_channel = 'snuba-config-updates'
 config_history_hash = 'snuba-config-history'
 config_changes_list = 'snuba-config-changes'
 config_changes_list_limit = 25
@@ -36,55 +53,197 @@ max_query_duration_s = 60
 rate_lookback_s = 60
 
 
+def get_ratelimit_concurrent_key(bucket: str) -> str:
+    return '{}{}:concurrent'.format(ratelimit_prefix, bucket)
+
+
+def get_ratelimit_rate_key(bucket: str, interval: int) -> str:
+    return '{}{}:rate:{}'.format(ratelimit_prefix, bucket, interval)
+
+
 def get_concurrent(bucket: str) -> Any:
     now = time.time()
+    backend, interval = get_configs([
+        ('rate_limit_backend', 'sorted_set'),
+        ('rate_counter_interval_sec', 10),
+    ])
+    if backend == 'counter':
+        running = rds.hgetall(get_ratelimit_concurrent_key(bucket))
+        return sum(
+            int(count) for start, count in running.items()
+            if int(start) + interval + max_query_duration_s > now
+        )
+
     bucket = '{}{}'.format(ratelimit_prefix, bucket)
     return rds.zcount(bucket, '({:f}'.format(now), '+inf')
 
 
 def get_rates(bucket: str, rollup: int=60) -> Sequence[Any]:
     now = int(time.time())
+    rate_history_s, backend, interval = get_configs([
+        ('rate_history_sec', 3600),
+        ('rate_limit_backend', 'sorted_set'),
+        ('rate_counter_interval_sec', 10),
+    ])
+    if backend == 'counter':
+        # The counters of the whole history are read at once, and summed up
+        # by rollup.
+        rollups = list(reversed(range(now - rollup, now - rate_history_s, -rollup)))
+        if not rollups:
+            return []
+        intervals = range(rollups[0] - rollups[0] % interval, now + 1, interval)
+        counts = rds.mget([get_ratelimit_rate_key(bucket, i) for i in intervals])
+        totals = [0] * len(rollups)
+        for start, count in zip(intervals, counts):
+            position = (start - rollups[0]) // rollup
+            if count is not None and 0 <= position < len(rollups):
+                totals[position] += int(count)
+        return [c / float(rollup) for c in totals]
+
     bucket = '{}{}'.format(ratelimit_prefix, bucket)
     pipe = rds.pipeline(transaction=False)
-    rate_history_s = get_config('rate_history_sec', 3600)
     for i in reversed(range(now - rollup, now - rate_history_s, -rollup)):
         pipe.zcount(bucket, i, '({:f}'.format(i + rollup))
     return [c / float(rollup) for c in pipe.execute()]
 
 
+class Deduplication:
+    """
+    Yielded by ``deduper``. ``is_duplicate`` is set if the query had to wait
+    for an identical one. The query that ran publishes the cache key of its
+    result to the queries waiting for it, so that they read it from the
+    result cache, and waiters expecting a different result format ignore it.
+    """
+
+    def __init__(self, is_duplicate: bool, payload: Optional[str] = None) -> None:
+        self.is_duplicate = is_duplicate
+        self.__received = payload
+        self.__published: Optional[str] = None
+
+    def get_result(self, key: str) -> Any:
+        """
+        Returns the cached result of the query this one waited for.
+        """
+        if self.__received is None or self.__received != key:
+            return None
+        return get_result(key)
+
+    def publish(self, key: str) -> None:
+        """
+        Notifies the waiting queries that the result was cached with `key`.
+        """
+        self.__published = key
+
+    def get_payload(self) -> Optional[str]:
+        return self.__published if self.__published is not None else self.__received
+
+
+class InflightQuery:
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.payload: Optional[str] = None
+
+
+inflight_queries: MutableMapping[str, InflightQuery] = {}
+inflight_queries_lock = threading.Lock()
+
+
 @contextmanager
-def deduper(query_id: Optional[str]) -> Iterator[bool]:
+def deduper(query_id: Optional[str]) -> Iterator[Deduplication]:
     """
-    A simple redis distributed lock on a query_id to prevent multiple
-    concurrent queries running with the same id. Blocks subsequent
-    queries until the first is finished.
+    Prevents multiple concurrent queries running with the same query_id.
+    Subsequent queries are blocked until the first is finished, and receive
+    the result it published, if any.
 
-    When used in conjunction with caching this means that the subsequent
-    queries can then use the cached result from the first query.
+    Identical queries running in the same process wait for each other first,
+    so only one of them takes part in the distributed deduplication.
+    """
+    if query_id is None:
+        yield Deduplication(False)
+        return
+
+    is_dupe = False
+    while True:
+        with inflight_queries_lock:
+            inflight = inflight_queries.get(query_id)
+            if inflight is None:
+                inflight = inflight_queries[query_id] = InflightQuery()
+                break
+
+        is_dupe = True
+        if not inflight.done.wait(max_query_duration_s):
+            # Like the distributed lock, stop waiting for a query that runs
+            # longer than any query should.
+            yield Deduplication(True)
+            return
+        if inflight.payload is not None:
+            yield Deduplication(True, inflight.payload)
+            return
+
+    try:
+        with distributed_deduper(query_id) as dedupe:
+            dedupe.is_duplicate = dedupe.is_duplicate or is_dupe
+            yield dedupe
+            inflight.payload = dedupe.get_payload()
+    finally:
+        with inflight_queries_lock:
+            del inflight_queries[query_id]
+        inflight.done.set()
+
+
+@contextmanager
+def distributed_deduper(query_id: str) -> Iterator[Deduplication]:
+    """
+    A redis distributed lock on a query_id. Instead of polling the lock,
+    subsequent queries subscribe to a channel on which the cache key of the
+    result of the query holding the lock is published when it is released.
     """
 
     unlock = '''
         if redis.call('get', KEYS[1]) == ARGV[1]
         then
+            redis.call('publish', ARGV[2], ARGV[3])
             return redis.call('del', KEYS[1])
         else
             return 0
         end
     '''
 
-    if query_id is None:
-        yield False
-    else:
-        lock = '{}{}'.format(query_lock_prefix, query_id)
-        nonce = uuid.uuid4()
-        try:
-            is_dupe = False
-            while not rds.set(lock, nonce, nx=True, ex=max_query_duration_s):
-                is_dupe = True
-                time.sleep(0.01)
-            yield is_dupe
-        finally:
-            rds.eval(unlock, 1, lock, nonce)
+    lock = '{}{}'.format(query_lock_prefix, query_id)
+    channel = '{}{}'.format(query_done_prefix, query_id)
+    nonce = str(uuid.uuid4())
+    is_dupe = False
+    payload = None
+    pubsub = None
+    try:
+        while not rds.set(lock, nonce, nx=True, ex=max_query_duration_s):
+            is_dupe = True
+            if pubsub is None:
+                # Try the lock again once subscribed, so that its release
+                # cannot be missed.
+                pubsub = rds.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(channel)
+                continue
+
+            # Waiting times out in case the query holding the lock died
+            # without releasing it.
+            message = pubsub.get_message(timeout=1)
+            if message is not None and message['data'] != b'null':
+                payload = message['data'].decode('utf-8')
+                break
+    finally:
+        if pubsub is not None:
+            pubsub.close()
+
+    if payload is not None:
+        yield Deduplication(True, payload)
+        return
+
+    dedupe = Deduplication(is_dupe)
+    try:
+        yield dedupe
+    finally:
+        rds.eval(unlock, 1, lock, nonce, channel, dedupe.get_payload() or 'null')
 
 
 # Runtime Configuration
@@ -121,6 +280,29 @@ def numeric(value: Optional[Any]) -> Optional[Any]:
 ABTEST_RE = re.compile('(?:(-?\d+\.?\d*)(?:\:(\d+))?\/?)')
 
 
+def compile_abtest(value: Optional[Any]) -> Optional[Tuple[Sequence[int], Sequence[Any]]]:
+    """
+    Parses an A/B test value into its cumulative weights and values, or
+    returns None if the value is not an A/B test.
+    """
+    if not isinstance(value, str) or not ABTEST_RE.match(value):
+        return None
+
+    weights: List[int] = []
+    values: List[Any] = []
+    total_weight = 0
+    for (v, weight) in ABTEST_RE.findall(value):
+        total_weight += int(weight or 1)
+        weights.append(total_weight)
+        values.append(numeric(v))
+    return weights, values
+
+
+def pick_abtest(weights: Sequence[int], values: Sequence[Any]) -> Any:
+    r = random.randint(1, weights[-1])
+    return values[bisect_left(weights, r)]
+
+
 def abtest(value: Optional[Any]) -> Optional[Any]:
     """
     Recognizes a value that consists of a '/'-separated sequence of
@@ -131,17 +313,54 @@ def abtest(value: Optional[Any]) -> Optional[Any]:
     1000:1/2000:1 => returns 1000 or 2000 with equal weight
     1000:2/2000:1 => returns 1000 twice as often as 2000
     """
-    if isinstance(value, str) and ABTEST_RE.match(value):
-        values = ABTEST_RE.findall(value)
-        total_weight = sum(int(weight or 1) for (_, weight) in values)
-        r = random.randint(1, total_weight)
-        i = 0
-        for (v, weight) in values:
-            i += int(weight or 1)
-            if i >= r:
-                return numeric(v)
-    else:
+    compiled = compile_abtest(value)
+    if compiled is None:
         return value
+    return pick_abtest(*compiled)
+
+
+class ConfigSnapshot:
+    """
+    An immutable, pre-parsed copy of the runtime config at a given version.
+    A/B test values are compiled once, so resolving the snapshot only has
+    to pick their values.
+    """
+
+    def __init__(self, raw_configs: Mapping[str, Optional[Any]], version: int) -> None:
+        self.version = version
+        self.__raw_configs = raw_configs
+        self.__static: MutableMapping[str, Optional[Any]] = {}
+        self.__abtests: MutableMapping[str, Tuple[Sequence[int], Sequence[Any]]] = {}
+        for key, value in raw_configs.items():
+            compiled = compile_abtest(value)
+            if compiled is None:
+                self.__static[key] = value
+            else:
+                self.__abtests[key] = compiled
+
+    def get_raw_configs(self) -> Mapping[str, Optional[Any]]:
+        return self.__raw_configs
+
+    def resolve(self) -> "ResolvedConfigs":
+        configs = dict(self.__static)
+        for key, compiled in self.__abtests.items():
+            configs[key] = pick_abtest(*compiled)
+        return ResolvedConfigs(configs)
+
+
+class ResolvedConfigs:
+    """
+    The runtime config values used by a request, with every A/B test
+    resolved, and the ClickHouse query settings it defines.
+    """
+
+    def __init__(self, configs: Mapping[str, Optional[Any]]) -> None:
+        self.configs: Mapping[str, Optional[Any]] = MappingProxyType(configs)
+        self.query_settings: Mapping[str, Optional[Any]] = MappingProxyType({
+            k.split('/', 1)[1]: v
+            for k, v in configs.items()
+            if k.startswith('query_settings/')
+        })
 
 
 def set_config(key: str, value: Optional[Any], user: Optional[str]=None) -> None:
@@ -162,6 +381,10 @@ def set_config(key: str, value: Optional[Any], user: Optional[str]=None) -> None
             rds.hset(config_history_hash, key, json.dumps(change_record))
         rds.lpush(config_changes_list, json.dumps((key, change_record)))
         rds.ltrim(config_changes_list, 0, config_changes_list_limit)
+
+        version = rds.incr(config_version_key)
+        invalidate_config_snapshot()
+        rds.publish(config_version_channel, version)
     except Exception as ex:
         logger.exception(ex)
 
@@ -181,17 +404,136 @@ def get_configs(key_defaults: Mapping[str, Optional[Any]]) -> Sequence[Optional[
 
 
 def get_all_configs() -> Mapping[str, Optional[Any]]:
-    return {k: abtest(v) for k, v in get_raw_configs().items()}
+    return get_resolved_configs().configs
+
+
+def get_query_settings() -> MutableMapping[str, Optional[Any]]:
+    return dict(get_resolved_configs().query_settings)
 
 
-@memoize(settings.CONFIG_MEMOIZE_TIMEOUT)
 def get_raw_configs() -> Mapping[str, Optional[Any]]:
+    return get_config_snapshot().get_raw_configs()
+
+
+def get_resolved_configs() -> ResolvedConfigs:
+    """
+    Returns the runtime config resolved for the current request, so every
+    lookup within a request sees the same values. Outside of a request the
+    config is resolved every time.
+    """
+    request_configs = _request_configs.get()
+    if request_configs is None:
+        return get_config_snapshot().resolve()
+    if not request_configs:
+        request_configs.append(get_config_snapshot().resolve())
+    return request_configs[0]
+
+
+def start_request_configs() -> Token:
+    """
+    Resolves the runtime config at most once for everything run in the
+    current context, until the returned token is passed to
+    `end_request_configs`.
+    """
+    return _request_configs.set([])
+
+
+def end_request_configs(token: Token) -> None:
+    _request_configs.reset(token)
+
+
+@contextmanager
+def request_configs() -> Iterator[None]:
+    """
+    Resolves the runtime config at most once for everything run within the
+    context, the first time it is needed.
+    """
+    token = start_request_configs()
+    try:
+        yield
+    finally:
+        end_request_configs(token)
+
+
+_request_configs: ContextVar[Optional[List[ResolvedConfigs]]] = ContextVar('request_configs', default=None)
+
+_config_snapshot: Optional[ConfigSnapshot] = None
+_config_snapshot_at = 0.0
+_config_listener_pid: Optional[int] = None
+_config_listener_lock = threading.Lock()
+
+
+def get_config_snapshot() -> ConfigSnapshot:
+    """
+    Returns the current runtime config snapshot. It is reloaded as soon as
+    the config changes if the change notifications can be received, and
+    after `CONFIG_MEMOIZE_TIMEOUT` seconds in any case.
+    """
+    global _config_snapshot, _config_snapshot_at
+
+    if settings.CONFIG_MEMOIZE_TIMEOUT > 0:
+        _start_config_listener()
+
+    now = time.time()
+    snapshot = _config_snapshot
+    if snapshot is None or now > _config_snapshot_at + settings.CONFIG_MEMOIZE_TIMEOUT:
+        snapshot = _load_config_snapshot()
+        _config_snapshot, _config_snapshot_at = snapshot, now
+    return snapshot
+
+
+def invalidate_config_snapshot(version: Optional[int]=None) -> None:
+    """
+    Drops the current snapshot, unless it is already at least at `version`.
+    """
+    global _config_snapshot
+
+    snapshot = _config_snapshot
+    if snapshot is not None and (version is None or version > snapshot.version):
+        _config_snapshot = None
+
+
+def _load_config_snapshot() -> ConfigSnapshot:
     try:
+        # The version is read first, so the snapshot is never considered
+        # newer than its contents.
+        version = int(rds.get(config_version_key) or 0)
         all_configs = rds.hgetall(config_hash)
-        return {k.decode('utf-8'): numeric(v.decode('utf-8')) for k, v in all_configs.items() if v is not None}
+        return ConfigSnapshot(
+            {k.decode('utf-8'): numeric(v.decode('utf-8')) for k, v in all_configs.items() if v is not None},
+            version,
+        )
     except Exception as ex:
         logger.exception(ex)
-        return {}
+        return ConfigSnapshot({}, 0)
+
+
+def _start_config_listener() -> None:
+    global _config_listener_pid
+
+    # Threads do not survive a fork, so every process needs its own.
+    pid = os.getpid()
+    if _config_listener_pid == pid:
+        return
+
+    with _config_listener_lock:
+        if _config_listener_pid != pid:
+            threading.Thread(target=_listen_config_changes, name='config-listener', daemon=True).start()
+            _config_listener_pid = pid
+
+
+def _listen_config_changes() -> None:
+    while True:
+        try:
+            pubsub = rds.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(config_version_channel)
+            # Changes may have been missed while not subscribed.
+            invalidate_config_snapshot()
+            for message in pubsub.listen():
+                invalidate_config_snapshot(int(message['data']))
+        except Exception as ex:
+            logger.exception(ex)
+            time.sleep(1)
 
 
 def delete_config(key: str, user: Optional[Any]=None) -> None:
@@ -214,13 +556,13 @@ def safe_dumps_default(value: Any) -> Any:
 safe_dumps = partial(json.dumps, for_json=True, default=safe_dumps_default)
 
 
-def record_query(data: Mapping[str, Optional[Any]]) -> None:
+def record_queries(batch: Sequence[Mapping[str, Optional[Any]]]) -> None:
     global kfk
     max_redis_queries = 200
     try:
-        data = safe_dumps(data)
+        payloads = [safe_dumps(data) for data in batch]
         rds.pipeline(transaction=False)\
-            .lpush(queries_list, data)\
+            .lpush(queries_list, *payloads)\
             .ltrim(queries_list, 0, max_redis_queries - 1)\
             .execute()
 
@@ -229,14 +571,20 @@ def record_query(data: Mapping[str, Optional[Any]]) -> None:
                 'bootstrap.servers': ','.join(settings.DEFAULT_BROKERS)
             })
 
-        kfk.produce(
-            settings.QUERIES_TOPIC,
-            data.encode('utf-8'),
-        )
+        for payload in payloads:
+            kfk.produce(
+                settings.QUERIES_TOPIC,
+                payload.encode('utf-8'),
+            )
+        kfk.poll(0)
     except Exception as ex:
         logger.exception('Could not record query due to error: %r', ex)
 
 
+def record_query(data: Mapping[str, Optional[Any]]) -> None:
+    record_queries([data])
+
+
 def get_queries() -> Sequence[Mapping[str, Optional[Any]]]:
     try:
         queries = []
@@ -253,11 +601,54 @@ def get_queries() -> Sequence[Mapping[str, Optional[Any]]]:
 
 def get_result(query_id: str) -> Any:
     key = '{}{}'.format(query_cache_prefix, query_id)
-    result = rds.get(key)
-    return result and json.loads(result)
+    value = rds.get(key)
+    if not value:
+        return None
+
+    start = time.time()
+    try:
+        codec, result = cache.decode(value)
+    except Exception as ex:
+        logger.exception('Could not decode cached result: %r', ex)
+        return None
+
+    metrics.timing('result_cache.decode', (time.time() - start) * 1000, tags={'codec': codec.name})
+    return result
 
 
 def set_result(query_id: str, result: Mapping[str, Optional[Any]]) -> Any:
-    timeout = get_config('cache_expiry_sec', 1)
+    timeout, codec_name, compression_threshold = get_configs([
+        ('cache_expiry_sec', 1),
+        ('result_cache_codec', 'json'),
+        ('result_cache_compression_threshold', 4096),
+    ])
+    codec = cache.get_codec(codec_name, compression_threshold)
+
+    start = time.time()
+    value = codec.encode(result)
+    tags = {'codec': codec.name}
+    metrics.timing('result_cache.encode', (time.time() - start) * 1000, tags=tags)
+    metrics.timing('result_cache.encoded_size', len(value), tags=tags)
+
     key = '{}{}'.format(query_cache_prefix, query_id)
-    return rds.set(key, json.dumps(result), ex=timeout)
+    return rds.set(key, value, ex=timeout)
+
+
+def get_buckets(shape_id: str, buckets: Sequence[str]) -> Sequence[Optional[Any]]:
+    """
+    Returns the cached value of each bucket of a query shape, or None for
+    the buckets that are not cached.
+    """
+    if not buckets:
+        return []
+    # The shape is a hash tag so all the buckets live on the same node.
+    keys = ['{}{{{}}}:{}'.format(bucket_cache_prefix, shape_id, bucket) for bucket in buckets]
+    return [value and json.loads(value) for value in rds.mget(keys)]
+
+
+def set_buckets(shape_id: str, buckets: Mapping[str, Any], timeout: int) -> None:
+    pipe = rds.pipeline(transaction=False)
+    for bucket, value in buckets.items():
+        key = '{}{{{}}}:{}'.format(bucket_cache_prefix, shape_id, bucket)
+        pipe.set(key, json.dumps(value), ex=timeout)
+    pipe.execute()
@@ -0,0 +1,103 @@
+import logging
+from abc import ABC, abstractmethod
+from typing import Any, Mapping, Optional, Tuple
+
+import lz4.frame
+import msgpack
+import simplejson as json
+
+logger = logging.getLogger('snuba.state.cache')
+
+
+# Binary encodings start with a NUL byte, which cannot start a JSON
+# document, followed by the format version and the compression used.
+HEADER_MARKER = 0
+FORMAT_VERSION = 1
+
+COMPRESSION_NONE = 0
+COMPRESSION_LZ4 = 1
+
+
+class InvalidCacheEntry(Exception):
+    pass
+
+
+class ResultCodec(ABC):
+    """
+    Encodes query results for the result cache.
+    """
+
+    name: str
+
+    @abstractmethod
+    def encode(self, result: Mapping[str, Optional[Any]]) -> bytes:
+        raise NotImplementedError
+
+    @abstractmethod
+    def decode(self, value: bytes) -> Any:
+        raise NotImplementedError
+
+
+class JSONCodec(ResultCodec):
+    name = 'json'
+
+    def encode(self, result: Mapping[str, Optional[Any]]) -> bytes:
+        return json.dumps(result).encode('utf-8')
+
+    def decode(self, value: bytes) -> Any:
+        return json.loads(value)
+
+
+class MsgpackCodec(ResultCodec):
+    """
+    Encodes results with msgpack, compressed with LZ4 when the encoded
+    result is at least ``compression_threshold`` bytes long.
+    """
+
+    name = 'msgpack'
+
+    def __init__(self, compression_threshold: int = 4096) -> None:
+        self.__compression_threshold = compression_threshold
+
+    def encode(self, result: Mapping[str, Optional[Any]]) -> bytes:
+        payload = msgpack.packb(result, use_bin_type=True)
+        if len(payload) >= self.__compression_threshold:
+            compression = COMPRESSION_LZ4
+            payload = lz4.frame.compress(payload)
+        else:
+            compression = COMPRESSION_NONE
+        return bytes([HEADER_MARKER, FORMAT_VERSION, compression]) + payload
+
+    def decode(self, value: bytes) -> Any:
+        marker, version, compression = value[:3]
+        if marker != HEADER_MARKER or version != FORMAT_VERSION:
+            raise InvalidCacheEntry(f'Unsupported cache entry format version {version}')
+
+        payload = value[3:]
+        if compression == COMPRESSION_LZ4:
+            payload = lz4.frame.decompress(payload)
+        elif compression != COMPRESSION_NONE:
+            raise InvalidCacheEntry(f'Unsupported cache entry compression {compression}')
+        return msgpack.unpackb(payload, raw=False)
+
+
+def get_codec(name: str, compression_threshold: int = 4096) -> ResultCodec:
+    if name == MsgpackCodec.name:
+        return MsgpackCodec(compression_threshold)
+    elif name == JSONCodec.name:
+        return JSONCodec()
+    else:
+        # A bad runtime config must not fail the queries writing to the cache.
+        logger.warning('Unknown result cache codec %r, using %r', name, JSONCodec.name)
+        return JSONCodec()
+
+
+def decode(value: bytes) -> Tuple[ResultCodec, Any]:
+    """
+    Decodes a cache entry written with any of the codecs.
+    """
+    if value[:1] == bytes([HEADER_MARKER]):
+        codec: ResultCodec = MsgpackCodec()
+    else:
+        codec = JSONCodec()
+    return codec, codec.decode(value)
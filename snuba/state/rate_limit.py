@@ -1,16 +1,21 @@
+from abc import ABC, abstractmethod
 from collections import namedtuple, ChainMap
-from contextlib import contextmanager, AbstractContextManager, ExitStack
+from contextlib import contextmanager, AbstractContextManager
 from dataclasses import dataclass
 import logging
+import threading
 import time
 from types import TracebackType
 from typing import (
+    Any,
     ChainMap as TypingChainMap,
     Iterator,
+    List,
     Mapping,
     MutableMapping,
     Optional,
     Sequence,
+    Tuple,
     Type
 )
 import uuid
@@ -80,13 +85,136 @@ class RateLimitStatsContainer:
         return ChainMap(*grouped_stats)
 
 
-@contextmanager
-def rate_limit(rate_limit_params: RateLimitParameters) -> Iterator[Optional[RateLimitStats]]:
+# Runs every rate limit of a query atomically. Queries are thrown ahead in
+# time in every bucket, and only kept in them if no limit is exceeded.
+ACQUIRE_SCRIPT = state.rds.register_script('''
+    local now = tonumber(ARGV[1])
+    local max_query_duration = tonumber(ARGV[2])
+    local rate_history = tonumber(ARGV[3])
+    local rate_lookback = tonumber(ARGV[4])
+    local query_id = ARGV[5]
+
+    local counts = {}
+    for i, bucket in ipairs(KEYS) do
+        redis.call('zremrangebyscore', bucket, '-inf', '(' .. string.format('%f', now - rate_history))
+        redis.call('zadd', bucket, now + max_query_duration, query_id .. ':' .. i)
+        local historical = redis.call('zcount', bucket, now - rate_lookback, now)
+        local concurrent = redis.call('zcount', bucket, '(' .. string.format('%f', now), '+inf')
+        counts[i] = {historical, concurrent}
+
+        local per_second_limit = tonumber(ARGV[4 + 2 * i])
+        local concurrent_limit = tonumber(ARGV[5 + 2 * i])
+        if (concurrent_limit and concurrent > concurrent_limit)
+            or (per_second_limit and historical / rate_lookback > per_second_limit)
+        then
+            -- not allowed / not counted
+            for j = 1, i do
+                redis.call('zrem', KEYS[j], query_id .. ':' .. j)
+            end
+            return {i, counts}
+        end
+    end
+    return {0, counts}
+''')
+
+# Returns the query to its start time in every bucket.
+RELEASE_SCRIPT = state.rds.register_script('''
+    for i, bucket in ipairs(KEYS) do
+        redis.call('zincrby', bucket, -tonumber(ARGV[2]), ARGV[1] .. ':' .. i)
+    end
+''')
+
+# Every bucket gets a hash of the number of running queries by start
+# interval, followed by the rate counters of the intervals overlapping the
+# lookback window, oldest first. Queries are only counted if no limit is
+# exceeded.
+COUNTER_ACQUIRE_SCRIPT = state.rds.register_script('''
+    local now = tonumber(ARGV[1])
+    local interval = tonumber(ARGV[2])
+    local max_query_duration = tonumber(ARGV[3])
+    local rate_history = tonumber(ARGV[4])
+    local rate_lookback = tonumber(ARGV[5])
+    local num_buckets = (#ARGV - 5) / 2
+    local stride = #KEYS / num_buckets
+    local current = now - now % interval
+
+    local counts = {}
+    for i = 1, num_buckets do
+        local base = (i - 1) * stride
+        local concurrent = 1
+        local running = redis.call('hgetall', KEYS[base + 1])
+        for j = 1, #running, 2 do
+            if tonumber(running[j]) + interval + max_query_duration <= now then
+                redis.call('hdel', KEYS[base + 1], running[j])
+            else
+                concurrent = concurrent + tonumber(running[j + 1])
+            end
+        end
+
+        -- Sliding window approximation, the oldest interval only partially
+        -- overlaps the lookback window.
+        local historical = 0
+        for j = 2, stride do
+            local start = current - (stride - j) * interval
+            local overlap = (start + interval - (now - rate_lookback)) / interval
+            local count = tonumber(redis.call('get', KEYS[base + j]) or 0)
+            historical = historical + count * math.max(0, math.min(1, overlap))
+        end
+        counts[i] = {tostring(historical), concurrent}
+
+        local per_second_limit = tonumber(ARGV[4 + 2 * i])
+        local concurrent_limit = tonumber(ARGV[5 + 2 * i])
+        if (concurrent_limit and concurrent > concurrent_limit)
+            or (per_second_limit and historical / rate_lookback > per_second_limit)
+        then
+            return {i, counts}
+        end
+    end
+
+    for i = 1, num_buckets do
+        local base = (i - 1) * stride
+        redis.call('hincrby', KEYS[base + 1], current, 1)
+        redis.call('expire', KEYS[base + 1], interval + max_query_duration)
+        redis.call('incr', KEYS[base + stride])
+        redis.call('expire', KEYS[base + stride], rate_history + interval)
+    end
+    return {0, counts}
+''')
+
+# Removes the query from the running queries of its start interval.
+COUNTER_RELEASE_SCRIPT = state.rds.register_script('''
+    for i, key in ipairs(KEYS) do
+        if redis.call('hexists', key, ARGV[1]) == 1
+            and redis.call('hincrby', key, ARGV[1], -1) <= 0
+        then
+            redis.call('hdel', key, ARGV[1])
+        end
+    end
+''')
+
+
+class RateLimitBackend(ABC):
+    """
+    Counts the queries of rate limiting buckets in redis.
     """
-    A context manager for rate limiting that allows for limiting based on
-    on a rolling-window per-second rate as well as the number of requests
-    concurrently running.
 
+    @abstractmethod
+    def acquire(self, rate_limit_params: Sequence[RateLimitParameters]) -> Tuple[int, Sequence[RateLimitStats], Any]:
+        """
+        Checks every rate limit in order and counts the query in all of
+        them if none is exceeded. Returns the 1-based position of the
+        exceeded rate limit, or 0, the stats of the rate limits checked and
+        the value to pass to `release` once the query is done.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def release(self, acquired: Any) -> None:
+        raise NotImplementedError
+
+
+class SortedSetRateLimitBackend(RateLimitBackend):
+    """
     Uses a single redis sorted set per rate-limiting bucket to track both the
     concurrency and rate, the score is the query timestamp. Queries are thrown
     ahead in time when they start so we can count them as concurrent, and
@@ -101,72 +229,115 @@ def rate_limit(rate_limit_params: RateLimitParameters) -> Iterator[Optional[Rate
                                  now
     """
 
-    bucket = '{}{}'.format(state.ratelimit_prefix, rate_limit_params.bucket)
-    query_id = uuid.uuid4()
+    def __init__(self, rate_history_s: int) -> None:
+        self.__rate_history_s = rate_history_s
 
-    now = time.time()
-    bypass_rate_limit, rate_history_s = state.get_configs([
-        ('bypass_rate_limit', 0),
-        ('rate_history_sec', 3600)
-    ])
+    def acquire(self, rate_limit_params: Sequence[RateLimitParameters]) -> Tuple[int, Sequence[RateLimitStats], Any]:
+        buckets = ['{}{}'.format(state.ratelimit_prefix, params.bucket) for params in rate_limit_params]
+        query_id = str(uuid.uuid4())
 
-    if bypass_rate_limit == 1:
-        yield None
-
-    pipe = state.rds.pipeline(transaction=False)
-    pipe.zremrangebyscore(bucket, '-inf', '({:f}'.format(now - rate_history_s))  # cleanup
-    pipe.zadd(bucket, now + state.max_query_duration_s, query_id)  # add query
-    if rate_limit_params.per_second_limit is None:
-        pipe.exists("nosuchkey")  # no-op if we don't need per-second
-    else:
-        pipe.zcount(bucket, now - state.rate_lookback_s, now)  # get historical
-    if rate_limit_params.concurrent_limit is None:
-        pipe.exists("nosuchkey")  # no-op if we don't need concurrent
-    else:
-        pipe.zcount(bucket, '({:f}'.format(now), '+inf')  # get concurrent
-
-    try:
-        _, _, historical, concurrent = pipe.execute()
-        historical = int(historical)
-        concurrent = int(concurrent)
-    except Exception as ex:
-        logger.exception(ex)
-        yield None  # fail open if redis is having issues
-
-    per_second = historical / float(state.rate_lookback_s)
-
-    stats = RateLimitStats(rate=per_second, concurrent=concurrent)
-
-    rate_limit_name = rate_limit_params.rate_limit_name
-
-    Reason = namedtuple('reason', 'scope name val limit')
-    reasons = [
-        Reason(rate_limit_name, 'concurrent', concurrent, rate_limit_params.concurrent_limit),
-        Reason(rate_limit_name, 'per-second', per_second, rate_limit_params.per_second_limit),
-    ]
+        args = [
+            '{:f}'.format(time.time()),
+            state.max_query_duration_s,
+            self.__rate_history_s,
+            state.rate_lookback_s,
+            query_id,
+        ]
+        args.extend(_get_limit_args(rate_limit_params))
 
-    reason = next((r for r in reasons if r.limit is not None and r.val > r.limit), None)
+        rejected, counts = ACQUIRE_SCRIPT(keys=buckets, args=args)
+        return rejected, _get_stats(counts), (buckets, query_id)
+
+    def release(self, acquired: Any) -> None:
+        buckets, query_id = acquired
+        RELEASE_SCRIPT(keys=buckets, args=[query_id, state.max_query_duration_s])
 
-    if reason:
-        try:
-            state.rds.zrem(bucket, query_id)  # not allowed / not counted
-        except Exception as ex:
-            logger.exception(ex)
-            pass
 
-        raise RateLimitExceeded(
-            '{r.scope} {r.name} of {r.val:.0f} exceeds limit of {r.limit:.0f}'.format(r=reason)
+class CounterRateLimitBackend(RateLimitBackend):
+    """
+    Uses fixed-size counters instead of one sorted set member per query, so
+    the memory used does not depend on the query volume.
+
+    Queries are counted towards the rate of the `interval_s` interval they
+    start in, and the rate is approximated over the lookback window from
+    those intervals. Running queries are counted by start interval as well,
+    so the queries that are never released stop being counted after
+    `max_query_duration_s`, like with sorted sets.
+    """
+
+    def __init__(self, rate_history_s: int, interval_s: int) -> None:
+        self.__rate_history_s = rate_history_s
+        self.__interval_s = interval_s
+
+    def acquire(self, rate_limit_params: Sequence[RateLimitParameters]) -> Tuple[int, Sequence[RateLimitStats], Any]:
+        now = time.time()
+        current = int(now) - int(now) % self.__interval_s
+        intervals = range(
+            current - state.rate_lookback_s // self.__interval_s * self.__interval_s,
+            current + 1,
+            self.__interval_s,
         )
 
-    try:
-        yield stats
-    finally:
-        try:
-            # return the query to its start time
-            state.rds.zincrby(bucket, query_id, -float(state.max_query_duration_s))
-        except Exception as ex:
-            logger.exception(ex)
-            pass
+        keys = []
+        for params in rate_limit_params:
+            keys.append(state.get_ratelimit_concurrent_key(params.bucket))
+            keys.extend(state.get_ratelimit_rate_key(params.bucket, interval) for interval in intervals)
+
+        args = [
+            '{:f}'.format(now),
+            self.__interval_s,
+            state.max_query_duration_s,
+            self.__rate_history_s,
+            state.rate_lookback_s,
+        ]
+        args.extend(_get_limit_args(rate_limit_params))
+
+        rejected, counts = COUNTER_ACQUIRE_SCRIPT(keys=keys, args=args)
+        return rejected, _get_stats(counts), (keys[::len(intervals) + 1], current)
+
+    def release(self, acquired: Any) -> None:
+        keys, interval = acquired
+        COUNTER_RELEASE_SCRIPT(keys=keys, args=[interval])
+
+
+def _get_limit_args(rate_limit_params: Sequence[RateLimitParameters]) -> Sequence[Any]:
+    args: List[Any] = []
+    for params in rate_limit_params:
+        args.append('' if params.per_second_limit is None else params.per_second_limit)
+        args.append('' if params.concurrent_limit is None else params.concurrent_limit)
+    return args
+
+
+def _get_stats(counts: Sequence[Tuple[Any, Any]]) -> Sequence[RateLimitStats]:
+    return [
+        RateLimitStats(
+            rate=float(historical) / state.rate_lookback_s,
+            concurrent=int(concurrent),
+        )
+        for historical, concurrent in counts
+    ]
+
+
+def get_rate_limit_backend() -> RateLimitBackend:
+    backend, rate_history_s, interval_s = state.get_configs([
+        ('rate_limit_backend', 'sorted_set'),
+        ('rate_history_sec', 3600),
+        ('rate_counter_interval_sec', 10),
+    ])
+    if backend == 'counter':
+        return CounterRateLimitBackend(rate_history_s, interval_s)
+    return SortedSetRateLimitBackend(rate_history_s)
+
+
+@contextmanager
+def rate_limit(rate_limit_params: RateLimitParameters) -> Iterator[Optional[RateLimitStats]]:
+    """
+    A context manager for rate limiting that allows for limiting based on
+    on a rolling-window per-second rate as well as the number of requests
+    concurrently running.
+    """
+    with RateLimitAggregator([rate_limit_params]) as stats:
+        yield stats.get_stats(rate_limit_params.rate_limit_name)
 
 
 def get_global_rate_limit_params() -> RateLimitParameters:
@@ -191,21 +362,58 @@ class RateLimitAggregator(AbstractContextManager):
     """
     Runs the rate limits provided by the `rate_limit_params` configuration object.
 
-    It runs the rate limits in the order described by `rate_limit_params`.
+    All the rate limits are checked, in the order described by
+    `rate_limit_params`, and released in a single call to redis, using the
+    backend selected by the `rate_limit_backend` runtime config.
+
+    The rate limits are released when the context exits, or earlier, from
+    any thread, by calling `release`.
     """
 
     def __init__(self, rate_limit_params: Sequence[RateLimitParameters]) -> None:
         self.rate_limit_params = rate_limit_params
-        self.stack = ExitStack()
+        self.__acquired: Optional[Tuple[RateLimitBackend, Any]] = None
+        self.__lock = threading.Lock()
 
     def __enter__(self) -> RateLimitStatsContainer:
         stats = RateLimitStatsContainer()
 
-        for rate_limit_param in self.rate_limit_params:
-            child_stats = self.stack.enter_context(rate_limit(rate_limit_param))
-            if child_stats:
-                stats.add_stats(rate_limit_param.rate_limit_name, child_stats)
+        bypass_rate_limit = state.get_config('bypass_rate_limit', 0)
+        if bypass_rate_limit == 1 or not self.rate_limit_params:
+            return stats
 
+        backend = get_rate_limit_backend()
+        try:
+            rejected, bucket_stats, acquired = backend.acquire(self.rate_limit_params)
+        except Exception as ex:
+            logger.exception(ex)
+            return stats  # fail open if redis is having issues
+
+        for params, child_stats in zip(self.rate_limit_params, bucket_stats):
+            # Limits sharing a name, like the limits of every project of a
+            # query, report the most loaded bucket.
+            existing = stats.get_stats(params.rate_limit_name)
+            if existing is not None:
+                child_stats = RateLimitStats(
+                    rate=max(existing.rate, child_stats.rate),
+                    concurrent=max(existing.concurrent, child_stats.concurrent),
+                )
+            stats.add_stats(params.rate_limit_name, child_stats)
+
+        if rejected:
+            params = self.rate_limit_params[rejected - 1]
+            rejected_stats = bucket_stats[rejected - 1]
+            Reason = namedtuple('reason', 'scope name val limit')
+            reasons = [
+                Reason(params.rate_limit_name, 'concurrent', rejected_stats.concurrent, params.concurrent_limit),
+                Reason(params.rate_limit_name, 'per-second', rejected_stats.rate, params.per_second_limit),
+            ]
+            reason = next(r for r in reasons if r.limit is not None and r.val > r.limit)
+            raise RateLimitExceeded(
+                '{r.scope} {r.name} of {r.val:.0f} exceeds limit of {r.limit:.0f}'.format(r=reason)
+            )
+
+        self.__acquired = (backend, acquired)
         return stats
 
     def __exit__(
@@ -214,4 +422,16 @@ class RateLimitAggregator(AbstractContextManager):
             exc_val: Optional[BaseException],
             exc_tb: Optional[TracebackType]
     ) -> None:
-        self.stack.pop_all().close()
+        self.release()
+
+    def release(self) -> None:
+        with self.__lock:
+            if self.__acquired is None:
+                return
+            backend, acquired = self.__acquired
+            self.__acquired = None
+
+        try:
+            backend.release(acquired)
+        except Exception as ex:
+            logger.exception(ex)
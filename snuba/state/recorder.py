@@ -0,0 +1,85 @@
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from typing import Any, List, Mapping, Optional
+
+from snuba import settings, state
+
+logger = logging.getLogger('snuba.state.recorder')
+
+
+class QueryRecorder:
+    """
+    Records queries from a background thread, so that serializing them and
+    sending them to redis and Kafka does not add to the response time.
+
+    Queries are sampled with the `record_queries_sample_rate` runtime
+    config, and dropped when the queue is full rather than blocking the
+    request.
+    """
+
+    def __init__(
+        self,
+        max_queue_size: int,
+        batch_size: int,
+        flush_interval: float,
+    ) -> None:
+        self.__queue: queue.Queue = queue.Queue(max_queue_size)
+        self.__batch_size = batch_size
+        self.__flush_interval = flush_interval
+        self.__lock = threading.Lock()
+        self.__pid: Optional[int] = None
+
+    def record(self, data: Mapping[str, Optional[Any]]) -> None:
+        sample_rate = state.get_config('record_queries_sample_rate', 1)
+        if sample_rate < 1 and random.random() >= sample_rate:
+            state.metrics.increment('query_recorder.sampled_out')
+            return
+
+        self.__start()
+        try:
+            self.__queue.put_nowait(data)
+        except queue.Full:
+            state.metrics.increment('query_recorder.dropped')
+
+    def __start(self) -> None:
+        # Threads do not survive a fork, so every process needs its own.
+        pid = os.getpid()
+        if self.__pid == pid:
+            return
+
+        with self.__lock:
+            if self.__pid != pid:
+                threading.Thread(target=self.__run, name='query-recorder', daemon=True).start()
+                self.__pid = pid
+
+    def __run(self) -> None:
+        while True:
+            batch: List[Mapping[str, Optional[Any]]] = [self.__queue.get()]
+            deadline = time.time() + self.__flush_interval
+            while len(batch) < self.__batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.__queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            state.record_queries(batch)
+            state.metrics.timing('query_recorder.batch_size', len(batch))
+            state.metrics.gauge('query_recorder.queue_size', self.__queue.qsize())
+
+
+recorder = QueryRecorder(
+    settings.QUERY_RECORDER_QUEUE_SIZE,
+    settings.QUERY_RECORDER_BATCH_SIZE,
+    settings.QUERY_RECORDER_FLUSH_INTERVAL,
+)
+
+
+def record_query(data: Mapping[str, Optional[Any]]) -> None:
+    recorder.record(data)
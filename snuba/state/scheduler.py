@@ -0,0 +1,163 @@
+from contextlib import contextmanager
+from dataclasses import dataclass
+import logging
+import time
+from typing import Iterator, Optional, Sequence
+import uuid
+
+from snuba import state
+from snuba.state.rate_limit import RateLimitParameters
+
+logger = logging.getLogger('snuba.state.scheduler')
+
+FINAL_RATE_LIMIT_NAME = 'final'
+
+# Registers a query with its weight, after dropping the queries that were
+# never released, and returns the total weight and number of the queries
+# running.
+ALLOCATE_SCRIPT = state.rds.register_script('''
+    local now = tonumber(ARGV[1])
+    local expired = redis.call('zrangebyscore', KEYS[2], '-inf', now)
+    for _, query_id in ipairs(expired) do
+        redis.call('hdel', KEYS[1], query_id)
+        redis.call('zrem', KEYS[2], query_id)
+    end
+
+    redis.call('hset', KEYS[1], ARGV[3], ARGV[4])
+    redis.call('zadd', KEYS[2], now + tonumber(ARGV[2]), ARGV[3])
+
+    local total = 0
+    local weights = redis.call('hvals', KEYS[1])
+    for _, weight in ipairs(weights) do
+        total = total + tonumber(weight)
+    end
+    return {tostring(total), #weights}
+''')
+
+RELEASE_SCRIPT = state.rds.register_script('''
+    redis.call('hdel', KEYS[1], ARGV[1])
+    redis.call('zrem', KEYS[2], ARGV[1])
+''')
+
+
+@dataclass(frozen=True)
+class Allocation:
+    """
+    The share of the ClickHouse resources a query can use.
+    """
+    share: float
+    running: int
+    max_threads: int
+    max_memory_usage: Optional[int]
+
+
+class FairShareScheduler:
+    """
+    Splits a global budget of ClickHouse threads and memory between the
+    queries running at the same time, in proportion to their weights.
+
+    Every query gets `weight / total weight` of the budget, where the total
+    includes the queries already running, so the queries of a project with
+    many queries running, or with a low weight, get a smaller share instead
+    of taking resources away from everyone else. Shares are computed when a
+    query starts, as ClickHouse settings cannot change while it runs.
+
+    Queries are tracked in redis until they are released, or for at most
+    `max_query_duration_s`.
+    """
+
+    def __init__(
+        self,
+        thread_budget: int,
+        memory_budget: int,
+        min_memory_usage: int,
+        max_query_duration_s: int,
+    ) -> None:
+        self.__thread_budget = thread_budget
+        self.__memory_budget = memory_budget
+        self.__min_memory_usage = min_memory_usage
+        self.__max_query_duration_s = max_query_duration_s
+
+    def __get_keys(self) -> Sequence[str]:
+        return [f'{state.scheduler_prefix}weights', f'{state.scheduler_prefix}deadlines']
+
+    def get_allocation(self, weight: float, total_weight: float, running: int) -> Allocation:
+        share = weight / total_weight if total_weight > 0 else 1.0
+        return Allocation(
+            share=share,
+            running=running,
+            max_threads=max(1, int(self.__thread_budget * share)),
+            max_memory_usage=max(
+                self.__min_memory_usage, int(self.__memory_budget * share)
+            ) if self.__memory_budget else None,
+        )
+
+    @contextmanager
+    def allocate(self, weight: float) -> Iterator[Optional[Allocation]]:
+        """
+        Runs a query with the given weight, yielding its allocation, or
+        None if redis is not available.
+        """
+        keys = self.__get_keys()
+        query_id = str(uuid.uuid4())
+        try:
+            total_weight, running = ALLOCATE_SCRIPT(
+                keys=keys,
+                args=['{:f}'.format(time.time()), self.__max_query_duration_s, query_id, weight],
+            )
+        except Exception as ex:
+            logger.exception(ex)
+            total_weight = None
+
+        if total_weight is None:
+            yield None  # fail open if redis is having issues
+            return
+
+        try:
+            yield self.get_allocation(weight, float(total_weight), int(running))
+        finally:
+            try:
+                RELEASE_SCRIPT(keys=keys, args=[query_id])
+            except Exception as ex:
+                logger.exception(ex)
+
+
+def get_scheduler() -> FairShareScheduler:
+    thread_budget, memory_budget, min_memory_usage = state.get_configs([
+        ('scheduler_thread_budget', 64),
+        ('scheduler_memory_budget', 0),
+        ('scheduler_min_memory_usage', 1024 ** 3),
+    ])
+    return FairShareScheduler(thread_budget, memory_budget, min_memory_usage, state.max_query_duration_s)
+
+
+def get_query_weight(project_ids: Sequence[int], referrer: Optional[str]) -> float:
+    """
+    The weight of a query is the product of the weights of its project and
+    of its referrer, both 1 by default. Queries on several projects use the
+    weight of the first one, like the project rate limit.
+    """
+    all_confs = state.get_all_configs()
+    weight = 1.0
+    if project_ids:
+        weight = float(all_confs.get(f'project_weight_{project_ids[0]}', 1))
+    if referrer:
+        weight *= float(all_confs.get(f'referrer_weight_{referrer}', 1))
+    return weight
+
+
+def get_final_rate_limit_params() -> Optional[RateLimitParameters]:
+    """
+    FINAL queries merge parts while they read them, which makes them much
+    more expensive than the weights account for, so the number of them
+    running at the same time is limited separately.
+    """
+    concurrent_limit = state.get_config('final_concurrent_limit', None)
+    if concurrent_limit is None:
+        return None
+    return RateLimitParameters(
+        rate_limit_name=FINAL_RATE_LIMIT_NAME,
+        bucket=FINAL_RATE_LIMIT_NAME,
+        per_second_limit=None,
+        concurrent_limit=concurrent_limit,
+    )
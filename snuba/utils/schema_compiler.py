@@ -0,0 +1,230 @@
+import copy
+import re
+from typing import Any, Callable, List, Mapping, MutableMapping, Optional, Sequence
+
+import jsonschema
+
+
+class UnsupportedSchema(Exception):
+    """
+    Exception thrown when a schema uses keywords that cannot be compiled.
+    """
+
+
+# Keywords that do not affect validation.
+IGNORED_KEYWORDS = {'default', 'definitions', 'description', 'title', '$schema'}
+
+# Type checks accepting a subset of what jsonschema accepts for every type.
+TYPE_CHECKS = {
+    'object': 'isinstance({value}, dict)',
+    'array': 'isinstance({value}, (list, tuple))',
+    'string': 'isinstance({value}, str)',
+    'integer': 'type({value}) is int',
+    'number': 'type({value}) in (int, float)',
+    'boolean': 'isinstance({value}, bool)',
+    'null': '{value} is None',
+}
+
+IMMUTABLE_TYPES = (str, int, float, bool, type(None))
+
+
+class _Compiler:
+    """
+    Generates the source of a function per subschema, so the checks of a
+    schema run as plain Python code instead of being looked up in the
+    schema for every value.
+    """
+
+    def __init__(self, root: Mapping[str, Any], set_defaults: bool) -> None:
+        self.__root = root
+        self.__set_defaults = set_defaults
+        self.__functions: List[str] = []
+        self.__refs: MutableMapping[str, str] = {}
+        self.__counter = 0
+        self.__namespace: MutableMapping[str, Any] = {
+            'deepcopy': copy.deepcopy,
+            'format_checker': jsonschema.FormatChecker(),
+        }
+
+    def compile(self) -> Callable[[Any], bool]:
+        name = self.__compile_schema(self.__root, in_branch=False)
+        exec('\n\n'.join(self.__functions), self.__namespace)
+        return self.__namespace[name]
+
+    def __get_function_name(self) -> str:
+        self.__counter += 1
+        return f'f{self.__counter}'
+
+    def __add_constant(self, value: Any) -> str:
+        name = f'c{len(self.__namespace)}'
+        self.__namespace[name] = value
+        return name
+
+    def __compile_ref(self, ref: str, in_branch: bool) -> str:
+        key = f'{ref}:{in_branch}'
+        if key not in self.__refs:
+            if not ref.startswith('#/'):
+                raise UnsupportedSchema(f'unsupported reference {ref!r}')
+            schema: Any = self.__root
+            for part in ref[2:].split('/'):
+                schema = schema[part.replace('~1', '/').replace('~0', '~')]
+            # Reserve the name first, references can be recursive.
+            self.__refs[key] = self.__get_function_name()
+            self.__compile_schema(schema, in_branch, self.__refs[key])
+        return self.__refs[key]
+
+    def __compile_schema(self, schema: Any, in_branch: bool, name: Optional[str] = None) -> str:
+        if not isinstance(schema, dict):
+            raise UnsupportedSchema('schemas must be objects')
+
+        if name is None:
+            name = self.__get_function_name()
+        # Reserve the position of the function in the module.
+        position = len(self.__functions)
+        self.__functions.append('')
+
+        lines = [f'def {name}(value):']
+        if '$ref' in schema:
+            # Like jsonschema, the other keywords are ignored.
+            lines.append(f"    return {self.__compile_ref(schema['$ref'], in_branch)}(value)")
+        else:
+            for keyword, argument in schema.items():
+                lines.extend(f'    {line}' for line in self.__compile_keyword(keyword, argument, schema, in_branch))
+            lines.append('    return True')
+
+        self.__functions[position] = '\n'.join(lines)
+        return name
+
+    def __compile_keyword(self, keyword: str, argument: Any, schema: Mapping[str, Any], in_branch: bool) -> Sequence[str]:
+        if keyword in IGNORED_KEYWORDS:
+            return []
+        elif keyword == 'type':
+            types = argument if isinstance(argument, list) else [argument]
+            if any(typ not in TYPE_CHECKS for typ in types):
+                raise UnsupportedSchema(f'unsupported type {argument!r}')
+            checks = ' or '.join(TYPE_CHECKS[typ].format(value='value') for typ in types)
+            return [f'if not ({checks}):', '    return False']
+        elif keyword == 'properties':
+            return self.__compile_properties(argument, in_branch)
+        elif keyword == 'required':
+            required = self.__add_constant(sorted(argument))
+            return [
+                f'if isinstance(value, dict) and any(name not in value for name in {required}):',
+                '    return False',
+            ]
+        elif keyword == 'additionalProperties':
+            if 'patternProperties' in schema:
+                raise UnsupportedSchema('patternProperties are not supported')
+            properties = self.__add_constant(frozenset(schema.get('properties', {})))
+            if argument is True:
+                return []
+            elif argument is False:
+                return [
+                    f'if isinstance(value, dict) and any(name not in {properties} for name in value):',
+                    '    return False',
+                ]
+            function = self.__compile_schema(argument, in_branch)
+            return [
+                'if isinstance(value, dict):',
+                f'    if not all({function}(item) for name, item in value.items() if name not in {properties}):',
+                '        return False',
+            ]
+        elif keyword == 'dependencies':
+            lines = ['if isinstance(value, dict):']
+            for name, dependency in argument.items():
+                if isinstance(dependency, list):
+                    dependencies = self.__add_constant(dependency)
+                    check = f'all(dependency in value for dependency in {dependencies})'
+                else:
+                    check = f'{self.__compile_schema(dependency, in_branch)}(value)'
+                lines.extend([f'    if {name!r} in value and not {check}:', '        return False'])
+            return lines
+        elif keyword == 'anyOf' or keyword == 'allOf':
+            functions = [self.__compile_schema(subschema, True) for subschema in argument]
+            operator = ' or ' if keyword == 'anyOf' else ' and '
+            checks = operator.join(f'{function}(value)' for function in functions)
+            return [f'if not ({checks}):', '    return False']
+        elif keyword == 'items':
+            if 'additionalItems' in schema:
+                raise UnsupportedSchema('additionalItems are not supported')
+            if isinstance(argument, list):
+                lines = ['if isinstance(value, (list, tuple)):']
+                for index, subschema in enumerate(argument):
+                    function = self.__compile_schema(subschema, in_branch)
+                    lines.extend([
+                        f'    if len(value) > {index} and not {function}(value[{index}]):',
+                        '        return False',
+                    ])
+                return lines
+            function = self.__compile_schema(argument, in_branch)
+            return [
+                f'if isinstance(value, (list, tuple)) and not all({function}(item) for item in value):',
+                '    return False',
+            ]
+        elif keyword in ('minItems', 'maxItems', 'minLength', 'maxLength'):
+            check = TYPE_CHECKS['array' if keyword.endswith('Items') else 'string'].format(value='value')
+            operator = '<' if keyword.startswith('min') else '>'
+            return [f'if {check} and len(value) {operator} {int(argument)}:', '    return False']
+        elif keyword in ('minimum', 'maximum'):
+            if 'exclusiveMinimum' in schema or 'exclusiveMaximum' in schema:
+                raise UnsupportedSchema('exclusive bounds are not supported')
+            operator = '<' if keyword == 'minimum' else '>'
+            bound = self.__add_constant(argument)
+            return [
+                # Other numeric types are left to jsonschema.
+                'if isinstance(value, (int, float)) and not isinstance(value, bool):',
+                f'    if type(value) not in (int, float) or value {operator} {bound}:',
+                '        return False',
+            ]
+        elif keyword == 'enum':
+            if not all(isinstance(item, str) for item in argument):
+                raise UnsupportedSchema('only enums of strings are supported')
+            values = self.__add_constant(frozenset(argument))
+            return [f'if not (isinstance(value, str) and value in {values}):', '    return False']
+        elif keyword == 'pattern':
+            pattern = self.__add_constant(re.compile(argument))
+            return [f'if isinstance(value, str) and not {pattern}.search(value):', '    return False']
+        elif keyword == 'format':
+            fmt = self.__add_constant(argument)
+            return [f'if not format_checker.conforms(value, {fmt}):', '    return False']
+
+        raise UnsupportedSchema(f'unsupported keyword {keyword!r}')
+
+    def __compile_properties(self, properties: Mapping[str, Any], in_branch: bool) -> Sequence[str]:
+        lines = ['if not isinstance(value, dict):', '    return False']
+        if self.__set_defaults:
+            for name, subschema in properties.items():
+                if 'default' not in subschema:
+                    continue
+                if in_branch:
+                    # jsonschema sets the defaults of the branches that do
+                    # not match as well.
+                    raise UnsupportedSchema('defaults are not supported in anyOf and allOf')
+
+                default = subschema['default']
+                if callable(default):
+                    expression = f'{self.__add_constant(default)}()'
+                elif isinstance(default, IMMUTABLE_TYPES):
+                    expression = self.__add_constant(default)
+                else:
+                    expression = f'deepcopy({self.__add_constant(default)})'
+                lines.extend([f'if {name!r} not in value:', f'    value[{name!r}] = {expression}'])
+
+        for name, subschema in properties.items():
+            function = self.__compile_schema(subschema, in_branch)
+            lines.extend([f'if {name!r} in value and not {function}(value[{name!r}]):', '    return False'])
+        return lines
+
+
+def compile_schema(schema: Mapping[str, Any], set_defaults: bool = True) -> Callable[[Any], bool]:
+    """
+    Compiles a schema into a function returning whether a value is valid,
+    setting the defaults of the schema in the value, like
+    `snuba.schemas.validate_jsonschema` does.
+
+    The function may reject values jsonschema would accept, but never
+    accepts a value jsonschema would reject, so values it rejects should
+    be validated again by jsonschema to get the error. Raises
+    UnsupportedSchema for schemas using keywords that are not supported.
+    """
+    return _Compiler(schema, set_defaults).compile()
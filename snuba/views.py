@@ -1,32 +1,45 @@
+import contextvars
 import logging
 import os
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from flask import Flask, redirect, render_template, request as http_request
+from typing import Any, Mapping, MutableMapping, Sequence, Tuple
+from flask import Flask, Response, g, redirect, render_template, request as http_request
 from markdown import markdown
 from uuid import uuid1
 import sentry_sdk
 from sentry_sdk.integrations.flask import FlaskIntegration
 from sentry_sdk.integrations.gnu_backtrace import GnuBacktraceIntegration
+import msgpack
 import simplejson as json
 from werkzeug.exceptions import BadRequest
 import jsonschema
 from uuid import UUID
 
 from snuba import schemas, settings, state, util
-from snuba.api.query import QueryResult, raw_query
+from snuba.api.admission import QueryTooExpensive, admit_query, estimate_request_cost
+from snuba.api.codecs import JSONCodec, SimpleJSONCodec, get_codec, json_default
+from snuba.api.cursor import InvalidCursor, apply_cursor, get_next_cursor
+from snuba.api.query import QueryResult, raw_query, reject_query, stream_query
+from snuba.api.bucket_cache import bucket_cache
 from snuba.api.split import split_query
 from snuba.query.schema import SETTINGS_SCHEMA
+from snuba.clickhouse.estimator import PartitionStatsCache
 from snuba.clickhouse.native import ClickhousePool
-from snuba.clickhouse.query import ClickhouseQuery
+from snuba.clickhouse.prewhere import ColumnSizeCache, get_prewhere_candidates, get_table_column_sizes, plan_prewhere
+from snuba.clickhouse.query import ClickhouseQuery, format_query
+from snuba.clickhouse.query_templates import QueryTemplateCache
 from snuba.query.timeseries import TimeSeriesExtensionProcessor
+from snuba.query.types import Condition
 from snuba.datasets.dataset import Dataset
 from snuba.datasets.factory import InvalidDatasetError, enforce_table_writer, get_dataset, get_enabled_dataset_names
 from snuba.datasets.schemas.tables import TableSchema
 from snuba.request import Request
 from snuba.request.schema import RequestSchema
 from snuba.redis import redis_client
-from snuba.util import local_dataset_mode
+from snuba.state.scheduler import get_final_rate_limit_params
+from snuba.util import create_metrics, local_dataset_mode
 from snuba.utils.metrics.backends.dummy import DummyMetricsBackend
 from snuba.utils.metrics.timer import Timer
 from snuba.utils.streams.kafka import KafkaMessage, TopicPartition
@@ -36,9 +49,24 @@ logger = logging.getLogger('snuba.api')
 logging.basicConfig(level=getattr(logging, settings.LOG_LEVEL.upper()), format='%(asctime)s %(message)s')
 
 clickhouse_rw = ClickhousePool()
-clickhouse_ro = ClickhousePool(client_settings={
-    'readonly': True,
-})
+clickhouse_ro = ClickhousePool(
+    client_settings={
+        'readonly': True,
+    },
+    replicas=settings.CLICKHOUSE_REPLICAS,
+    warm_up_connections=settings.CLICKHOUSE_WARM_UP_CONNECTIONS,
+    metrics=create_metrics(settings.DOGSTATSD_HOST, settings.DOGSTATSD_PORT, 'snuba.api'),
+)
+
+query_template_cache = QueryTemplateCache(
+    format_query,
+    create_metrics(settings.DOGSTATSD_HOST, settings.DOGSTATSD_PORT, 'snuba.api'),
+    max_size=settings.QUERY_TEMPLATE_CACHE_SIZE,
+    ttl=settings.QUERY_TEMPLATE_CACHE_TTL,
+)
+
+column_size_cache = ColumnSizeCache(clickhouse_ro, refresh_interval=settings.PREWHERE_COLUMN_SIZES_REFRESH_INTERVAL)
+partition_stats_cache = PartitionStatsCache(clickhouse_ro, refresh_interval=settings.PARTITION_STATS_REFRESH_INTERVAL)
 
 
 try:
@@ -46,6 +74,9 @@ try:
 except ImportError:
     def check_down_file_exists():
         return False
+
+    def get_disconnect_check():
+        return None
 else:
     def check_down_file_exists():
         try:
@@ -53,6 +84,20 @@ else:
         except OSError:
             return False
 
+    def get_disconnect_check():
+        # The connection of the current request, checked from other threads.
+        fd = uwsgi.connection_fd()
+        return lambda: not uwsgi.is_connected(fd)
+
+if settings.CLICKHOUSE_WARM_UP_CONNECTIONS:
+    try:
+        from uwsgidecorators import postfork
+    except ImportError:
+        clickhouse_ro.start()
+    else:
+        # Connections cannot be shared with the worker processes.
+        postfork(clickhouse_ro.start)
+
 
 def check_clickhouse():
     """
@@ -85,35 +130,59 @@ sentry_sdk.init(
 )
 
 
-@application.errorhandler(BadRequest)
-def handle_bad_request(exception: BadRequest):
+@application.before_request
+def resolve_request_configs():
+    # Every runtime config lookup of a request sees the same values.
+    g.request_configs_token = state.start_request_configs()
+
+
+@application.teardown_request
+def release_request_configs(exception):
+    token = g.pop('request_configs_token', None)
+    if token is not None:
+        state.end_request_configs(token)
+
+
+def resolve_schema_defaults(value):
+    # XXX: This is necessary for rendering schema defaults values that are
+    # generated by callables, rather than constants.
+    if callable(value):
+        return value()
+    elif isinstance(value, Mapping):
+        return {key: resolve_schema_defaults(item) for key, item in value.items()}
+    elif isinstance(value, list):
+        return [resolve_schema_defaults(item) for item in value]
+    return value
+
+
+def get_bad_request_error(exception: BadRequest):
     cause = getattr(exception, '__cause__', None)
     if isinstance(cause, json.errors.JSONDecodeError):
-        data = {'error': {'type': 'json', 'message': str(cause)}}
+        return {'error': {'type': 'json', 'message': str(cause)}}
     elif isinstance(cause, jsonschema.ValidationError):
-        data = {'error': {
+        return {'error': {
             'type': 'schema',
             'message': cause.message,
             'path': list(cause.path),
-            'schema': cause.schema,
+            'schema': resolve_schema_defaults(cause.schema),
         }}
     else:
-        data = {'error': {'type': 'request', 'message': str(exception)}}
+        return {'error': {'type': 'request', 'message': str(exception)}}
 
-    def default_encode(value):
-        # XXX: This is necessary for rendering schema defaults values that are
-        # generated by callables, rather than constants.
-        if callable(value):
-            return value()
-        else:
-            raise TypeError()
 
-    return json.dumps(data, indent=4, default=default_encode), 400, {'Content-Type': 'application/json'}
+def get_invalid_dataset_error(exception: InvalidDatasetError):
+    return {'error': {'type': 'dataset', 'message': str(exception)}}
+
+
+@application.errorhandler(BadRequest)
+def handle_bad_request(exception: BadRequest):
+    data = get_bad_request_error(exception)
+    return json.dumps(data, indent=4), 400, {'Content-Type': 'application/json'}
 
 
 @application.errorhandler(InvalidDatasetError)
 def handle_invalid_dataset(exception: InvalidDatasetError):
-    data = {'error': {'type': 'dataset', 'message': str(exception)}}
+    data = get_invalid_dataset_error(exception)
     return json.dumps(data, sort_keys=True, indent=4), 404, {'Content-Type': 'application/json'}
 
 
@@ -190,13 +259,46 @@ def health():
     return (json.dumps(body), status, {'Content-Type': 'application/json'})
 
 
+def get_json_codec() -> JSONCodec:
+    return get_codec(state.get_config('api_json_codec', SimpleJSONCodec.name))
+
+
 def parse_request_body(http_request):
     try:
-        return json.loads(http_request.data)
+        return get_json_codec().loads(http_request.data)
     except json.errors.JSONDecodeError as error:
         raise BadRequest(str(error)) from error
 
 
+request_schemas: MutableMapping[Dataset, RequestSchema] = {}
+
+
+def get_request_schema(dataset: Dataset) -> RequestSchema:
+    """
+    Returns the request schema of a dataset, built once since building it
+    also compiles its validator.
+    """
+    schema = request_schemas.get(dataset)
+    if schema is None:
+        schema = request_schemas[dataset] = RequestSchema.build_with_extensions(dataset.get_extensions())
+    return schema
+
+
+for name in get_enabled_dataset_names():
+    try:
+        get_request_schema(get_dataset(name))
+    except NotImplementedError:
+        # The dataset does not support queries.
+        pass
+
+
+sdk_stats_request_schema = RequestSchema(
+    schemas.SDK_STATS_BASE_SCHEMA,
+    SETTINGS_SCHEMA,
+    schemas.SDK_STATS_EXTENSIONS_SCHEMA,
+)
+
+
 def validate_request_content(body, schema: RequestSchema, timer, dataset: Dataset) -> Request:
     source = dataset.get_dataset_schemas().get_read_schema().get_data_source()
     try:
@@ -227,7 +329,7 @@ def unqualified_query_view(*, timer: Timer):
 def dataset_query_view(*, dataset_name: str, timer: Timer):
     dataset = get_dataset(dataset_name)
     if http_request.method == 'GET':
-        schema = RequestSchema.build_with_extensions(dataset.get_extensions())
+        schema = get_request_schema(dataset)
         return render_template(
             'query.html',
             query_template=json.dumps(
@@ -242,35 +344,231 @@ def dataset_query_view(*, dataset_name: str, timer: Timer):
         assert False, 'unexpected fallthrough'
 
 
+def msgpack_default(obj):
+    if hasattr(obj, 'for_json'):
+        return obj.for_json()
+    elif isinstance(obj, (datetime, UUID)):
+        return json_default(obj)
+    raise TypeError(f'Cannot serialize object of type {type(obj).__name__}')
+
+
+def run_in_context(generator):
+    """
+    Runs a generator in a copy of the current context. The body of a
+    streamed response is generated after the request is torn down, so this
+    keeps the runtime config resolved for the request.
+    """
+    context = contextvars.copy_context()
+
+    def run():
+        try:
+            while True:
+                try:
+                    yield context.run(next, generator)
+                except StopIteration:
+                    return
+        finally:
+            context.run(generator.close)
+
+    return run()
+
+
+def stream_json_result(result, codec: JSONCodec):
+    """
+    Encodes a streamed result into the same document as the json format, one
+    block of rows at a time. Everything that is only known once all the rows
+    have been received is written after the data.
+    """
+    blocks = result['data']
+    try:
+        yield '{"meta": %s, "data": [' % codec.dumps(result['meta'])
+        separator = ''
+        for block in blocks:
+            if block:
+                yield separator + codec.dumps(block)[1:-1]
+                separator = ', '
+    finally:
+        blocks.close()
+
+    trailer = codec.dumps({k: v for k, v in result.items() if k not in ('meta', 'data')})
+    yield ']}' if trailer == '{}' else '], ' + trailer[1:]
+
+
+def format_query_result(query_result: QueryResult, result_format: str):
+    if result_format == 'json_stream' and query_result.status == 200:
+        return Response(
+            run_in_context(stream_json_result(query_result.result, get_json_codec())),
+            query_result.status,
+            mimetype='application/json',
+        )
+    elif result_format == 'msgpack':
+        return (
+            msgpack.packb(query_result.result, default=msgpack_default, use_bin_type=True),
+            query_result.status,
+            {'Content-Type': 'application/x-msgpack'}
+        )
+
+    return (
+        get_json_codec().dumps(query_result.result),
+        query_result.status,
+        {'Content-Type': 'application/json'}
+    )
+
+
 def dataset_query(dataset, body, timer):
     assert http_request.method == 'POST'
+    request, query_result = run_dataset_query(
+        dataset, body, timer, http_request.referrer, get_request_disconnect_check()
+    )
+    return format_query_result(query_result, request.settings.get_format())
+
+
+def get_request_disconnect_check():
+    if not state.get_config('cancel_disconnected_queries', 0):
+        return None
+    return get_disconnect_check()
+
+
+def run_dataset_query(dataset, body, timer, referrer, disconnect_check=None) -> Tuple[Request, QueryResult]:
+    """
+    Runs a query request. This does not depend on the HTTP request, so
+    the queries of a batch can run in other threads.
+    """
     ensure_table_exists(dataset)
 
-    schema = RequestSchema.build_with_extensions(dataset.get_extensions())
-    query_result = parse_and_run_query(
-        dataset,
-        validate_request_content(body, schema, timer, dataset),
-        timer,
-    )
+    request = validate_request_content(body, get_request_schema(dataset), timer, dataset)
+    request.settings.add_stat('referrer', referrer)
+    if disconnect_check is not None:
+        request.settings.set_disconnect_check(disconnect_check)
+    try:
+        apply_cursor(dataset, request)
+    except InvalidCursor as error:
+        raise BadRequest(str(error)) from error
+
+    # Running the query may change the request, the next cursor depends on
+    # the limit and order the client asked for.
+    cursor_request = request.copy()
+    query_result = parse_and_run_query(dataset, request, timer)
+    if query_result.status == 200 and request.settings.get_format() == 'json':
+        cursor = get_next_cursor(dataset, cursor_request, query_result.result)
+        if cursor is not None:
+            query_result.result['cursor'] = cursor
+
+    return request, query_result
+
+
+BATCH_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        # Query request bodies, with their dataset.
+        'queries': {
+            'type': 'array',
+            'items': {'type': 'object'},
+            'minItems': 1,
+            'maxItems': settings.BATCH_MAX_QUERIES,
+        },
+    },
+    'required': ['queries'],
+    'additionalProperties': False,
+}
+
+batch_executor = ThreadPoolExecutor(max_workers=settings.BATCH_QUERY_THREADS)
+
+
+@application.route('/batch', methods=['POST'])
+@util.time_request('batch')
+def batch_query_view(*, timer: Timer):
+    """
+    Runs several queries, possibly on different datasets, concurrently.
+    The response holds the status and result of every query, in the order
+    of the queries of the request.
+    """
+    body = parse_request_body(http_request)
+    try:
+        body = schemas.validate_jsonschema(body, BATCH_SCHEMA)
+    except jsonschema.ValidationError as error:
+        raise BadRequest(str(error)) from error
 
-    def json_default(obj):
-        if isinstance(obj, datetime):
-            return obj.isoformat()
-        elif isinstance(obj, UUID):
-            return str(obj)
-        return obj
+    # This resolves the runtime config of the request, which is shared
+    # with every query of the batch.
+    disconnect_check = get_request_disconnect_check()
+
+    futures = []
+    for query_body in body['queries']:
+        context = contextvars.copy_context()
+        futures.append(batch_executor.submit(
+            context.run,
+            run_batch_query,
+            query_body,
+            http_request.referrer,
+            disconnect_check,
+        ))
+    results = [future.result() for future in futures]
+    timer.mark('execute')
 
     return (
-        json.dumps(
-            query_result.result,
-            for_json=True,
-            default=json_default),
-        query_result.status,
-        {'Content-Type': 'application/json'}
+        get_json_codec().dumps({'results': results, 'timing': timer}),
+        200,
+        {'Content-Type': 'application/json'},
     )
 
 
+def run_batch_query(body, referrer, disconnect_check) -> Mapping[str, Any]:
+    timer = Timer('query')
+    try:
+        if body.get('format') == 'json_stream':
+            raise BadRequest('results cannot be streamed in a batch')
+        dataset = get_dataset(body.pop('dataset', settings.DEFAULT_DATASET_NAME))
+        _, query_result = run_dataset_query(dataset, body, timer, referrer, disconnect_check)
+    except BadRequest as error:
+        return {'status': 400, 'result': get_bad_request_error(error)}
+    except InvalidDatasetError as error:
+        return {'status': 404, 'result': get_invalid_dataset_error(error)}
+    except Exception as error:
+        logger.exception(error)
+        return {'status': 500, 'result': {'error': {'type': 'unknown', 'message': str(error)}}}
+
+    return {'status': query_result.status, 'result': query_result.result}
+
+
+def apply_query_processors(dataset, request: Request) -> Sequence[Condition]:
+    """
+    Runs the query processors of the dataset, then moves the conditions
+    to evaluate in PREWHERE out of the query and returns them.
+
+    Processors may change the table the query reads from depending on the
+    conditions of the query, so they run before any condition is moved.
+    """
+    for processor in dataset.get_query_processors():
+        processor.process_query(request.query, request.settings)
+
+    use_prewhere_planner, max_prewhere_conditions = state.get_configs([
+        ('use_prewhere_planner', 0),
+        ('max_prewhere_conditions', settings.MAX_PREWHERE_CONDITIONS),
+    ])
+    if use_prewhere_planner:
+        prewhere_conditions = plan_prewhere(
+            dataset,
+            request.query,
+            get_table_column_sizes(dataset, column_size_cache),
+            max_prewhere_conditions,
+        )
+    else:
+        # Use the conditions that have the highest priority (based on the
+        # position of their columns in the prewhere keys list)
+        prewhere_conditions = [
+            cond for _, cond in get_prewhere_candidates(dataset, request.query)
+        ][:settings.MAX_PREWHERE_CONDITIONS]
+    if prewhere_conditions:
+        request.query.set_conditions(
+            list(filter(lambda cond: cond not in prewhere_conditions, request.query.get_conditions()))
+        )
+
+    return prewhere_conditions
+
+
 @split_query
+@bucket_cache
 def parse_and_run_query(dataset, request: Request, timer) -> QueryResult:
     from_date, to_date = TimeSeriesExtensionProcessor.get_time_limit(request.extensions['timeseries'])
 
@@ -287,47 +585,61 @@ def parse_and_run_query(dataset, request: Request, timer) -> QueryResult:
     if request.settings.get_turbo():
         request.query.set_final(False)
 
-    prewhere_conditions = []
-    # Add any condition to PREWHERE if:
-    # - It is a single top-level condition (not OR-nested), and
-    # - Any of its referenced columns are in dataset.get_prewhere_keys()
-    prewhere_candidates = [
-        (util.columns_in_expr(cond[0]), cond)
-        for cond in request.query.get_conditions() if util.is_condition(cond) and
-        any(col in dataset.get_prewhere_keys() for col in util.columns_in_expr(cond[0]))
-    ]
-    # Use the condition that has the highest priority (based on the
-    # position of its columns in the prewhere keys list)
-    prewhere_candidates = sorted([
-        (min(dataset.get_prewhere_keys().index(col) for col in cols if col in dataset.get_prewhere_keys()), cond)
-        for cols, cond in prewhere_candidates
-    ], key=lambda priority_and_col: priority_and_col[0])
-    if prewhere_candidates:
-        prewhere_conditions = [cond for _, cond in prewhere_candidates][:settings.MAX_PREWHERE_CONDITIONS]
-        request.query.set_conditions(
-            list(filter(lambda cond: cond not in prewhere_conditions, request.query.get_conditions()))
-        )
-
-    for processor in dataset.get_query_processors():
-        processor.process_query(request.query, request.settings)
+    prewhere_conditions = apply_query_processors(dataset, request)
 
     relational_source = request.query.get_data_source()
     request.query.add_conditions(relational_source.get_mandatory_conditions())
 
+    cost_stats = {}
+    cost_error = None
+    if state.get_config('estimate_query_cost', 0):
+        estimate = estimate_request_cost(
+            dataset, request, from_date, to_date, partition_stats_cache, column_size_cache
+        )
+        if estimate is not None:
+            try:
+                admit_query(dataset, request, estimate, cost_stats)
+            except QueryTooExpensive as ex:
+                cost_error = ex
+        timer.mark('estimate_cost')
+
+    if request.query.get_final():
+        final_rate_limit = get_final_rate_limit_params()
+        if final_rate_limit is not None:
+            request.settings.add_rate_limit(final_rate_limit)
+
     source = relational_source.format_from()
     # TODO: consider moving the performance logic and the pre_where generation into
     # ClickhouseQuery since they are Clickhouse specific
-    query = ClickhouseQuery(dataset, request.query, request.settings, prewhere_conditions)
+    use_query_templates = state.get_config('use_query_templates', 0)
+    query = ClickhouseQuery(
+        dataset,
+        request.query,
+        request.settings,
+        prewhere_conditions,
+        template_cache=query_template_cache if use_query_templates else None,
+    )
     timer.mark('prepare_query')
 
     stats = {
         'clickhouse_table': source,
         'final': request.query.get_final(),
-        'referrer': http_request.referrer,
         'num_days': (to_date - from_date).days,
         'sample': request.query.get_sample(),
+        **request.settings.get_stats(),
+        **cost_stats,
     }
 
+    if cost_error is not None:
+        return reject_query(request, timer, stats, {
+            'type': 'query-cost',
+            'message': 'query too expensive',
+            'detail': str(cost_error),
+        }, 400)
+
+    if request.settings.get_format() == 'json_stream':
+        return stream_query(request, query, clickhouse_ro, timer, stats)
+
     return raw_query(request, query, clickhouse_ro, timer, stats)
 
 
@@ -340,14 +652,11 @@ def sdk_distribution(*, timer: Timer):
     dataset = get_dataset('events')
     request = validate_request_content(
         parse_request_body(http_request),
-        RequestSchema(
-            schemas.SDK_STATS_BASE_SCHEMA,
-            SETTINGS_SCHEMA,
-            schemas.SDK_STATS_EXTENSIONS_SCHEMA,
-        ),
+        sdk_stats_request_schema,
         timer,
         dataset,
     )
+    request.settings.add_stat('referrer', http_request.referrer)
 
     request.query.set_aggregations([
         ['uniq', 'project_id', 'projects'],
@@ -361,14 +670,7 @@ def sdk_distribution(*, timer: Timer):
     ensure_table_exists(dataset)
 
     query_result = parse_and_run_query(dataset, request, timer)
-    return (
-        json.dumps(
-            query_result.result,
-            for_json=True,
-            default=lambda obj: obj.isoformat() if isinstance(obj, datetime) else obj),
-        query_result.status,
-        {'Content-Type': 'application/json'}
-    )
+    return format_query_result(query_result, request.settings.get_format())
 
 
 @application.route('/subscriptions', methods=['POST'])
@@ -0,0 +1,100 @@
+from typing import Any, Mapping
+
+from snuba.clickhouse.prewhere import ColumnSizeCache, get_column_size, plan_prewhere
+from snuba.datasets.factory import get_dataset
+from snuba.query.query import Query
+
+
+COLUMN_SIZES = {
+    'event_id': 1000,
+    'project_id': 10,
+    'timestamp': 100,
+    'message': 50000,
+    'environment': 50,
+    'tags.key': 2000,
+    'tags.value': 8000,
+}
+
+
+def build_query(body: Mapping[str, Any]) -> Query:
+    dataset = get_dataset('events')
+    return Query(
+        {
+            'selected_columns': ['event_id', 'message', 'tags[sentry:release]'],
+            'aggregations': [],
+            'groupby': [],
+            'limit': 100,
+            'offset': 0,
+            **body,
+        },
+        dataset.get_dataset_schemas().get_read_schema().get_data_source(),
+    )
+
+
+def test_column_size():
+    assert get_column_size('message', COLUMN_SIZES, 1) == 50000
+    assert get_column_size('tags[sentry:release]', COLUMN_SIZES, 1) == 10000
+    assert get_column_size('contexts[device.name]', COLUMN_SIZES, 1) == 1
+
+
+def test_plan_prewhere():
+    dataset = get_dataset('events')
+
+    # A selective condition on a small column beats the first prewhere key.
+    query = build_query({'conditions': [
+        ['event_id', '!=', 'a' * 32],
+        ['environment', '=', 'prod'],
+    ]})
+    assert plan_prewhere(dataset, query, COLUMN_SIZES, 1) == [['environment', '=', 'prod']]
+
+    # Matching a large column is not worth reading it first.
+    query = build_query({'conditions': [
+        ['message', 'LIKE', '%error%'],
+        ['event_id', '=', 'a' * 32],
+    ]})
+    assert plan_prewhere(dataset, query, COLUMN_SIZES, 1) == [['event_id', '=', 'a' * 32]]
+
+    # More conditions are only added while they reduce the data read.
+    query = build_query({'conditions': [
+        ['environment', '=', 'prod'],
+        ['project_id', 'IN', [1, 2]],
+        ['message', 'NOT LIKE', '%error%'],
+    ]})
+    assert plan_prewhere(dataset, query, COLUMN_SIZES, 3) == [
+        ['environment', '=', 'prod'],
+        ['project_id', 'IN', [1, 2]],
+    ]
+
+    # Without column sizes the plan only depends on the operators.
+    query = build_query({'conditions': [
+        ['message', 'LIKE', '%error%'],
+        ['event_id', '=', 'a' * 32],
+    ]})
+    assert plan_prewhere(dataset, query, {}, 1) == [['event_id', '=', 'a' * 32]]
+
+
+class FakeClickhousePool:
+    def __init__(self) -> None:
+        self.queries = []
+
+    def execute(self, sql, params):
+        self.queries.append(sql)
+        if 'system.columns' in sql:
+            return [('event_id', 0), ('message', 0)]
+        return [('event_id', 10), ('message', 20)]
+
+
+def test_column_size_cache():
+    clickhouse = FakeClickhousePool()
+    cache = ColumnSizeCache(clickhouse, refresh_interval=3600)
+
+    # Sizes are read from the parts when the columns do not report them.
+    assert cache.get_column_sizes('sentry_local') == {'event_id': 10, 'message': 20}
+    assert cache.get_column_sizes('sentry_local') == {'event_id': 10, 'message': 20}
+    assert len(clickhouse.queries) == 2
+
+    # Refreshing reloads the tables already requested, off the request path.
+    cache.refresh()
+    assert len(clickhouse.queries) == 4
+    assert cache.get_column_sizes('sentry_local') == {'event_id': 10, 'message': 20}
+    assert len(clickhouse.queries) == 4
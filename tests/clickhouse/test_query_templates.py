@@ -0,0 +1,93 @@
+from typing import Any, Mapping
+
+from snuba.clickhouse.query import format_query
+from snuba.clickhouse.query_templates import QueryTemplateCache
+from snuba.datasets.factory import get_dataset
+from snuba.query.query import Query
+from snuba.request.request_settings import RequestSettings
+from tests.backends.metrics import Increment, TestingMetricsBackend
+
+
+def build_query(body: Mapping[str, Any]) -> Query:
+    dataset = get_dataset('events')
+    return Query(
+        {
+            'selected_columns': ['event_id', 'tags[sentry:release]'],
+            'aggregations': [],
+            'groupby': [],
+            'orderby': '-timestamp',
+            'limit': 100,
+            'offset': 0,
+            **body,
+        },
+        dataset.get_dataset_schemas().get_read_schema().get_data_source(),
+    )
+
+
+def test_template_matches_formatter():
+    dataset = get_dataset('events')
+    settings = RequestSettings(turbo=False, consistent=False, debug=False)
+    metrics = TestingMetricsBackend()
+    cache = QueryTemplateCache(format_query, metrics)
+
+    bodies = [
+        {'conditions': [
+            ['project_id', 'IN', [1, 2]],
+            ['timestamp', '>=', '2019-09-19T10:00:00'],
+            [['environment', '=', 'prod'], ['tags[foo]', 'LIKE', '%bar%']],
+        ]},
+        {'conditions': [
+            ['project_id', 'IN', [3]],
+            ['timestamp', '>=', '2019-09-20T11:00:00'],
+            [['environment', '=', 'dev'], ['tags[foo]', 'LIKE', "%b'az%"]],
+        ]},
+        # The same literal twice is deduplicated by the formatter.
+        {'conditions': [
+            ['environment', '=', 'prod'],
+            ['environment', '=', 'prod'],
+            [['environment', '=', 'dev'], ['tags[foo]', 'LIKE', 'x']],
+        ]},
+        {'conditions': [
+            ['environment', '=', 'prod'],
+            ['environment', '=', 'dev'],
+            [['environment', '=', 'dev'], ['tags[foo]', 'LIKE', 'x']],
+        ]},
+        # Array columns generate a different expression for scalar literals.
+        {'conditions': [['exception_frames.filename', 'LIKE', '%foo%']]},
+        {'conditions': [['exception_frames.filename', 'LIKE', '%bar%']]},
+    ]
+
+    for body in bodies:
+        for prewhere in ([], [['event_id', '=', 'a' * 32]], [['event_id', '=', 'b' * 32]]):
+            query = build_query(body)
+            expected = format_query(dataset, query, settings, prewhere)
+            assert cache.format_sql(dataset, build_query(body), settings, prewhere) == expected
+
+    assert Increment('query_template_cache.hit', 1, None) in metrics.calls
+    assert Increment('query_template_cache.miss', 1, None) in metrics.calls
+
+
+def test_lru_eviction():
+    dataset = get_dataset('events')
+    settings = RequestSettings(turbo=False, consistent=False, debug=False)
+    metrics = TestingMetricsBackend()
+    cache = QueryTemplateCache(format_query, metrics, max_size=1)
+
+    def run(limit: int) -> None:
+        query = build_query({
+            'conditions': [['project_id', '=', 1]],
+            'limit': limit,
+        })
+        cache.format_sql(dataset, query, settings, [])
+
+    run(10)
+    run(10)
+    run(20)
+    run(10)
+
+    assert [call.name for call in metrics.calls] == [
+        'query_template_cache.miss',
+        'query_template_cache.hit',
+        'query_template_cache.miss',
+        'query_template_cache.miss',
+    ]
@@ -0,0 +1,172 @@
+import pytest
+import time
+
+from datetime import datetime
+from typing import Any, Mapping
+
+from snuba import replacer, rollup, state
+from snuba.datasets.factory import get_dataset
+from snuba.query.processors.rollup import RollupProcessor
+from snuba.query.query import Query
+from snuba.redis import redis_client
+from snuba.request import Request
+from snuba.request.request_settings import RequestSettings
+
+# 2019-09-01T00:00:00
+ROLLUP_START = 1567296000
+
+
+def build_query(body: Mapping[str, Any]) -> Query:
+    dataset = get_dataset('events')
+    return Query(
+        {
+            'selected_columns': [],
+            'aggregations': [
+                ['count()', '', 'count'],
+                ['uniq', 'tags[sentry:user]', 'users'],
+            ],
+            'groupby': ['issue', 'time'],
+            'conditions': [
+                ('project_id', 'IN', [1, 2]),
+                ('timestamp', '>=', '2019-10-01T00:00:00'),
+                ('timestamp', '<', '2019-10-02T00:00:00'),
+            ],
+            'orderby': '-count',
+            'granularity': 3600,
+            'limit': 100,
+            'offset': 0,
+            **body,
+        },
+        dataset.get_dataset_schemas().get_read_schema().get_data_source(),
+    )
+
+
+def process(query: Query, turbo: bool = False) -> RequestSettings:
+    request_settings = RequestSettings(turbo=turbo, consistent=False, debug=False)
+    processor, = get_dataset('events').get_query_processors()
+    assert isinstance(processor, RollupProcessor)
+    processor.process_query(query, request_settings)
+    return request_settings
+
+
+def setup_function(function) -> None:
+    redis_client.flushdb()
+    state.set_config('events_rollup_start', ROLLUP_START)
+
+
+def test_routes_to_rollup() -> None:
+    query = build_query({})
+    request_settings = process(query)
+
+    assert request_settings.get_stats() == {'rollup': 'routed'}
+    assert query.get_data_source().format_from() == 'test_sentry_rollup_hourly_local'
+    assert query.get_data_source().get_mandatory_conditions() == []
+    assert query.get_aggregations() == [
+        ['countMerge', 'times_seen', 'count'],
+        ['uniqMerge', 'users', 'users'],
+    ]
+
+
+@pytest.mark.parametrize('body, reason', [
+    ({'aggregations': [['max', 'received', 'last_seen']]}, 'aggregation'),
+    ({'groupby': ['environment']}, 'column'),
+    ({'granularity': 60}, 'granularity'),
+    ({'conditions': [
+        ('project_id', 'IN', [1, 2]),
+        ('timestamp', '>=', '2019-10-01T00:30:00'),
+    ]}, 'time_range'),
+    ({'conditions': [
+        ('project_id', 'IN', [1, 2]),
+        ('timestamp', '>=', '2019-08-01T00:00:00'),
+    ]}, 'time_range'),
+    ({'conditions': [
+        ('project_id', 'IN', [1, 2]),
+        ('timestamp', '>=', '2019-10-01T00:00:00'),
+        [('message', 'LIKE', '%error%'), ('issue', '=', 1)],
+    ]}, 'condition'),
+    ({'conditions': [
+        ('timestamp', '>=', '2019-10-01T00:00:00'),
+        [('project_id', '=', 1), ('issue', '=', 1)],
+    ]}, 'project'),
+    ({'orderby': 'environment'}, 'orderby'),
+    ({'sample': 0.1}, 'sample'),
+])
+def test_skips_rollup(body: Mapping[str, Any], reason: str) -> None:
+    query = build_query(body)
+    request_settings = process(query)
+
+    assert request_settings.get_stats() == {'rollup': reason}
+    assert query.get_data_source().format_from() == 'test_sentry_local'
+    assert query.get_aggregations() == build_query(body).get_aggregations()
+
+
+def test_rollup_disabled() -> None:
+    state.delete_config('events_rollup_start')
+    query = build_query({})
+    assert process(query).get_stats() == {'rollup': 'disabled'}
+
+    state.set_config('events_rollup_start', ROLLUP_START)
+    query = build_query({})
+    query.set_final(True)
+    assert process(query).get_stats() == {'rollup': 'final'}
+    assert process(build_query({}), turbo=True).get_stats() == {'rollup': 'sample'}
+
+
+def test_skips_replaced_projects() -> None:
+    replacer.set_project_replaced(2)
+    query = build_query({})
+    assert process(query).get_stats() == {'rollup': 'replaced'}
+    assert query.get_data_source().format_from() == 'test_sentry_local'
+
+    query = build_query({'conditions': [
+        ('project_id', '=', 1),
+        ('timestamp', '>=', '2019-10-01T00:00:00'),
+    ]})
+    assert process(query).get_stats() == {'rollup': 'routed'}
+
+    # Once the rollup is rebuilt, projects replaced before are only kept
+    # off it for the time range that was not rebuilt.
+    rollup.set_rollup_rebuilt('test_sentry_rollup_hourly_local', time.time(), datetime(2019, 10, 7))
+    for conditions, reason in [
+        ([('timestamp', '<', '2019-10-07T00:00:00')], 'routed'),
+        ([('timestamp', '<', '2019-10-07T01:00:00')], 'replaced'),
+        ([], 'replaced'),
+    ]:
+        query = build_query({'conditions': [
+            ('project_id', 'IN', [1, 2]),
+            ('timestamp', '>=', '2019-10-01T00:00:00'),
+            *conditions,
+        ]})
+        assert process(query).get_stats() == {'rollup': reason}
+
+    replacer.set_project_replaced(2)
+    query = build_query({'conditions': [
+        ('project_id', 'IN', [1, 2]),
+        ('timestamp', '>=', '2019-10-01T00:00:00'),
+        ('timestamp', '<', '2019-10-02T00:00:00'),
+    ]})
+    assert process(query).get_stats() == {'rollup': 'replaced'}
+
+
+def test_processors_run_before_prewhere() -> None:
+    from snuba.views import apply_query_processors
+
+    # The message condition is picked for PREWHERE, the rollup still has
+    # to see it to keep the query on the events table.
+    message_condition = ('message', 'LIKE', '%error%')
+    query = build_query({'conditions': [
+        ('project_id', 'IN', [1, 2]),
+        ('timestamp', '>=', '2019-10-01T00:00:00'),
+        message_condition,
+    ]})
+    request = Request(query, RequestSettings(turbo=False, consistent=False, debug=False), {})
+    assert apply_query_processors(get_dataset('events'), request) == [message_condition]
+    assert request.settings.get_stats() == {'rollup': 'condition'}
+    assert query.get_data_source().format_from() == 'test_sentry_local'
+    assert message_condition not in query.get_conditions()
+
+    query = build_query({})
+    request = Request(query, RequestSettings(turbo=False, consistent=False, debug=False), {})
+    assert apply_query_processors(get_dataset('events'), request) == [('project_id', 'IN', [1, 2])]
+    assert request.settings.get_stats() == {'rollup': 'routed'}
+    assert query.get_data_source().format_from() == 'test_sentry_rollup_hourly_local'
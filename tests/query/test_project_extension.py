@@ -11,6 +11,17 @@ from snuba.query.types import Condition
 from snuba.request.request_settings import RequestSettings
 from snuba.schemas import validate_jsonschema
 
+
+def teardown_function(function):
+    for key in [
+        'rate_limit_all_projects',
+        'project_per_second_limit_2',
+        'project_concurrent_limit_2',
+        'project_concurrent_limit_3',
+    ]:
+        state.delete_config(key)
+
+
 project_extension_test_data = [
     (
         {
@@ -107,6 +118,31 @@ def test_project_extension_project_rate_limits_are_overridden():
     assert most_recent_rate_limit.concurrent_limit == 10
 
 
+def test_project_extension_rate_limits_all_projects():
+    extension = ProjectExtension(
+        processor=ProjectExtensionProcessor(project_column="project_id")
+    )
+    raw_data = {
+        'project': [2, 3]
+    }
+    valid_data = validate_jsonschema(raw_data, extension.get_schema())
+    query = Query(
+        {
+            "conditions": []
+        },
+        TableSource("my_table", ColumnSet([])),
+    )
+    request_settings = RequestSettings(turbo=False, consistent=False, debug=False)
+    state.set_config('rate_limit_all_projects', 1)
+    state.set_config('project_concurrent_limit_3', 10)
+
+    num_rate_limits_before_processing = len(request_settings.get_rate_limit_params())
+    extension.get_processor().process_query(query, valid_data, request_settings)
+
+    rate_limits = request_settings.get_rate_limit_params()[num_rate_limits_before_processing:]
+    assert [(r.bucket, r.concurrent_limit) for r in rate_limits] == [('2', 1000), ('3', 10)]
+
+
 class TestProjectExtensionWithGroups(BaseTest):
     def setup_method(self, test_method):
         super().setup_method(test_method)
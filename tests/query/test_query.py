@@ -1,3 +1,6 @@
+import copy
+import pytest
+
 from snuba.clickhouse.columns import ColumnSet
 from snuba.datasets.factory import get_dataset
 from snuba.datasets.schemas.tables import TableSource
@@ -174,3 +177,103 @@ def test_referenced_columns():
     }
     query = Query(body, source)
     assert query.get_all_referenced_columns() == set(['tags_key', 'tags_value', 'time', 'issue', 'c', 'd'])
+
+
+def test_copy_query():
+    conditions = [["c1", "IN", list(range(1000))]]
+    query = Query(
+        {
+            "selected_columns": ["c1", "c2"],
+            "conditions": conditions,
+            "groupby": ["project_id"],
+            "limit": 100,
+        },
+        TableSource("my_table", ColumnSet([])),
+    )
+    query.set_final(True)
+
+    copied = query.copy()
+    assert copied.get_final() is True
+    assert copied.get_data_source() is query.get_data_source()
+    # The values of the body are shared until they are replaced.
+    assert copied.get_conditions() is conditions
+
+    copied.add_conditions([["c2", "=", "a"]])
+    copied.add_groupby(["c2"])
+    copied.set_selected_columns(["c3"])
+    copied.set_limit(10)
+    copied.set_final(False)
+
+    assert query.get_conditions() is conditions
+    assert conditions == [["c1", "IN", list(range(1000))]]
+    assert query.get_groupby() == ["project_id"]
+    assert query.get_selected_columns() == ["c1", "c2"]
+    assert query.get_limit() == 100
+    assert query.get_final() is True
+
+    assert copied.get_conditions() == conditions + [["c2", "=", "a"]]
+    assert copied.get_groupby() == ["project_id", "c2"]
+
+
+copy_mutations = [
+    lambda query: query.set_data_source(TableSource("other_table", ColumnSet([]))),
+    lambda query: query.set_selected_columns(["c3"]),
+    lambda query: query.set_aggregations([["count()", "", "count"]]),
+    lambda query: query.set_groupby(["c3"]),
+    lambda query: query.add_groupby(["c3"]),
+    lambda query: query.set_conditions([["c3", "=", "b"]]),
+    lambda query: query.add_conditions([["c3", "=", "b"]]),
+    lambda query: query.set_arrayjoin("c3"),
+    lambda query: query.set_orderby(["-c3"]),
+    lambda query: query.set_sample(0.5),
+    lambda query: query.set_limit(10),
+    lambda query: query.set_offset(10),
+    lambda query: query.set_final(False),
+    lambda query: query.set_granularity(60),
+]
+
+
+@pytest.mark.parametrize("mutate", copy_mutations)
+def test_copy_query_setters(mutate) -> None:
+    query = Query(
+        {
+            "selected_columns": ["c1", "c2"],
+            "aggregations": [["uniq", "c1", "uniq_c1"]],
+            "conditions": [["c1", "IN", [1, 2, 3]]],
+            "groupby": ["project_id"],
+            "arrayjoin": "c2",
+            "orderby": ["-timestamp"],
+            "sample": 10,
+            "limit": 100,
+            "offset": 5,
+            "granularity": 3600,
+        },
+        TableSource("my_table", ColumnSet([])),
+    )
+    query.set_final(True)
+
+    def get_state(query):
+        return (
+            query.get_data_source(),
+            query.get_selected_columns(),
+            query.get_aggregations(),
+            query.get_groupby(),
+            query.get_conditions(),
+            query.get_arrayjoin(),
+            query.get_orderby(),
+            query.get_sample(),
+            query.get_limit(),
+            query.get_offset(),
+            query.get_final(),
+            query.get_granularity(),
+        )
+
+    before = copy.deepcopy(get_state(query)[1:])
+    data_source = query.get_data_source()
+
+    copied = query.copy()
+    mutate(copied)
+
+    assert get_state(copied) != get_state(query)
+    assert query.get_data_source() is data_source
+    assert get_state(query)[1:] == before
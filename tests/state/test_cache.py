@@ -0,0 +1,44 @@
+import pytest
+
+from snuba.state import cache
+
+
+RESULT = {
+    'meta': [{'name': 'project_id', 'type': 'UInt64'}, {'name': 'message', 'type': 'String'}],
+    'data': [{'project_id': i, 'message': 'a message ¯\\_(ツ)_/¯'} for i in range(100)],
+    'totals': {'project_id': None, 'message': ''},
+}
+
+
+@pytest.mark.parametrize('codec', [
+    cache.JSONCodec(),
+    cache.MsgpackCodec(),
+    cache.MsgpackCodec(compression_threshold=0),
+])
+def test_roundtrip(codec: cache.ResultCodec):
+    value = codec.encode(RESULT)
+    decoded_codec, result = cache.decode(value)
+    assert decoded_codec.name == codec.name
+    assert result == RESULT
+
+
+def test_compression_threshold():
+    uncompressed = cache.MsgpackCodec(compression_threshold=1 << 30)
+    compressed = cache.MsgpackCodec(compression_threshold=0)
+    assert uncompressed.encode(RESULT)[2] == cache.COMPRESSION_NONE
+    assert compressed.encode(RESULT)[2] == cache.COMPRESSION_LZ4
+    assert len(compressed.encode(RESULT)) < len(uncompressed.encode(RESULT))
+
+
+def test_unsupported_version():
+    value = bytearray(cache.MsgpackCodec().encode(RESULT))
+    value[1] = cache.FORMAT_VERSION + 1
+    with pytest.raises(cache.InvalidCacheEntry):
+        cache.decode(bytes(value))
+
+
+def test_get_codec():
+    assert isinstance(cache.get_codec('msgpack'), cache.MsgpackCodec)
+    assert isinstance(cache.get_codec('json'), cache.JSONCodec)
+    # Unknown codecs fall back to JSON rather than failing the query.
+    assert isinstance(cache.get_codec('msgpak'), cache.JSONCodec)
@@ -109,6 +109,35 @@ class TestRateLimit(BaseTest):
             with RateLimitAggregator([rate_limit_params_outer, rate_limit_params_inner]):
                 pass
 
+    def test_aggregator_is_atomic(self):
+        project_params = RateLimitParameters('project', 'atomic-project', None, 1)
+        global_params = RateLimitParameters('global', 'atomic-global', None, 1)
+
+        with RateLimitAggregator([global_params]):
+            # The project bucket is not counted when the global one rejects.
+            with pytest.raises(RateLimitExceeded, match='global concurrent of 2 exceeds limit of 1'):
+                with RateLimitAggregator([project_params, global_params]):
+                    pass
+            assert state.get_concurrent('atomic-project') == 0
+
+        with RateLimitAggregator([project_params, global_params]) as stats:
+            assert stats.get_stats('project') == RateLimitStats(rate=0, concurrent=1)
+            assert stats.get_stats('global').concurrent == 1
+
+        # Released queries count towards the rate of every bucket.
+        assert state.get_concurrent('atomic-project') == 0
+        assert state.get_concurrent('atomic-global') == 0
+        with RateLimitAggregator([project_params]) as stats:
+            assert stats.get_stats('project').rate == 1 / state.rate_lookback_s
+
+    def test_aggregator_reports_most_loaded_bucket(self):
+        project2_params = RateLimitParameters('project', 'loaded-2', None, None)
+        project3_params = RateLimitParameters('project', 'loaded-3', None, None)
+
+        with RateLimitAggregator([project3_params]):
+            with RateLimitAggregator([project2_params, project3_params]) as stats:
+                assert stats.get_stats('project').concurrent == 2
+
     def test_rate_limit_container(self):
         rate_limit_container = RateLimitStatsContainer()
         rate_limit_stats = RateLimitStats(rate=0.5, concurrent=2)
@@ -122,3 +151,19 @@ class TestRateLimit(BaseTest):
             'foo_rate': 0.5,
             'foo_concurrent': 2
         }
+
+
+class TestCounterRateLimit(TestRateLimit):
+    def setup_method(self, test_method):
+        super().setup_method(test_method)
+        state.set_config('rate_limit_backend', 'counter')
+
+    def test_dashboard_stats(self):
+        rate_limit_params = RateLimitParameters('foo', 'dashboard', None, None)
+        with rate_limit(rate_limit_params):
+            assert state.get_concurrent('dashboard') == 1
+        assert state.get_concurrent('dashboard') == 0
+
+        rates = state.get_rates('dashboard')
+        assert len(rates) == 59
+        assert sum(rates) * 60 == 1
@@ -0,0 +1,41 @@
+import time
+from unittest.mock import call, patch
+
+from snuba import state
+from snuba.state.recorder import QueryRecorder
+from tests.base import BaseTest
+
+
+class TestQueryRecorder(BaseTest):
+    def test_records_batches(self):
+        recorder = QueryRecorder(max_queue_size=100, batch_size=5, flush_interval=0.1)
+        batches = []
+        with patch.object(state, 'record_queries', batches.append):
+            for i in range(12):
+                recorder.record({'sql': str(i)})
+
+            deadline = time.time() + 5
+            while sum(len(batch) for batch in batches) < 12 and time.time() < deadline:
+                time.sleep(0.01)
+
+        recorded = [data['sql'] for batch in batches for data in batch]
+        assert recorded == [str(i) for i in range(12)]
+        assert all(len(batch) <= 5 for batch in batches)
+
+    def test_drops_on_overflow(self):
+        recorder = QueryRecorder(max_queue_size=10, batch_size=5, flush_interval=0.1)
+        # Nothing is flushed until the queue is full.
+        with patch.object(QueryRecorder, '_QueryRecorder__start'), \
+                patch.object(state.metrics, 'increment') as increment:
+            for i in range(12):
+                recorder.record({'sql': str(i)})
+
+        assert increment.call_args_list == [call('query_recorder.dropped')] * 2
+
+    def test_sampling(self):
+        recorder = QueryRecorder(max_queue_size=10, batch_size=5, flush_interval=0.1)
+        state.set_config('record_queries_sample_rate', 0)
+        with patch.object(state, 'record_queries') as record_queries:
+            recorder.record({'sql': 'SELECT 1'})
+            time.sleep(0.2)
+        assert not record_queries.called
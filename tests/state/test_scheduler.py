@@ -0,0 +1,74 @@
+import time
+from unittest.mock import patch
+
+from tests.base import BaseTest
+from snuba import state
+from snuba.state.scheduler import FairShareScheduler, get_final_rate_limit_params, get_query_weight
+
+
+class TestFairShareScheduler(BaseTest):
+    def test_allocate(self):
+        scheduler = FairShareScheduler(
+            thread_budget=16,
+            memory_budget=8 * 1024 ** 3,
+            min_memory_usage=1024 ** 3,
+            max_query_duration_s=60,
+        )
+
+        with scheduler.allocate(1) as first:
+            assert first.share == 1.0
+            assert first.max_threads == 16
+            assert first.max_memory_usage == 8 * 1024 ** 3
+
+            with scheduler.allocate(3) as second:
+                assert second.share == 0.75
+                assert second.running == 2
+                assert second.max_threads == 12
+                assert second.max_memory_usage == 6 * 1024 ** 3
+
+                with scheduler.allocate(12) as third:
+                    # Queries never get less than one thread, and the
+                    # minimum amount of memory.
+                    with scheduler.allocate(0.01) as fourth:
+                        assert fourth.max_threads == 1
+                        assert fourth.max_memory_usage == 1024 ** 3
+
+                    assert third.share == 0.75
+
+        # Released queries do not count anymore.
+        with scheduler.allocate(2) as allocation:
+            assert allocation.share == 1.0
+            assert allocation.running == 1
+
+    def test_expired_queries(self):
+        scheduler = FairShareScheduler(16, 0, 0, max_query_duration_s=60)
+
+        with patch('snuba.state.scheduler.RELEASE_SCRIPT'):
+            with scheduler.allocate(1):
+                pass
+
+        with scheduler.allocate(1) as allocation:
+            # The query that was never released is still running.
+            assert allocation.share == 0.5
+            assert allocation.max_memory_usage is None
+
+        with patch('snuba.state.scheduler.time.time', return_value=time.time() + 61):
+            with scheduler.allocate(1) as allocation:
+                assert allocation.share == 1.0
+
+    def test_query_weight(self):
+        assert get_query_weight([1, 2], 'api') == 1.0
+
+        state.set_config('project_weight_1', 2)
+        state.set_config('referrer_weight_api', 0.5)
+        assert get_query_weight([1, 2], 'api') == 1.0
+        assert get_query_weight([1, 2], 'search') == 2.0
+        assert get_query_weight([2], 'api') == 0.5
+        assert get_query_weight([], None) == 1.0
+
+    def test_final_rate_limit(self):
+        assert get_final_rate_limit_params() is None
+
+        state.set_config('final_concurrent_limit', 2)
+        params = get_final_rate_limit_params()
+        assert (params.bucket, params.concurrent_limit) == ('final', 2)
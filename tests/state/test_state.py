@@ -3,11 +3,12 @@ from tests.base import BaseEventsTest
 from functools import partial
 import random
 import simplejson as json
-from threading import Thread
+from threading import Event, Thread
 import time
+from unittest.mock import patch
 import uuid
 
-from snuba import state
+from snuba import settings, state
 from snuba.state import safe_dumps
 
 
@@ -93,6 +94,88 @@ class TestState(BaseEventsTest):
             state.delete_config('use_query_id')
             state.delete_config('use_cache')
 
+    def test_deduper_publishes_result(self):
+        query_id = uuid.uuid4().hex
+        results = []
+
+        def run_query(value):
+            with state.deduper(query_id) as dedupe:
+                result = dedupe.get_result('key')
+                if result is None:
+                    time.sleep(0.2)
+                    result = {'data': [value]}
+                    state.set_result('key', result)
+                    dedupe.publish('key')
+                results.append((dedupe.is_duplicate, result))
+
+        threads = [Thread(target=run_query, args=(i,)) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Only one query ran, the others read its cached result.
+        assert sorted(is_dupe for is_dupe, _ in results) == [False, True, True]
+        assert len(set(json.dumps(result) for _, result in results)) == 1
+
+        # Waiters expecting a different result run the query themselves.
+        with state.deduper(query_id) as dedupe:
+            assert not dedupe.is_duplicate
+            assert dedupe.get_result('other') is None
+
+    def test_deduper_wait_is_bounded(self):
+        query_id = uuid.uuid4().hex
+        running = Event()
+        finished = Event()
+
+        def run_query():
+            with state.deduper(query_id):
+                running.set()
+                finished.wait(5)
+
+        thread = Thread(target=run_query)
+        thread.start()
+        try:
+            running.wait(5)
+            with patch.object(state, 'max_query_duration_s', 0.1):
+                # The query stuck in the same process is not waited for
+                # longer than any query can run.
+                with state.deduper(query_id) as dedupe:
+                    assert dedupe.is_duplicate
+                    assert dedupe.get_result('key') is None
+        finally:
+            finished.set()
+            thread.join()
+
+    def test_request_configs(self):
+        state.set_configs({'foo': '1/2/3/4/5/6/7/8', 'query_settings/max_threads': 4})
+
+        with state.request_configs():
+            assert len(set(state.get_config('foo') for _ in range(20))) == 1
+            assert state.get_query_settings() == {'max_threads': 4}
+
+        assert len(set(state.get_config('foo') for _ in range(100))) > 1
+
+    def test_config_snapshot_invalidation(self):
+        with patch.object(settings, 'CONFIG_MEMOIZE_TIMEOUT', 3600):
+            state.set_config('foo', 1)
+            assert state.get_config('foo') == 1
+
+            # Changes made by this process are seen immediately.
+            state.set_config('foo', 2)
+            assert state.get_config('foo') == 2
+
+            # Changes made by other processes are seen once notified.
+            state.rds.hset(state.config_hash, 'foo', 3)
+            assert state.get_config('foo') == 2
+            state.rds.publish(state.config_version_channel, state.rds.incr(state.config_version_key))
+            deadline = time.time() + 5
+            while state.get_config('foo') != 3 and time.time() < deadline:
+                time.sleep(0.01)
+            assert state.get_config('foo') == 3
+
+        state.invalidate_config_snapshot()
+
     def test_memoize(self):
 
         @state.memoize(0.1)
@@ -111,6 +194,8 @@ class TestState(BaseEventsTest):
         assert state.abtest('1000/2000:5') in (1000, 2000)
         assert state.abtest('1000/2000:0') == 1000
         assert state.abtest('1.5:1/-1.5:1') in (1.5, -1.5)
+        assert state.compile_abtest('1000:2/2000:1') == ([2, 3], [1000, 2000])
+        assert state.compile_abtest(1000) is None
 
 
 def test_safe_dumps():
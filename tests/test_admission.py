@@ -0,0 +1,80 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from snuba import state
+from snuba.api.admission import QueryTooExpensive, admit_query
+from snuba.clickhouse.estimator import PartitionStats, QueryCostEstimate, estimate_query_cost
+from snuba.datasets.factory import get_dataset
+from snuba.query.query import Query
+from snuba.request import Request
+from snuba.request.request_settings import RequestSettings
+
+
+def teardown_function(function):
+    for key in ['query_cost_reject_bytes', 'query_cost_sample_bytes', 'query_cost_low_priority_bytes']:
+        state.delete_config(key)
+
+
+def test_estimate_query_cost():
+    week = timedelta(days=7)
+    start = datetime(2019, 10, 7)
+    partitions = [
+        PartitionStats(start, start + week, 1000),
+        PartitionStats(start + week, start + 2 * week, 2000),
+    ]
+    column_sizes = {'event_id': 30000, 'message': 60000}
+
+    # Half of the second partition, for one column.
+    estimate = estimate_query_cost(
+        partitions, column_sizes, start + week, start + week + week / 2, ['event_id'], 1.0, None, 1,
+    )
+    assert estimate == QueryCostEstimate(1000, 10000)
+
+    # FINAL, projects and sampling scale the estimate.
+    estimate = estimate_query_cost(
+        partitions, column_sizes, start, start + 2 * week, ['event_id', 'message'], 0.5, 0.1, 2,
+    )
+    assert estimate == QueryCostEstimate(300, 9000)
+
+    assert estimate_query_cost([], column_sizes, start, start + week, ['event_id'], 1.0, None, 1) == \
+        QueryCostEstimate(0, 0)
+
+
+def build_request() -> Request:
+    events = get_dataset('events')
+    return Request(
+        Query(
+            {'selected_columns': ['event_id'], 'limit': 100},
+            events.get_dataset_schemas().get_read_schema().get_data_source(),
+        ),
+        RequestSettings(False, False, False),
+        {'project': {'project': 1}},
+    )
+
+
+def test_admit_query():
+    events = get_dataset('events')
+    state.set_configs({
+        'query_cost_reject_bytes': 10000,
+        'query_cost_sample_bytes': 1000,
+        'query_cost_low_priority_bytes': 500,
+    })
+
+    request = build_request()
+    stats = {}
+    admit_query(events, request, QueryCostEstimate(10, 100), stats)
+    assert stats == {'estimated_rows': 10, 'estimated_bytes': 100}
+    assert request.query.get_sample() is None
+
+    request = build_request()
+    stats = {}
+    admit_query(events, request, QueryCostEstimate(100, 4000), stats)
+    assert stats['cost_action'] == 'low_priority'
+    assert request.query.get_sample() == 0.25
+    assert request.settings.get_query_settings() == {'priority': 10, 'max_threads': 1}
+    assert request.settings.get_rate_limit_params()[-1].rate_limit_name == 'low_priority'
+
+    request = build_request()
+    with pytest.raises(QueryTooExpensive):
+        admit_query(events, request, QueryCostEstimate(1000, 40000), {})
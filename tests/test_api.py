@@ -3,6 +3,7 @@ import calendar
 from datetime import datetime, timedelta
 from dateutil.parser import parse as parse_datetime
 from functools import partial
+import msgpack
 from unittest.mock import patch
 import pytest
 import pytz
@@ -18,6 +19,20 @@ from snuba.redis import redis_client
 from tests.base import BaseApiTest
 
 
+def test_run_in_context():
+    from snuba.views import run_in_context
+
+    def stream():
+        yield state.get_resolved_configs()
+
+    with state.request_configs():
+        configs = state.get_resolved_configs()
+        streamed = run_in_context(stream())
+
+    # The body is streamed after the request configs are released.
+    assert list(streamed) == [configs]
+
+
 class TestApi(BaseApiTest):
     def setup_method(self, test_method, dataset_name='events'):
         super().setup_method(test_method, dataset_name)
@@ -43,6 +58,7 @@ class TestApi(BaseApiTest):
         state.delete_config('project_concurrent_limit_1')
         state.delete_config('project_per_second_limit')
         state.delete_config('date_align_seconds')
+        state.delete_config('stream_block_size')
 
     def generate_fizzbuzz_events(self):
         """
@@ -254,6 +270,92 @@ class TestApi(BaseApiTest):
         })).data)
         assert 'LIMIT 100 BY environment' in result['sql']
 
+    def test_columnar_format(self):
+        query = {
+            'project': self.project_ids,
+            'groupby': ['project_id', 'time'],
+            'totals': True,
+            'aggregations': [['count()', '', 'count']],
+            'orderby': ['project_id', 'time'],
+        }
+        rows = json.loads(self.app.post('/query', data=json.dumps(query)).data)
+        columnar = json.loads(self.app.post('/query', data=json.dumps({
+            **query,
+            'format': 'columnar',
+        })).data)
+
+        assert columnar['meta'] == rows['meta']
+        assert columnar['totals'] == rows['totals']
+        assert columnar['data'] == {
+            col['name']: [row[col['name']] for row in rows['data']]
+            for col in rows['meta']
+        }
+
+        response = self.app.post('/query', data=json.dumps({
+            **query,
+            'format': 'msgpack',
+        }))
+        assert response.headers['Content-Type'] == 'application/x-msgpack'
+        assert msgpack.unpackb(response.data, raw=False)['data'] == columnar['data']
+
+    def test_json_stream_format(self):
+        query = {
+            'project': self.project_ids,
+            'groupby': ['project_id', 'time'],
+            'totals': True,
+            'aggregations': [['count()', '', 'count']],
+            'orderby': ['project_id', 'time'],
+        }
+        rows = json.loads(self.app.post('/query', data=json.dumps(query)).data)
+
+        state.set_config('stream_block_size', 2)
+        response = self.app.post('/query', data=json.dumps({
+            **query,
+            'format': 'json_stream',
+        }))
+        assert response.status_code == 200
+        assert response.headers['Content-Type'] == 'application/json'
+
+        streamed = json.loads(response.data)
+        assert len(streamed['data']) > 2
+        assert streamed['meta'] == rows['meta']
+        assert streamed['data'] == rows['data']
+        assert streamed['totals'] == rows['totals']
+
+    def test_batch(self):
+        query = {
+            'project': self.project_ids,
+            'groupby': ['project_id'],
+            'aggregations': [['count()', '', 'count']],
+            'orderby': 'project_id',
+        }
+        rows = json.loads(self.app.post('/query', data=json.dumps(query)).data)
+
+        response = self.app.post('/batch', data=json.dumps({'queries': [
+            {**query, 'dataset': 'events'},
+            {'dataset': 'transactions', 'project': self.project_ids, 'aggregations': [['count()', '', 'count']]},
+            {**query, 'selected_columns': ['unknown']},
+            {**query, 'dataset': 'unknown'},
+            {**query, 'format': 'json_stream'},
+            # The schema of the error has defaults generated by callables.
+            {**query, 'from_date': 5},
+        ]}))
+        assert response.status_code == 200
+        results = json.loads(response.data)['results']
+
+        assert [result['status'] for result in results] == [200, 200, 500, 404, 400, 400]
+        assert results[0]['result']['data'] == rows['data']
+        assert results[1]['result']['data'] == [{'count': 0}]
+        assert results[2]['result']['error']['type'] == 'clickhouse'
+        assert results[3]['result']['error']['type'] == 'dataset'
+        assert results[4]['result']['error']['type'] == 'request'
+        assert results[5]['result']['error']['type'] == 'schema'
+        assert results[5]['result']['error']['path'] == ['from_date']
+        assert isinstance(results[5]['result']['error']['schema']['default'], str)
+
+        response = self.app.post('/batch', data=json.dumps({'queries': []}))
+        assert response.status_code == 400
+
     def test_conditions(self):
         result = json.loads(self.app.post('/query', data=json.dumps({
             'project': 2,
@@ -0,0 +1,84 @@
+from datetime import datetime, timedelta
+
+from snuba import replacer, state
+from snuba.api.bucket_cache import bucket_cache
+from snuba.api.query import QueryResult
+from snuba.datasets.dataset import Dataset
+from snuba.datasets.factory import get_dataset
+from snuba.query.query import Query
+from snuba.request import Request
+from snuba.request.request_settings import RequestSettings
+from snuba.util import parse_datetime
+from snuba.utils.metrics.timer import Timer
+
+
+def teardown_function(function):
+    state.delete_config('use_bucket_cache')
+    state.delete_config('bucket_cache_recent_seconds')
+
+
+def test_bucket_cache():
+    state.set_config('use_bucket_cache', 1)
+    state.set_config('bucket_cache_recent_seconds', 0)
+
+    now = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+    # One event every 10 minutes over the last day.
+    timestamps = [now - timedelta(minutes=10 * i) for i in range(1, 6 * 24 + 1)]
+    ranges = []
+
+    def run_query(dataset: Dataset, request: Request, timer: Timer):
+        from_date = parse_datetime(request.extensions['timeseries']['from_date'])
+        to_date = parse_datetime(request.extensions['timeseries']['to_date'])
+        ranges.append((from_date, to_date))
+        counts = {}
+        for ts in timestamps:
+            if from_date <= ts < to_date:
+                bucket = ts.replace(minute=0).isoformat() + '+00:00'
+                counts[bucket] = counts.get(bucket, 0) + 1
+        return QueryResult({
+            'meta': [{'name': 'time', 'type': 'DateTime'}, {'name': 'count', 'type': 'UInt64'}],
+            'data': [{'time': bucket, 'count': count} for bucket, count in sorted(counts.items())],
+        }, 200)
+
+    cached_query = bucket_cache(run_query)
+    events = get_dataset('events')
+
+    def build_request(from_date: datetime, to_date: datetime) -> Request:
+        return Request(
+            Query(
+                {
+                    'aggregations': [['count()', '', 'count']],
+                    'groupby': ['time'],
+                    'orderby': 'time',
+                    'limit': 1000,
+                },
+                events.get_dataset_schemas().get_read_schema().get_data_source(),
+            ),
+            RequestSettings(False, False, False),
+            {
+                'project': {'project': 1},
+                'timeseries': {
+                    'from_date': from_date.isoformat(),
+                    'to_date': to_date.isoformat(),
+                    'granularity': 3600,
+                },
+            },
+        )
+
+    from_date = now - timedelta(hours=23, minutes=30)
+    first = cached_query(events, build_request(from_date, now), None)
+    assert first.result == run_query(events, build_request(from_date, now), None).result
+
+    ranges.clear()
+    later = from_date + timedelta(minutes=20)
+    second = cached_query(events, build_request(later, now), None)
+    assert second.result['data'] == run_query(events, build_request(later, now), None).result['data']
+    # Only the partial bucket at the start of the range was queried again.
+    assert ranges[:-1] == [(later, later.replace(minute=0) + timedelta(hours=1))]
+
+    # Buckets cached before a replacement of the project are not used.
+    replacer.set_project_replaced(1)
+    ranges.clear()
+    third = cached_query(events, build_request(later, now), None)
+    assert third.result['data'] == second.result['data']
+    assert ranges == [(later, now)]
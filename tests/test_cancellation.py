@@ -0,0 +1,67 @@
+import pytest
+import time
+from typing import Any, MutableMapping
+
+from snuba.api.cancellation import CLIENT_DISCONNECTED, DEADLINE_EXCEEDED, QueryCancelled, QueryWatchdog
+from snuba.api.query import _apply_deadline_settings
+from snuba.datasets.factory import get_dataset
+from snuba.query.query import Query
+from snuba.request import Request
+from snuba.request.request_settings import RequestSettings
+
+
+def test_deadline() -> None:
+    cancelled = []
+    with QueryWatchdog(lambda: cancelled.append(True), deadline=time.time() + 0.05) as watchdog:
+        time.sleep(0.2)
+
+    assert cancelled == [True]
+    assert watchdog.reason == DEADLINE_EXCEEDED
+
+    # Queries completing before the deadline are left alone.
+    with QueryWatchdog(lambda: cancelled.append(True), deadline=time.time() + 5) as watchdog:
+        pass
+
+    assert cancelled == [True]
+    assert watchdog.reason is None
+
+
+def test_client_disconnected() -> None:
+    cancelled = []
+    connected = [True]
+    with QueryWatchdog(
+        lambda: cancelled.append(True),
+        disconnect_check=lambda: not connected[0],
+        poll_interval=0.01,
+    ) as watchdog:
+        time.sleep(0.05)
+        assert watchdog.reason is None
+        connected[0] = False
+        time.sleep(0.1)
+
+    assert cancelled == [True]
+    assert watchdog.reason == CLIENT_DISCONNECTED
+
+
+def test_deadline_settings() -> None:
+    def build_request(timeout):
+        dataset = get_dataset('events')
+        return Request(
+            Query({}, dataset.get_dataset_schemas().get_read_schema().get_data_source()),
+            RequestSettings(False, False, False, timeout=timeout),
+            {},
+        )
+
+    query_settings: MutableMapping[str, Any] = {}
+    _apply_deadline_settings(build_request(None), query_settings)
+    assert query_settings == {}
+
+    _apply_deadline_settings(build_request(2.5), query_settings)
+    assert query_settings == {'max_execution_time': 3}
+
+    query_settings = {'max_execution_time': 1}
+    _apply_deadline_settings(build_request(2.5), query_settings)
+    assert query_settings == {'max_execution_time': 1}
+
+    with pytest.raises(QueryCancelled):
+        _apply_deadline_settings(build_request(0), query_settings)
@@ -3,6 +3,7 @@ from tests.base import BaseEventsTest
 from datetime import datetime, timedelta
 
 from snuba import cleanup
+from snuba.datasets.factory import get_dataset
 
 
 class TestCleanup(BaseEventsTest):
@@ -80,3 +81,13 @@ class TestCleanup(BaseEventsTest):
             (to_monday(one_week_ago), 30),
             (to_monday(base), 90)
         ]
+
+
+def test_cleanup_tables():
+    # The rollup is partitioned like the events table, so it is cleaned up
+    # along with it.
+    assert cleanup.get_cleanup_tables(get_dataset('events')) == [
+        'test_sentry_local',
+        'test_sentry_rollup_hourly_local',
+    ]
+    assert cleanup.get_cleanup_tables(get_dataset('outcomes')) == ['test_outcomes_raw_local']
@@ -1,3 +1,7 @@
+import pytest
+import threading
+import time
+
 from tests.base import BaseEventsTest
 
 from clickhouse_driver import errors
@@ -5,7 +9,7 @@ from unittest.mock import patch, call
 
 from snuba.clickhouse.columns import Array, ColumnSet, Nested, Nullable, String, UInt
 from snuba.datasets.factory import enforce_table_writer
-from snuba.clickhouse.native import ClickhousePool
+from snuba.clickhouse.native import ClickhousePool, HedgingPolicy
 
 
 class TestClickhouse(BaseEventsTest):
@@ -40,3 +44,122 @@ class TestClickhouse(BaseEventsTest):
         cp = ClickhousePool()
         cp.execute("SHOW TABLES")
         assert FakeClient.return_value.execute.mock_calls == [call("SHOW TABLES"), call("SHOW TABLES")]
+
+
+class FakeClients:
+    """
+    Creates a fake client per host, failing for the hosts that are down,
+    and blocking on the hosts that are slow until their query is killed.
+    """
+
+    def __init__(self) -> None:
+        self.down = set()
+        self.slow = set()
+        self.queries = []
+        self.killed = []
+        self.released = threading.Event()
+
+    def __call__(self, host, port, **kwargs):
+        clients = self
+
+        class FakeClient:
+            def execute(self, sql, params=None, **kwargs):
+                clients.queries.append((host, sql))
+                if host in clients.down:
+                    raise errors.NetworkError(f'{host} is down')
+                if sql.startswith('KILL QUERY'):
+                    clients.killed.append((host, params['query_ids']))
+                    clients.released.set()
+                    return []
+                if host in clients.slow:
+                    clients.released.wait(5)
+                    raise errors.ServerException('Query was cancelled', 394)
+                return [(host,)]
+
+            def disconnect(self):
+                pass
+
+        return FakeClient()
+
+
+def test_replicas_failover():
+    clients = FakeClients()
+    with patch('snuba.clickhouse.native.Client', clients), \
+            patch('snuba.clickhouse.native.random.sample', lambda hosts, k: hosts[:k]):
+        cp = ClickhousePool('ch1', 9000, replicas=[('ch1', 9000), ('ch2', 9000)], failure_threshold=2)
+        assert [health.host for health in cp.hosts] == ['ch1', 'ch2']
+
+        # The retry of a failed query goes to the other replica, and the
+        # failing replica is not preferred anymore.
+        clients.down.add('ch1')
+        assert cp.execute('SELECT 1') == [('ch2',)]
+        assert cp.execute('SELECT 1') == [('ch2',)]
+        assert clients.queries == [('ch1', 'SELECT 1'), ('ch2', 'SELECT 1'), ('ch2', 'SELECT 1')]
+        assert not cp.hosts[0].is_ejected()
+
+        # After enough failures in a row, the replica is ejected.
+        cp.hosts[1].record_failure()
+        cp.hosts[1].record_failure()
+        assert cp.execute('SELECT 1') == [('ch2',)]
+        assert cp.hosts[0].is_ejected()
+
+        clients.queries.clear()
+        cp.hosts[1].record_failure()
+        assert cp.execute('SELECT 1') == [('ch2',)]
+        assert clients.queries == [('ch2', 'SELECT 1')]
+
+        # Until it works again.
+        clients.down.clear()
+        cp.hosts[0].record_success(0)
+        assert not cp.hosts[0].is_ejected()
+
+
+def test_every_replica_ejected():
+    clients = FakeClients()
+    with patch('snuba.clickhouse.native.Client', clients):
+        cp = ClickhousePool('ch1', 9000, replicas=[('ch2', 9000)], failure_threshold=1)
+        clients.down.update(['ch1', 'ch2'])
+        with pytest.raises(errors.NetworkError):
+            cp.execute('SELECT 1')
+        assert all(health.is_ejected() for health in cp.hosts)
+
+        # Queries still go somewhere.
+        clients.down.clear()
+        assert cp.execute('SELECT 1') in ([('ch1',)], [('ch2',)])
+        assert len([health for health in cp.hosts if health.is_ejected()]) == 1
+
+
+def test_hedged_reads():
+    clients = FakeClients()
+    policy = HedgingPolicy(delay=0.01, max_rate=1.0)
+    with patch('snuba.clickhouse.native.Client', clients), \
+            patch('snuba.clickhouse.native.random.sample', lambda hosts, k: hosts[:k]):
+        # Fast queries are not hedged.
+        cp = ClickhousePool('ch1', 9000, replicas=[('ch2', 9000)])
+        assert cp.execute_hedged('SELECT 1', policy) == [('ch1',)]
+        assert clients.queries == [('ch1', 'SELECT 1')]
+        assert cp.get_latency_percentile(95) is None
+        assert cp.get_latency_percentile(95, min_samples=1) < 1
+
+        # Slow queries are sent to the other replica, and killed when it
+        # answers first.
+        clients.queries.clear()
+        clients.slow.add('ch1')
+        cp = ClickhousePool('ch1', 9000, replicas=[('ch2', 9000)])
+        assert cp.execute_hedged('SELECT 1', policy, query_id='abc') == [('ch2',)]
+        assert clients.released.wait(1)
+        assert clients.killed == [('ch1', ['abc'])]
+        assert clients.queries[:2] == [('ch1', 'SELECT 1'), ('ch2', 'SELECT 1')]
+
+        # Queries failing to connect are sent to the other replica right
+        # away, unless too many queries were hedged already.
+        clients.slow.clear()
+        clients.down.add('ch1')
+        cp = ClickhousePool('ch1', 9000, replicas=[('ch2', 9000)])
+        start = time.time()
+        assert cp.execute_hedged('SELECT 1', HedgingPolicy(delay=5, max_rate=1.0)) == [('ch2',)]
+        assert time.time() - start < 5
+
+        cp = ClickhousePool('ch1', 9000, replicas=[('ch2', 9000)])
+        with pytest.raises(errors.NetworkError):
+            cp.execute_hedged('SELECT 1', HedgingPolicy(delay=5, max_rate=0.0))
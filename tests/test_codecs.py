@@ -0,0 +1,50 @@
+import pytest
+import simplejson as json
+from datetime import datetime, timezone
+from decimal import Decimal
+from uuid import UUID
+
+from snuba.api.codecs import RapidJSONCodec, SimpleJSONCodec, get_codec
+from snuba.utils.metrics.timer import Timer
+
+
+codec_test_data = [
+    {'data': [{'event_id': UUID(int=1), 'timestamp': datetime(2019, 10, 1, 12, 30, 5, 1000), 'project_id': 1}]},
+    {'data': [{'timestamp': datetime(2019, 10, 1, tzinfo=timezone.utc), 'tags': [('a', 'b')], 'value': 0.1}]},
+    {'data': [], 'totals': {'count': 10**20}, 'message': 'café  '},
+    # Encoded by simplejson.
+    {'data': [{1: 'a'}], 'value': Decimal('1.5')},
+]
+
+
+@pytest.mark.parametrize("value", codec_test_data)
+def test_json_codecs(value) -> None:
+    expected = json.loads(SimpleJSONCodec().dumps(value))
+    assert json.loads(RapidJSONCodec().dumps(value)) == expected
+    assert RapidJSONCodec().loads(SimpleJSONCodec().dumps(value)) == expected
+    assert RapidJSONCodec().loads(SimpleJSONCodec().dumps(value).encode('utf-8')) == expected
+
+
+def test_for_json() -> None:
+    timer = Timer('test')
+    timer.mark('execute')
+    for codec in [SimpleJSONCodec(), RapidJSONCodec()]:
+        assert json.loads(codec.dumps({'timing': timer})) == {'timing': timer.for_json()}
+
+
+def test_decode_errors() -> None:
+    # Invalid bodies raise the errors of simplejson, for the error
+    # payloads of bad requests.
+    for body in [b'{', b'[1,]', b'']:
+        with pytest.raises(json.errors.JSONDecodeError) as expected:
+            SimpleJSONCodec().loads(body)
+        with pytest.raises(json.errors.JSONDecodeError) as error:
+            RapidJSONCodec().loads(body)
+        assert str(error.value) == str(expected.value)
+
+
+def test_get_codec() -> None:
+    assert isinstance(get_codec('simplejson'), SimpleJSONCodec)
+    assert isinstance(get_codec('rapidjson'), RapidJSONCodec)
+    # Unknown codecs fall back to simplejson rather than failing requests.
+    assert isinstance(get_codec('yaml'), SimpleJSONCodec)
@@ -0,0 +1,117 @@
+import pytest
+from datetime import datetime
+from typing import Any, Mapping
+
+from snuba import state
+from snuba.api.cursor import InvalidCursor, apply_cursor, decode_cursor, encode_cursor, get_next_cursor
+from snuba.api.query import QueryResult
+from snuba.api.split import split_query
+from snuba.datasets.dataset import Dataset
+from snuba.datasets.factory import get_dataset
+from snuba.query.query import Query
+from snuba.request import Request
+from snuba.request.request_settings import RequestSettings
+from snuba.utils.metrics.timer import Timer
+
+
+def teardown_function(function):
+    state.delete_config('use_split')
+
+
+def build_request(body: Mapping[str, Any]) -> Request:
+    dataset = get_dataset('events')
+    return Request(
+        Query(
+            {
+                'selected_columns': ['event_id', 'timestamp', 'message'],
+                'conditions': [],
+                'orderby': ['-timestamp', '-event_id'],
+                'limit': 2,
+                **body,
+            },
+            dataset.get_dataset_schemas().get_read_schema().get_data_source(),
+        ),
+        RequestSettings(False, False, False),
+        {
+            'project': {'project': [1]},
+            'timeseries': {
+                'from_date': '2019-09-01T00:00:00',
+                'to_date': '2019-10-01T00:00:00',
+                'granularity': 3600,
+            },
+        },
+    )
+
+
+def test_cursor_roundtrip() -> None:
+    timestamp = datetime(2019, 9, 20, 12, 30, 15)
+    assert decode_cursor(encode_cursor(timestamp, 'a' * 32)) == (timestamp, 'a' * 32)
+
+    with pytest.raises(InvalidCursor):
+        decode_cursor('not a cursor')
+
+
+def test_apply_cursor() -> None:
+    dataset = get_dataset('events')
+    request = build_request({'cursor': encode_cursor(datetime(2019, 9, 20, 12, 30, 15), 'b' * 32)})
+    apply_cursor(dataset, request)
+
+    assert request.query.get_conditions() == [
+        ('timestamp', '<=', '2019-09-20T12:30:15'),
+        [
+            ('timestamp', '<', '2019-09-20T12:30:15'),
+            ('event_id', '<', 'b' * 32),
+        ],
+    ]
+    # The time range ends right after the cursor.
+    assert request.extensions['timeseries']['to_date'] == '2019-09-20T12:30:16'
+    assert request.extensions['timeseries']['from_date'] == '2019-09-01T00:00:00'
+
+    # Without a cursor the query is unchanged.
+    request = build_request({})
+    apply_cursor(dataset, request)
+    assert request.query.get_conditions() == []
+
+    with pytest.raises(InvalidCursor):
+        apply_cursor(dataset, build_request({
+            'orderby': '-timestamp',
+            'cursor': encode_cursor(datetime(2019, 9, 20), 'b' * 32),
+        }))
+
+
+def test_next_cursor() -> None:
+    dataset = get_dataset('events')
+    request = build_request({})
+    result = {'data': [
+        {'event_id': 'c' * 32, 'timestamp': '2019-09-20T13:00:00+00:00'},
+        {'event_id': 'b' * 32, 'timestamp': '2019-09-20T12:30:15+00:00'},
+    ]}
+    cursor = get_next_cursor(dataset, request, result)
+    assert decode_cursor(cursor) == (datetime(2019, 9, 20, 12, 30, 15), 'b' * 32)
+
+    # A page shorter than the limit is the last one.
+    assert get_next_cursor(dataset, request, {'data': result['data'][:1]}) is None
+    # Rows cannot be paged without the sort key.
+    assert get_next_cursor(dataset, build_request({'orderby': '-timestamp'}), result) is None
+
+
+def test_next_cursor_after_time_split() -> None:
+    state.set_config('use_split', 1)
+    dataset = get_dataset('events')
+    rows = [
+        {'event_id': 'c' * 32, 'timestamp': '2019-09-30T23:30:00+00:00'},
+        {'event_id': 'b' * 32, 'timestamp': '2019-09-02T12:30:15+00:00'},
+    ]
+
+    @split_query
+    def do_query(dataset: Dataset, request: Request, timer: Timer):
+        from_date = request.extensions['timeseries']['from_date']
+        to_date = request.extensions['timeseries']['to_date']
+        data = [row for row in rows if from_date <= row['timestamp'][:19] < to_date]
+        return QueryResult({'data': data[:request.query.get_limit()]}, 200)
+
+    request = build_request({'limit': 3})
+    result = do_query(dataset, request, None)
+    assert result.result['data'] == rows
+    # Every row was returned, even though the last window asked for one.
+    assert get_next_cursor(dataset, request, result.result) is None
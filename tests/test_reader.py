@@ -0,0 +1,50 @@
+import uuid
+from datetime import date, datetime
+
+from dateutil.tz import tz
+
+from snuba.reader import get_conversion_plan, transform_columns
+
+
+def test_transform_columns():
+    meta = [
+        {'name': 'event_id', 'type': 'UUID'},
+        {'name': 'project_id', 'type': 'UInt64'},
+        {'name': 'timestamp', 'type': 'DateTime'},
+        {'name': 'received', 'type': 'Nullable(DateTime)'},
+        {'name': 'day', 'type': 'Date'},
+    ]
+    result = transform_columns({
+        'meta': meta,
+        'data': [{
+            'event_id': uuid.UUID(int=1),
+            'project_id': 1,
+            'timestamp': datetime(2019, 10, 1, 12, 30, 15),
+            'received': datetime(2019, 10, 1, 12, 30, 15, 500, tzinfo=tz.tzutc()),
+            'day': date(2019, 10, 1),
+        }],
+        'totals': {
+            'event_id': uuid.UUID(int=2),
+            'project_id': 2,
+            'timestamp': datetime(2019, 10, 2),
+            'received': datetime(2019, 10, 2),
+            'day': date(2019, 10, 2),
+        },
+    })
+
+    assert result['data'] == [{
+        'event_id': '00000000-0000-0000-0000-000000000001',
+        'project_id': 1,
+        'timestamp': '2019-10-01T12:30:15+00:00',
+        'received': '2019-10-01T12:30:15.000500+00:00',
+        'day': '2019-10-01T00:00:00+00:00',
+    }]
+    assert result['totals'] == {
+        'event_id': '00000000-0000-0000-0000-000000000002',
+        'project_id': 2,
+        'timestamp': '2019-10-02T00:00:00+00:00',
+        'received': '2019-10-02T00:00:00+00:00',
+        'day': '2019-10-02T00:00:00+00:00',
+    }
+
+    assert get_conversion_plan([dict(col) for col in meta]) is get_conversion_plan(meta)
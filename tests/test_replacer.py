@@ -1,10 +1,12 @@
 import pytz
 import re
-from datetime import datetime
+import time
+import calendar
+from datetime import datetime, timedelta
 from functools import partial
 import simplejson as json
 
-from snuba import replacer
+from snuba import replacer, rollup, state
 from snuba.clickhouse import DATETIME_FORMAT
 from snuba.settings import PAYLOAD_DATETIME_FORMAT
 from snuba.utils.metrics.backends.dummy import DummyMetricsBackend
@@ -285,6 +287,109 @@ class TestReplacer(BaseEventsTest):
         assert _issue_count() == []
         assert _issue_count(total=True) == [{'count': 1, 'issue': 1}]
 
+    def test_rollup_counts_after_replacements(self):
+        hour = datetime.utcnow().replace(minute=0, second=0, microsecond=0) - timedelta(hours=2)
+        state.set_config('events_rollup_start', calendar.timegm((hour - timedelta(days=1)).timetuple()))
+
+        events = []
+        for group_id in [1, 1, 2]:
+            event = self.create_event_for_date(hour + timedelta(minutes=10))
+            event['project_id'] = self.project_id
+            event['group_id'] = group_id
+            events.append(event)
+        self.write_processed_records(events)
+
+        def _issue_count():
+            result = json.loads(self.app.post('/query', data=json.dumps({
+                'project': [self.project_id],
+                'aggregations': [['count()', '', 'count']],
+                'groupby': ['issue'],
+                'orderby': 'issue',
+                'granularity': 3600,
+                'from_date': hour.isoformat(),
+                'to_date': (hour + timedelta(hours=1)).isoformat(),
+            })).data)
+            return result['data'], result['stats']['rollup']
+
+        assert _issue_count() == ([{'count': 2, 'issue': 1}, {'count': 1, 'issue': 2}], 'routed')
+
+        timestamp = datetime.now(tz=pytz.utc)
+
+        for message, expected in [
+            ((2, 'end_merge', {
+                'project_id': self.project_id,
+                'new_group_id': 2,
+                'previous_group_ids': [1],
+                'datetime': timestamp.strftime(PAYLOAD_DATETIME_FORMAT),
+            }), [{'count': 3, 'issue': 2}]),
+            ((2, 'end_delete_groups', {
+                'project_id': self.project_id,
+                'group_ids': [2],
+                'datetime': timestamp.strftime(PAYLOAD_DATETIME_FORMAT),
+            }), []),
+        ]:
+            processed = self.replacer.process_message(self._wrap(message))
+            self.replacer.flush_batch([processed])
+
+            # The rollup still holds the counts from before the replacement,
+            # so queries of the project are answered from the raw table.
+            assert _issue_count() == (expected, 'replaced')
+
+            # Until the rollup is rebuilt from the replaced events.
+            view, table = rollup.get_rollups(self.dataset)[0]
+            started = time.time()
+            until = rollup.run_rebuild(
+                self.clickhouse, self.database, view, table, dry_run=False,
+                as_of=hour + timedelta(days=9),
+            )
+            rollup.set_rollup_rebuilt(table.get_table_name(), started, until)
+            assert _issue_count() == (expected, 'routed')
+
+        state.delete_config('events_rollup_start')
+
+    def test_bucket_cache_after_replacements(self):
+        state.set_config('use_bucket_cache', 1)
+        state.set_config('bucket_cache_recent_seconds', 0)
+        hour = datetime.utcnow().replace(minute=0, second=0, microsecond=0) - timedelta(hours=2)
+
+        events = []
+        for group_id in [1, 2]:
+            event = self.create_event_for_date(hour + timedelta(minutes=10))
+            event['project_id'] = self.project_id
+            event['group_id'] = group_id
+            events.append(event)
+        self.write_processed_records(events)
+
+        def _issue_count():
+            result = json.loads(self.app.post('/query', data=json.dumps({
+                'project': [self.project_id],
+                'aggregations': [['count()', '', 'count']],
+                'conditions': [['issue', '=', 1]],
+                'groupby': ['time'],
+                'granularity': 3600,
+                'from_date': hour.isoformat(),
+                'to_date': (hour + timedelta(hours=2)).isoformat(),
+            })).data)
+            return [row['count'] for row in result['data']], result['stats'].get('cached_buckets')
+
+        assert _issue_count() == ([1], 0)
+        assert _issue_count() == ([1], 1)
+
+        message = (2, 'end_delete_groups', {
+            'project_id': self.project_id,
+            'group_ids': [1],
+            'datetime': datetime.now(tz=pytz.utc).strftime(PAYLOAD_DATETIME_FORMAT),
+        })
+        processed = self.replacer.process_message(self._wrap(message))
+        self.replacer.flush_batch([processed])
+
+        # The cached bucket still counts the deleted event, it is queried
+        # again.
+        assert _issue_count() == ([], 0)
+
+        state.delete_config('use_bucket_cache')
+        state.delete_config('bucket_cache_recent_seconds')
+
     def test_query_time_flags(self):
         project_ids = [1, 2]
 
@@ -0,0 +1,25 @@
+from datetime import datetime, timedelta
+
+from snuba import rollup
+from snuba.datasets.factory import get_dataset
+
+
+def test_get_rollups():
+    (view, table), = rollup.get_rollups(get_dataset('events'))
+    assert view.get_local_table_name() == 'test_sentry_mv_rollup_hourly_local'
+    assert table.get_local_table_name() == 'test_sentry_rollup_hourly_local'
+    assert rollup.get_rollups(get_dataset('outcomes')) == []
+
+
+def test_filter_closed_partitions():
+    monday = datetime(2019, 9, 16)
+    parts = [(monday - timedelta(days=7), 90), (monday, 30), (monday, 90)]
+
+    assert rollup.filter_closed_partitions(parts, as_of=monday) == []
+    assert rollup.filter_closed_partitions(parts, as_of=monday + timedelta(days=1)) == [
+        (monday - timedelta(days=7), 90),
+    ]
+    assert rollup.filter_closed_partitions(parts, as_of=monday + timedelta(days=8)) == parts
+    assert rollup.filter_closed_partitions(parts, as_of=monday + timedelta(days=8), margin=timedelta(days=2)) == [
+        (monday - timedelta(days=7), 90),
+    ]
@@ -1,6 +1,10 @@
 import pytest
+import time
+from datetime import datetime, timedelta
 from typing import Any, Mapping
 
+from dateutil.parser import parse as parse_datetime
+
 from snuba import state
 from snuba.api.split import split_query
 from snuba.datasets.dataset import Dataset
@@ -16,6 +20,11 @@ def setup_function(function):
     state.set_config('use_split', 1)
 
 
+def teardown_function(function):
+    for key in ['use_split', 'split_step', 'split_speculative_windows', 'split_test_abtest']:
+        state.delete_config(key)
+
+
 test_data_no_split = [
     "events",
     "transactions",
@@ -135,3 +144,174 @@ def test_col_split(
     )
 
     do_query(events, request, None)
+
+
+@pytest.mark.parametrize("speculative_windows", [0, 1, 2])
+def test_time_split(speculative_windows: int):
+    state.set_config('split_step', 3600)
+    state.set_config('split_speculative_windows', speculative_windows)
+
+    # One event every 30 minutes, only in the first and the last days.
+    timestamps = [
+        datetime(2019, 9, 19, 10) + timedelta(minutes=30 * i)
+        for i in list(range(48)) + list(range(48 * 29, 48 * 30))
+    ]
+    windows = []
+
+    @split_query
+    def do_query(dataset: Dataset, request: Request, timer: Timer):
+        from_date = parse_datetime(request.extensions['timeseries']['from_date'])
+        to_date = parse_datetime(request.extensions['timeseries']['to_date'])
+        windows.append((from_date, to_date))
+        data = [
+            {'event_id': ts.isoformat(), 'timestamp': ts.isoformat()}
+            for ts in sorted(timestamps, reverse=True)
+            if from_date <= ts < to_date
+        ]
+        return QueryResult({'data': data[:request.query.get_limit()]}, 200)
+
+    events = get_dataset('events')
+    query = Query(
+        {
+            'selected_columns': ['event_id', 'timestamp'],
+            'conditions': [],
+            'orderby': '-timestamp',
+            'limit': 10,
+            'offset': 45,
+        },
+        events.get_dataset_schemas().get_read_schema().get_data_source(),
+    )
+    request = Request(
+        query,
+        RequestSettings(False, False, False),
+        {
+            'project': {'project': 1},
+            'timeseries': {
+                'from_date': '2019-09-19T10:00:00',
+                'to_date': '2019-10-19T10:00:00',
+                'granularity': 3600,
+            },
+        },
+    )
+
+    result = do_query(events, request, None)
+    # Every window is queried with a copy of the request.
+    assert request.query.get_limit() == 10
+    assert request.query.get_offset() == 45
+    assert request.extensions['timeseries']['from_date'] == '2019-09-19T10:00:00'
+    expected = sorted(timestamps, reverse=True)[45:55]
+    assert result.result['data'] == [
+        {'event_id': ts.isoformat(), 'timestamp': ts.isoformat()}
+        for ts in expected
+    ]
+
+
+def test_time_split_stops_discarded_windows():
+    state.set_config('split_step', 3600)
+    state.set_config('split_speculative_windows', 2)
+
+    started = []
+    stopped = []
+
+    def wait_for(items, count):
+        deadline = time.time() + 5
+        while len(items) < count and time.time() < deadline:
+            time.sleep(0.01)
+
+    @split_query
+    def do_query(dataset: Dataset, request: Request, timer: Timer):
+        disconnect_check = request.settings.get_disconnect_check()
+        if disconnect_check is None:
+            # The latest window returns enough rows for the whole query,
+            # once the speculative windows are running.
+            wait_for(started, 2)
+            return QueryResult({'data': [{'event_id': str(i)} for i in range(10)]}, 200)
+
+        # Speculative windows run until the query watchdog would kill them.
+        started.append(True)
+        deadline = time.time() + 5
+        while not disconnect_check() and time.time() < deadline:
+            time.sleep(0.01)
+        stopped.append(disconnect_check())
+        return QueryResult({'data': []}, 200)
+
+    events = get_dataset('events')
+    query = Query(
+        {
+            'selected_columns': ['event_id', 'timestamp'],
+            'conditions': [],
+            'orderby': '-timestamp',
+            'limit': 10,
+        },
+        events.get_dataset_schemas().get_read_schema().get_data_source(),
+    )
+    request = Request(
+        query,
+        RequestSettings(False, False, False),
+        {
+            'project': {'project': 1},
+            'timeseries': {
+                'from_date': '2019-09-19T10:00:00',
+                'to_date': '2019-10-19T10:00:00',
+                'granularity': 3600,
+            },
+        },
+    )
+
+    result = do_query(events, request, None)
+    assert len(result.result['data']) == 10
+
+    wait_for(stopped, 2)
+    assert stopped == [True, True]
+
+
+def test_time_split_shares_request_configs(monkeypatch):
+    state.set_config('split_step', 3600)
+    state.set_config('split_speculative_windows', 2)
+    state.set_config('split_test_abtest', '1/2/3/4/5/6/7/8/9/10')
+
+    picks = []
+
+    def pick_abtest(weights, values):
+        picks.append(values)
+        return values[len(picks) % len(values)]
+
+    values = []
+
+    @split_query
+    def do_query(dataset: Dataset, request: Request, timer: Timer):
+        values.append(state.get_config('split_test_abtest'))
+        return QueryResult({'data': []}, 200)
+
+    events = get_dataset('events')
+    query = Query(
+        {
+            'selected_columns': ['event_id', 'timestamp'],
+            'conditions': [],
+            'orderby': '-timestamp',
+            'limit': 10,
+        },
+        events.get_dataset_schemas().get_read_schema().get_data_source(),
+    )
+    request = Request(
+        query,
+        RequestSettings(False, False, False),
+        {
+            'project': {'project': 1},
+            'timeseries': {
+                'from_date': '2019-09-19T10:00:00',
+                'to_date': '2019-09-20T10:00:00',
+                'granularity': 3600,
+            },
+        },
+    )
+
+    monkeypatch.setattr(state, 'pick_abtest', pick_abtest)
+    with state.request_configs():
+        do_query(events, request, None)
+
+    # The A/B test is resolved once for the request, and every window,
+    # including the speculative ones, sees the same value.
+    assert len(picks) == 1
+    assert len(values) > 1
+    assert set(values) == {picks[0][1]}
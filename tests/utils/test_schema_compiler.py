@@ -0,0 +1,96 @@
+import jsonschema
+import pytest
+from typing import Any
+
+from snuba.query.project_extension import PROJECT_EXTENSION_SCHEMA
+from snuba.query.schema import GENERIC_QUERY_SCHEMA, SETTINGS_SCHEMA
+from snuba.schemas import CompiledSchema, validate_jsonschema
+from snuba.utils.schema_compiler import UnsupportedSchema, compile_schema
+
+schema_test_data = [
+    {'project': 1},
+    {
+        'project': [1, 2],
+        'selected_columns': ['a', ['foo', ['b']]],
+        'aggregations': [['count()', '', 'count'], ['uniq', ['a', 'b'], 'uniq']],
+        'conditions': [['a', '=', 1], [['b', 'IN', [1, 2]], ['c', 'IS NULL', None]]],
+        'groupby': 'a',
+        'orderby': ['-count'],
+        'limitby': [10, 'a'],
+        'granularity': 60,
+        'turbo': True,
+    },
+    {},
+    {'project': 'a'},
+    {'project': 1, 'unknown': 1},
+    {'project': 1, 'limit': -1},
+    {'project': 1, 'limitby': ['a', 10]},
+    {'project': 1, 'conditions': [['a', 'MATCHES', 1]]},
+    {'project': 1, 'granularity': 0},
+    {'project': 1, 'format': 'csv'},
+    {'project': 1, 'timeout': -1},
+]
+
+
+def validate(schema: Any, value: Any) -> Any:
+    try:
+        return validate_jsonschema(value, schema)
+    except jsonschema.ValidationError as error:
+        return (error.message, list(error.path), error.schema)
+
+
+def validate_compiled(schema: CompiledSchema, value: Any) -> Any:
+    try:
+        return schema.validate(value)
+    except jsonschema.ValidationError as error:
+        return (error.message, list(error.path), error.schema)
+
+
+@pytest.mark.parametrize("value", schema_test_data)
+def test_compiled_schema(value: Any) -> None:
+    # The timeseries extension is left out since its defaults depend on
+    # the current time.
+    schema = {
+        'type': 'object',
+        'properties': {
+            **GENERIC_QUERY_SCHEMA['properties'],
+            **SETTINGS_SCHEMA['properties'],
+            **PROJECT_EXTENSION_SCHEMA['properties'],
+        },
+        'required': PROJECT_EXTENSION_SCHEMA['required'],
+        'definitions': GENERIC_QUERY_SCHEMA['definitions'],
+        'additionalProperties': False,
+    }
+    compiled = CompiledSchema(schema)
+    assert compiled.is_compiled()
+    assert validate_compiled(compiled, value) == validate(schema, value)
+
+
+def test_compiled_values_are_copied() -> None:
+    schema = {
+        'type': 'object',
+        'properties': {
+            'a': {'type': 'array', 'default': []},
+            'b': {'type': 'object', 'properties': {'c': {'type': 'integer', 'default': 1}}},
+        },
+    }
+    value = {'b': {}}
+    validated = CompiledSchema(schema).validate(value)
+    assert validated == {'a': [], 'b': {'c': 1}}
+    assert value == {'b': {}}
+
+    validated['a'].append(1)
+    assert CompiledSchema(schema).validate(value) == {'a': [], 'b': {'c': 1}}
+
+
+def test_unsupported_schema() -> None:
+    schema = {'type': 'object', 'patternProperties': {'^a': {'type': 'integer'}}}
+    with pytest.raises(UnsupportedSchema):
+        compile_schema(schema)
+
+    # Schemas that cannot be compiled are still validated by jsonschema.
+    compiled = CompiledSchema(schema)
+    assert not compiled.is_compiled()
+    assert compiled.validate({'a': 1}) == {'a': 1}
+    with pytest.raises(jsonschema.ValidationError):
+        compiled.validate({'a': 'b'})